@@ -0,0 +1,422 @@
+from my_dpi.flow import Flow
+from my_dpi.packet import Packet
+from my_dpi.pcap_reader import PcapReader
+from worker import Worker
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# bytes of every packet copied to the header array: Ethernet, two VLAN tags,
+# IPv4 header with options and TCP header up to its data offset
+HEADER_BYTES = 96
+ETHERTYPES_VLAN = (0x8100, 0x88a8, 0x9100)
+# shorter segments of blocks with flow timeouts or max_flows are processed packet by packet
+MIN_SEGMENT_PACKETS = 64
+
+
+class BatchWorker(Worker):
+    """ Worker that decodes blocks of packets with NumPy
+
+    Ethernet/VLAN/IPv4/TCP/UDP headers of a block are decoded with vectorised
+    offset arithmetic, and flow packet/byte counters and timestamps are
+    updated with grouped reductions. Only the first packet of every new flow
+    and next packets of flows that are still pending go through MyDpi. Packets the vectorised decoder does not
+    handle (IPv6, MPLS, ...) go through Worker.process_packet.
+    Blocks with flow timeouts or max_flows are processed in segments that end
+    before the next packet that may expire a flow or evict one, so flows leave
+    the table at the packets they would leave it at in Worker.process_packet.
+    """
+
+    def __init__(self, my_bdpi, flow_table=None, batch_size=65536, packet_filter=None):
+        if np is None:
+            raise ImportError('numpy is required for batch mode')
+        Worker.__init__(self, my_bdpi, flow_table, packet_filter=packet_filter)
+        self.batch_size = batch_size
+        self.records_dtype = np.dtype([
+            ('timestamp', np.float64),
+            ('captured_length', np.int64),
+            ('header', np.uint8, (HEADER_BYTES,)),
+        ])
+
+    def executor(self, pcap_file_name):
+        """ Read pcap or pcapng file in blocks of batch_size packets
+
+        Args:
+            pcap_file_name (string): path of the pcap file
+        """
+        with PcapReader(pcap_file_name) as pcap:
+            # headers are gathered straight from the memory mapping of the file
+            file_bytes = np.frombuffer(pcap.mapping, dtype=np.uint8)
+            block = []
+            packet_filter = self.packet_filter
+            view = pcap.view
+            for record in pcap.iter_record_offsets():
+                # filtered packets are left out of the blocks
+                if packet_filter is not None and not packet_filter(view[record[1]:record[1] + record[2]]):
+                    continue
+                block.append(record)
+                if len(block) >= self.batch_size:
+                    self.process_block(view, file_bytes, block)
+                    block = []
+            if block:
+                self.process_block(view, file_bytes, block)
+            # the mapping can not be closed while an array uses it
+            del file_bytes
+
+    def load_block(self, file_bytes, block):
+        """ Load packet records into a structured array
+
+        Args:
+            file_bytes (numpy.ndarray): bytes of the capture file
+            block (list): list of (timestamp, packet offset, captured length) records
+
+        Returns:
+            numpy.ndarray: records with timestamp, captured_length and the first HEADER_BYTES of the packet
+        """
+        block_array = np.array(block, dtype=np.float64)
+        data_offsets = block_array[:, 1].astype(np.int64)
+        records = np.zeros(len(block), dtype=self.records_dtype)
+        records['timestamp'] = block_array[:, 0]
+        records['captured_length'] = block_array[:, 2]
+        header_offsets = data_offsets[:, None] + np.arange(HEADER_BYTES)
+        # bytes after the end of the file are never read because of captured_length checks
+        records['header'] = file_bytes[np.minimum(header_offsets, len(file_bytes) - 1)]
+        return records
+
+    def decode_block(self, records):
+        """ Decode Ethernet/VLAN/IPv4/TCP/UDP headers of every record
+
+        Args:
+            records (numpy.ndarray): records returned by load_block
+
+        Returns:
+            dict: arrays of decoded fields, 'decoded' marks packets with a TCP/UDP payload and
+                'fallback' marks packets that must go through Worker.process_packet
+        """
+        header = records['header'].astype(np.int64)
+        captured_length = records['captured_length']
+        rows = np.arange(len(records))
+
+        def field(offset, size=1):
+            # big endian field of size bytes at per packet offset
+            value = header[rows, offset]
+            for index in range(1, size):
+                value = (value << 8) | header[rows, offset + index]
+            return value
+
+        l3_offset = np.full(len(records), 12)
+        ethertype = field(l3_offset, 2)
+        for _ in range(2):
+            vlan = np.isin(ethertype, ETHERTYPES_VLAN)
+            l3_offset = l3_offset + vlan * 4
+            ethertype = np.where(vlan, field(l3_offset, 2), ethertype)
+        l3_offset = l3_offset + 2
+        is_ipv4 = (ethertype == 0x0800) & (captured_length >= l3_offset + 20)
+        version_ihl = field(l3_offset)
+        header_length = (version_ihl & 0x0f) * 4
+        is_ipv4 &= ((version_ihl >> 4) == 4) & (header_length >= 20)
+        total_length = field(l3_offset + 2, 2)
+        fragment_offset = field(l3_offset + 6, 2) & 0x1fff
+        ip_protocol = field(l3_offset + 9)
+        src_ip = field(l3_offset + 12, 4)
+        dst_ip = field(l3_offset + 16, 4)
+        l4_offset = l3_offset + header_length
+        is_tcp = ip_protocol == 6
+        is_udp = ip_protocol == 17
+        src_port = field(l4_offset, 2)
+        dst_port = field(l4_offset + 2, 2)
+        tcp_sequence = field(l4_offset + 4, 4)
+        payload_offset = np.where(is_tcp, l4_offset + (field(l4_offset + 12) >> 4) * 4, l4_offset + 8)
+        payload_end = np.minimum(l3_offset + total_length, captured_length)
+        payload_length = payload_end - payload_offset
+        l4_present = (is_tcp & (payload_end >= l4_offset + 13)) | (is_udp & (payload_end >= l4_offset + 8))
+        decoded = is_ipv4 & (fragment_offset == 0) & l4_present & (payload_length > 0)
+        # every packet that is not an IPv4 packet is decoded by the Worker
+        fallback = ~is_ipv4
+        return {
+            'decoded': decoded,
+            'fallback': fallback,
+            'src_ip': src_ip,
+            'dst_ip': dst_ip,
+            'is_tcp': is_tcp,
+            'src_port': src_port,
+            'dst_port': dst_port,
+            'tcp_sequence': tcp_sequence,
+            'payload_offset': payload_offset,
+            'payload_end': payload_end,
+            'payload_length': payload_length,
+        }
+
+    def process_block(self, view, file_bytes, block):
+        """ Decode a block of records and update flows with grouped reductions
+
+        Args:
+            view (memoryview): memoryview of the capture file
+            file_bytes (numpy.ndarray): bytes of the capture file
+            block (list): list of (timestamp, packet offset, captured length) records
+        """
+        records = self.load_block(file_bytes, block)
+        fields = self.decode_block(records)
+        flow_table = self.flows_dict
+        if not flow_table.expiring and flow_table.max_flows is None:
+            # flows only leave the table at the end of the capture, the whole block is one segment
+            for index in np.flatnonzero(fields['fallback']):
+                self.process_record(view, block, index)
+            self.process_segment(view, block, records, fields, 0, len(block))
+            return
+
+        # flows expire and are evicted between segments like they would between packets
+        timestamps = records['timestamp']
+        fallback_indexes = np.flatnonzero(fields['fallback'])
+        start = 0
+        while start < len(block):
+            if flow_table.expiring:
+                flow_table.expire(float(timestamps[start]))
+            end = self.get_segment_end(timestamps, fallback_indexes, start)
+            if end - start < MIN_SEGMENT_PACKETS:
+                # a fallback packet, or a segment that costs more NumPy calls than its packets cost one by one
+                end = max(end, start + 1)
+                for index in range(start, end):
+                    self.process_record(view, block, index)
+            else:
+                evicting_index = self.process_segment(view, block, records, fields, start, end)
+                if evicting_index is not None:
+                    # the new flow of this packet evicts a flow, packets before it are a segment of their own
+                    if evicting_index > start:
+                        self.process_segment(view, block, records, fields, start, evicting_index)
+                    self.process_record(view, block, evicting_index)
+                    end = evicting_index + 1
+            start = end
+
+    def process_record(self, view, block, index):
+        """ Process a packet of a block with Worker.process_packet
+
+        Args:
+            view (memoryview): memoryview of the capture file
+            block (list): list of (timestamp, packet offset, captured length) records
+            index (int): index of the packet in block
+        """
+        timestamp, data_offset, captured_length = block[index]
+        self.process_packet(view[data_offset:data_offset + captured_length], timestamp)
+
+    def get_segment_end(self, timestamps, fallback_indexes, start):
+        """ Get the end of the segment that starts at start: the next fallback packet,
+            or the next packet whose timestamp may expire a flow
+
+        Args:
+            timestamps (numpy.ndarray): timestamps of the block
+            fallback_indexes (numpy.ndarray): increasing indexes of the fallback packets of the block
+            start (int): index of the first packet of the segment, flows are expired up to its timestamp
+
+        Returns:
+            int: index after the last packet of the segment, start if the first packet is a fallback packet
+        """
+        flow_table = self.flows_dict
+        end = len(timestamps)
+        fallback_position = np.searchsorted(fallback_indexes, start)
+        if fallback_position < len(fallback_indexes):
+            end = int(fallback_indexes[fallback_position])
+        if not flow_table.expiring or end == start:
+            return end
+        oldest_last_time, oldest_start_time = flow_table.get_oldest_times()
+        # expiring packets are searched in growing windows, the search costs about the length of the segment
+        window_end = start
+        window_length = MIN_SEGMENT_PACKETS
+        while window_end < end:
+            window_end = min(window_end + window_length, end)
+            window_length *= 2
+            window_timestamps = timestamps[start:window_end]
+            # flows added by the segment are not older than the earliest timestamp before them
+            oldest_times = np.minimum.accumulate(window_timestamps)
+            is_expiring = np.zeros(len(window_timestamps), dtype=np.bool_)
+            for timeout, oldest_time in ((flow_table.idle_timeout, oldest_last_time),
+                                         (flow_table.active_timeout, oldest_start_time)):
+                if timeout is None:
+                    continue
+                times = oldest_times if oldest_time is None else np.minimum(oldest_times, oldest_time)
+                # same comparison as FlowTable.expire
+                is_expiring |= window_timestamps - timeout >= times
+            # flows were expired up to the first packet
+            is_expiring[0] = False
+            if is_expiring.any():
+                return start + int(np.argmax(is_expiring))
+        return end
+
+    def process_segment(self, view, block, records, fields, start, end):
+        """ Update flows of the decoded packets of a segment with grouped reductions,
+            no flow may expire in the segment
+
+        Args:
+            view (memoryview): memoryview of the capture file
+            block (list): list of (timestamp, packet offset, captured length) records
+            records (numpy.ndarray): records returned by load_block
+            fields (dict): fields returned by decode_block
+            start (int): index of the first packet of the segment
+            end (int): index after the last packet of the segment
+
+        Returns:
+            int: None if the segment is processed, otherwise the index of the first packet
+                whose new flow would evict a flow above max_flows, nothing is processed then
+        """
+        indexes = np.flatnonzero(fields['decoded'][start:end]) + start
+        if not len(indexes):
+            return None
+        timestamps = records['timestamp'][indexes]
+        payload_length = fields['payload_length'][indexes]
+        is_tcp = fields['is_tcp'][indexes]
+        # endpoints packed like FiveTuple.get_flow_key: 32 bits address and 16 bits port
+        src_endpoint = (fields['src_ip'][indexes] << 16) | fields['src_port'][indexes]
+        dst_endpoint = (fields['dst_ip'][indexes] << 16) | fields['dst_port'][indexes]
+        src_endpoint_is_lower = src_endpoint <= dst_endpoint
+        lower_endpoint = np.minimum(src_endpoint, dst_endpoint)
+        higher_endpoint = (np.maximum(src_endpoint, dst_endpoint) << 1) | is_tcp
+        # group packets by flow: stable sort by (lower, higher) endpoint, then split where the key changes
+        order = np.lexsort((higher_endpoint, lower_endpoint))
+        sorted_lower = lower_endpoint[order]
+        sorted_higher = higher_endpoint[order]
+        is_group_start = np.ones(len(order), dtype=np.bool_)
+        is_group_start[1:] = (sorted_lower[1:] != sorted_lower[:-1]) | (sorted_higher[1:] != sorted_higher[:-1])
+        inverse = np.empty(len(order), dtype=np.int64)
+        inverse[order] = np.cumsum(is_group_start) - 1
+        # the sort is stable, so the group start is the first packet of the flow in the block
+        first_indexes = order[is_group_start]
+        flow_keys = [
+            lower.to_bytes(6, 'big') + (higher >> 1).to_bytes(6, 'big') + (b'\x01' if higher & 1 else b'\x00')
+            for lower, higher in zip(sorted_lower[is_group_start].tolist(), sorted_higher[is_group_start].tolist())
+        ]
+        creation_order = np.argsort(first_indexes, kind='stable')
+
+        flow_table = self.flows_dict
+        if flow_table.max_flows is not None:
+            # an evicted flow may still have packets in the segment, the segment must stop before its eviction
+            free_flows_count = flow_table.max_flows - len(flow_table)
+            for flow_index in creation_order:
+                if flow_keys[flow_index] not in flow_table:
+                    free_flows_count -= 1
+                    if free_flows_count < 0:
+                        return int(indexes[first_indexes[flow_index]])
+
+        flows_count = len(flow_keys)
+        client_endpoint_is_lower = np.empty(flows_count, dtype=np.bool_)
+        # packets already counted by Flow.update_stats
+        counted = np.zeros(len(indexes), dtype=np.bool_)
+        flows = [None] * flows_count
+        # create flows in the order of their first packet
+        for flow_index in creation_order:
+            flow_key = flow_keys[flow_index]
+            flow = flow_table.lookup(flow_key)
+            if flow is None:
+                first_index = first_indexes[flow_index]
+                flow = self.create_flow(flow_key, view, block, fields, indexes[first_index], bool(src_endpoint_is_lower[first_index]))
+                counted[first_index] = True
+            flows[flow_index] = flow
+            client_endpoint_is_lower[flow_index] = flow.client_endpoint_is_lower
+
+        # packets of flows that are still pending are inspected one by one in packet order
+        is_inspecting = np.array([flow.is_inspecting() for flow in flows], dtype=np.bool_)
+        for position in np.flatnonzero(~counted & is_inspecting[inverse]):
+            flow = flows[inverse[position]]
+            if flow.is_inspecting():
+                self.inspect_next_packet(flow, view, block, fields, indexes[position],
+                                         bool(src_endpoint_is_lower[position]))
+
+        positions = np.arange(len(indexes))
+        if flow_table.lru:
+            # like lookups of every packet, flows are left in the order of their last packet
+            last_packets = np.full(flows_count, -1)
+            np.maximum.at(last_packets, inverse, positions)
+            for flow_index in np.argsort(last_packets):
+                flow_table.lookup(flow_keys[flow_index])
+
+        # grouped reductions over the remaining packets of every flow
+        remaining = ~counted
+        # every packet of the segment was the first packet of its flow
+        if not remaining.any():
+            return None
+        flow_indexes = inverse[remaining]
+        is_from_client = src_endpoint_is_lower[remaining] == client_endpoint_is_lower[flow_indexes]
+        remaining_length = payload_length[remaining]
+        sent_packets = np.bincount(flow_indexes[is_from_client], minlength=flows_count)
+        recieved_packets = np.bincount(flow_indexes[~is_from_client], minlength=flows_count)
+        sent_bytes = np.zeros(flows_count, dtype=np.int64)
+        recieved_bytes = np.zeros(flows_count, dtype=np.int64)
+        np.add.at(sent_bytes, flow_indexes[is_from_client], remaining_length[is_from_client])
+        np.add.at(recieved_bytes, flow_indexes[~is_from_client], remaining_length[~is_from_client])
+        # like update_stats, flow last time is the timestamp of the last packet of the flow
+        last_positions = np.full(flows_count, -1)
+        np.maximum.at(last_positions, flow_indexes, positions[:len(flow_indexes)])
+        remaining_timestamps = timestamps[remaining]
+
+        # flows without remaining packets keep -1 and are left as create_flow counted them
+        for flow_index in np.flatnonzero(last_positions >= 0):
+            flow = flows[flow_index]
+            flow.flow_last_time = float(remaining_timestamps[last_positions[flow_index]])
+            flow.sent_packets_count += int(sent_packets[flow_index])
+            flow.recieved_packets_count += int(recieved_packets[flow_index])
+            flow.sent_bytes_count += int(sent_bytes[flow_index])
+            flow.recieved_bytes_count += int(recieved_bytes[flow_index])
+        return None
+
+    def create_flow(self, flow_key, view, block, fields, index, src_endpoint_is_lower):
+        """ Create a flow from its first packet and inspect that packet
+
+        Args:
+            flow_key (bytes): flow key
+            view (memoryview): memoryview of the capture file
+            block (list): list of (timestamp, packet offset, captured length) records
+            fields (dict): fields returned by decode_block
+            index (int): index of the first packet in block
+            src_endpoint_is_lower (bool): direction of the first packet
+
+        Returns:
+            Flow: new flow
+        """
+        timestamp, data_offset, _ = block[index]
+        five_tuple_key = (
+            int(fields['src_ip'][index]).to_bytes(4, 'big'),
+            int(fields['dst_ip'][index]).to_bytes(4, 'big'),
+            bool(fields['is_tcp'][index]),
+            int(fields['src_port'][index]),
+            int(fields['dst_port'][index])
+        )
+        flow = Flow(five_tuple_key, src_endpoint_is_lower)
+        self.flows_dict.add(flow_key, flow)
+        application_data = view[data_offset + int(fields['payload_offset'][index]):
+                                data_offset + int(fields['payload_end'][index])]
+        application_packet = Packet(True, timestamp, application_data, self.get_tcp_sequence(fields, index))
+        flow.update_stats(application_packet)
+        self.my_dpi.inspect_packet(five_tuple_key, flow, application_packet)
+        return flow
+
+    def inspect_next_packet(self, flow, view, block, fields, index, src_endpoint_is_lower):
+        """ Pass a packet of a pending flow to MyDpi, flow counters are updated by process_block
+
+        Args:
+            flow (Flow): flow
+            view (memoryview): memoryview of the capture file
+            block (list): list of (timestamp, packet offset, captured length) records
+            fields (dict): fields returned by decode_block
+            index (int): index of the packet in block
+            src_endpoint_is_lower (bool): direction of the packet
+        """
+        timestamp, data_offset, _ = block[index]
+        application_data = view[data_offset + int(fields['payload_offset'][index]):
+                                data_offset + int(fields['payload_end'][index])]
+        application_packet = Packet(flow.is_packet_from_client(src_endpoint_is_lower), timestamp,
+                                    application_data, self.get_tcp_sequence(fields, index))
+        self.my_dpi.inspect_next_packet(flow, application_packet)
+
+    @staticmethod
+    def get_tcp_sequence(fields, index):
+        """ Get TCP sequence number of a decoded packet
+
+        Args:
+            fields (dict): fields returned by decode_block
+            index (int): index of the packet in block
+
+        Returns:
+            int: sequence number, None for UDP
+        """
+        return int(fields['tcp_sequence'][index]) if fields['is_tcp'][index] else None
@@ -0,0 +1,356 @@
+""" Benchmark of the packet pipeline on a synthetic capture
+
+Measures packets per second and tracemalloc peak memory of Worker.process_packet,
+FiveTuple.get_five_tuple_of_packet, a compiled packet filter, MyDpi.inspect_packet,
+every module callback on its own and flows per second of the SQLite flow store
+inserts, and writes them as JSON with the commit they were measured on.
+Results of two commits are compared with --compare, the exit status is 1 when
+a benchmark is slower than the baseline by more than --tolerance.
+
+Run from the repository root:
+    python -m benchmarks.bench_pipeline --output results.json
+    python -m benchmarks.bench_pipeline --compare results.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import argparse
+import subprocess
+import tracemalloc
+import dpkt
+from my_dpi.my_dpi import MyDpi
+from my_dpi.flow import Flow
+from my_dpi.packet import Packet
+from my_dpi.five_tuple import FiveTuple
+from my_dpi.pcap_reader import PcapReader
+from my_dpi import fast_parser
+from my_dpi.packet_filter import compile_filter
+from my_dpi.flow_store import FlowStore
+from worker import Worker
+from benchmarks.pcap_generator import generate_capture, add_capture_arguments
+
+
+# minimum number of packets passed to a module callback in one run
+MIN_CALLBACK_PACKETS = 20000
+# flows inserted by the flow store benchmark, the flows of the capture are repeated
+MIN_STORED_FLOWS = 200000
+# expression of the packet filter benchmark, every primitive reads a different header field
+FILTER_EXPRESSION = 'udp and port 53 or tcp dst port 443 or net 10.0.0.0/8'
+
+
+def get_commit():
+    """ Get hash of the checked out commit
+
+    Returns:
+        string: commit hash, None outside of a git repository
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(setup, run, packets_count, repeat, unit='packets'):
+    """ Time run on a fresh state and measure its peak memory in a separate run
+
+    Args:
+        setup (function): returns the state passed to run, not timed
+        run (function): benchmarked function
+        packets_count (int): number of packets handled by one run
+        repeat (int): number of timed runs, the fastest one is kept
+        unit (string, optional): what packets_count counts, printed with the throughput. Defaults to 'packets'.
+
+    Returns:
+        dict: packets, seconds, packets_per_second, unit and peak_memory_bytes
+    """
+    seconds = float('inf')
+    for _ in range(repeat):
+        state = setup()
+        start_time = time.perf_counter()
+        run(state)
+        seconds = min(seconds, time.perf_counter() - start_time)
+    # tracemalloc slows allocations down, so memory is measured apart from time
+    state = setup()
+    tracemalloc.start()
+    run(state)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'packets': packets_count,
+        'seconds': seconds,
+        'packets_per_second': packets_count / seconds if seconds else None,
+        'unit': unit,
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def load_capture(path):
+    """ Read every packet of a capture in memory, reading is not part of the benchmarks
+
+    Args:
+        path (string): capture path
+
+    Returns:
+        list: list of (timestamp, packet bytes)
+    """
+    with PcapReader(path) as pcap:
+        return [(timestamp, bytes(buffer)) for timestamp, buffer in pcap]
+
+
+def get_first_packets(packets):
+    """ Get decoded first packet of every flow
+
+    Args:
+        packets (list): list of (timestamp, packet bytes)
+
+    Returns:
+        list: list of (five_tuple_key, timestamp, payload bytes)
+    """
+    first_packets = []
+    flow_keys = set()
+    for timestamp, packet in packets:
+        decoded_packet = fast_parser.decode_packet(packet)
+        if not isinstance(decoded_packet, tuple):
+            continue
+        five_tuple_key = decoded_packet[:5]
+        flow_key, _ = FiveTuple.get_flow_key(*five_tuple_key)
+        if flow_key in flow_keys:
+            continue
+        flow_keys.add(flow_key)
+        first_packets.append((five_tuple_key, timestamp, bytes(decoded_packet[5])))
+    return first_packets
+
+
+def bench_process_packet(packets, repeat):
+    def setup():
+        return Worker(MyDpi())
+
+    def run(dpi_worker):
+        process_packet = dpi_worker.process_packet
+        for timestamp, packet in packets:
+            process_packet(packet, timestamp)
+
+    return measure(setup, run, len(packets), repeat)
+
+
+def bench_get_five_tuple_of_packet(packets, repeat):
+    ip_packets = []
+    for _, packet in packets:
+        ip_packet = dpkt.ethernet.Ethernet(packet).data
+        if isinstance(ip_packet, dpkt.ip.IP) and isinstance(ip_packet.data, (dpkt.tcp.TCP, dpkt.udp.UDP)):
+            ip_packets.append(ip_packet)
+
+    def run(_):
+        get_five_tuple_of_packet = FiveTuple.get_five_tuple_of_packet
+        for ip_packet in ip_packets:
+            get_five_tuple_of_packet(ip_packet)
+
+    return measure(lambda: None, run, len(ip_packets), repeat)
+
+
+def bench_packet_filter(packets, repeat):
+    packet_filter = compile_filter(FILTER_EXPRESSION)
+
+    def run(_):
+        for _, packet in packets:
+            packet_filter(packet)
+
+    return measure(lambda: None, run, len(packets), repeat)
+
+
+def get_new_flows(first_packets):
+    """ Build a new flow and its first application packet for every first packet
+
+    Args:
+        first_packets (list): list returned by get_first_packets
+
+    Returns:
+        list: list of (five_tuple_key, flow, application_packet)
+    """
+    new_flows = []
+    for five_tuple_key, timestamp, payload in first_packets:
+        flow = Flow(five_tuple_key)
+        application_packet = Packet(True, timestamp, payload)
+        flow.update_stats(application_packet)
+        new_flows.append((five_tuple_key, flow, application_packet))
+    return new_flows
+
+
+def bench_inspect_packet(first_packets, repeat):
+    def setup():
+        return MyDpi(), get_new_flows(first_packets)
+
+    def run(state):
+        my_dpi, new_flows = state
+        for five_tuple_key, flow, application_packet in new_flows:
+            my_dpi.inspect_packet(five_tuple_key, flow, application_packet)
+
+    return measure(setup, run, len(first_packets), repeat)
+
+
+def bench_flow_store(first_packets, repeat):
+    """ Benchmark inserts of the flow store, building its indexes included
+
+    Args:
+        first_packets (list): list returned by get_first_packets
+        repeat (int): number of timed runs
+
+    Returns:
+        dict: measure result, its packets are stored flows
+    """
+    flows = [flow for _, flow, _ in get_new_flows(first_packets)]
+    flows = flows * -(-MIN_STORED_FLOWS // len(flows))
+    with tempfile.TemporaryDirectory() as directory:
+        paths = iter(range(repeat + 1))
+
+        def setup():
+            return FlowStore(os.path.join(directory, f'flows_{next(paths)}.db'))
+
+        def run(flow_store):
+            export_flow = flow_store.export_flow
+            for flow in flows:
+                export_flow(flow)
+            flow_store.close()
+
+        return measure(setup, run, len(flows), repeat, unit='flows')
+
+
+def bench_callbacks(first_packets, repeat):
+    """ Benchmark every module callback on the first packets its signature matches
+
+    Args:
+        first_packets (list): list returned by get_first_packets
+        repeat (int): number of timed runs
+
+    Returns:
+        dict: callback name -> measure result
+    """
+    results = {}
+    my_dpi = MyDpi()
+    # signatures call module methods instead of their lazy loaders
+    my_dpi.load_protocol_modules()
+    engines = (
+        (False, my_dpi.udp_first_packet_signatures),
+        (True, my_dpi.tcp_first_packet_signatures),
+    )
+    for is_tcp, engine in engines:
+        for signature in engine.signatures:
+            matched_packets = [first_packet for first_packet in first_packets
+                               if first_packet[0][2] == is_tcp and len(first_packet[2]) >= signature.min_length
+                               and signature.regex.search(first_packet[2])]
+            if not matched_packets:
+                continue
+            # callbacks take microseconds, short lists are repeated to get stable timings
+            matched_packets = matched_packets * -(-MIN_CALLBACK_PACKETS // len(matched_packets))
+
+            def run(new_flows, callback=signature.callback):
+                for _, flow, application_packet in new_flows:
+                    callback(flow, application_packet)
+
+            results[f'callback:{signature.callback.__qualname__}'] = measure(
+                lambda packets=matched_packets: get_new_flows(packets), run, len(matched_packets), repeat)
+    return results
+
+
+def run_benchmarks(capture_path, repeat):
+    """ Run every benchmark on a capture
+
+    Args:
+        capture_path (string): capture path
+        repeat (int): number of timed runs of every benchmark
+
+    Returns:
+        dict: benchmark name -> measure result
+    """
+    packets = load_capture(capture_path)
+    first_packets = get_first_packets(packets)
+    results = {
+        'Worker.process_packet': bench_process_packet(packets, repeat),
+        'FiveTuple.get_five_tuple_of_packet': bench_get_five_tuple_of_packet(packets, repeat),
+        'packet_filter': bench_packet_filter(packets, repeat),
+        'MyDpi.inspect_packet': bench_inspect_packet(first_packets, repeat),
+        'FlowStore.export_flow': bench_flow_store(first_packets, repeat),
+    }
+    results.update(bench_callbacks(first_packets, repeat))
+    return results
+
+
+def compare_results(baseline, results, tolerance):
+    """ Print throughput of results relative to baseline
+
+    Args:
+        baseline (dict): previous results document
+        results (dict): current results document
+        tolerance (float): allowed relative slowdown
+
+    Returns:
+        list: names of the benchmarks slower than tolerance allows
+    """
+    if baseline.get('capture') != results.get('capture'):
+        print('warning: captures of the two results are generated with different options')
+    regressions = []
+    for name, result in results['results'].items():
+        baseline_result = baseline['results'].get(name)
+        if baseline_result is None or not baseline_result['packets_per_second']:
+            continue
+        ratio = result['packets_per_second'] / baseline_result['packets_per_second']
+        marker = ''
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+            marker = '  REGRESSION'
+        print(f'{name}: {ratio:.2f}x of {str(baseline.get("commit"))[:10]}{marker}')
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='benchmark the packet pipeline on a synthetic capture')
+    add_capture_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=3, dest='repeat', metavar='N')
+    parser.add_argument('--output', type=str, default=None, dest='output', metavar='File Path',
+                        help='write results as JSON')
+    parser.add_argument('--compare', type=str, default=None, dest='compare', metavar='File Path',
+                        help='compare with previous JSON results')
+    parser.add_argument('--tolerance', type=float, default=0.1, dest='tolerance',
+                        help='relative slowdown reported as a regression')
+    args = parser.parse_args(arguments)
+
+    capture_options = {
+        'flows': args.flows_count,
+        'packets_per_flow': args.packets_per_flow,
+        'protocol_mix': args.protocol_mix,
+        'tcp_ratio': args.tcp_ratio,
+        'seed': args.seed,
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        capture_path = os.path.join(directory, 'capture.pcap')
+        generate_capture(capture_path, args.flows_count, args.packets_per_flow, args.protocol_mix,
+                         args.tcp_ratio, args.seed)
+        benchmark_results = run_benchmarks(capture_path, args.repeat)
+    results = {
+        'commit': get_commit(),
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'capture': capture_options,
+        'results': benchmark_results,
+    }
+    for name, result in benchmark_results.items():
+        print(f'{name}: {result["packets_per_second"]:,.0f} {result["unit"]}/s, '
+              f'peak memory {result["peak_memory_bytes"] / 1024:,.0f} KiB')
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare_results(baseline, results, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
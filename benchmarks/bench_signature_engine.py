@@ -0,0 +1,103 @@
+""" Benchmark of first packet signature matching
+
+Compares the previous dictionary of raw patterns (re.search on every pattern and every
+callback called) with the precompiled SignatureEngine used by MyDpi.
+
+Run from the repository root:
+    python -m benchmarks.bench_signature_engine
+"""
+import re
+import random
+import timeit
+from my_dpi.my_dpi import MyDpi
+from my_dpi.flow import Flow
+from my_dpi.packet import Packet
+
+
+def get_sample_payloads(count, seed=0):
+    """ Build a deterministic list of UDP and TCP first packet payloads
+
+    Args:
+        count (int): number of payloads
+        seed (int): random seed
+
+    Returns:
+        list: list of (is_tcp, dst_port, payload) tuples
+    """
+    random_generator = random.Random(seed)
+    udp_payloads = [
+        # DNS query
+        (53, b'\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x07example\x03com\x00\x00\x01\x00\x01'),
+        # NTP client request
+        (123, b'\x23' + b'\x00' * 47),
+        # STUN binding request
+        (3478, b'\x00\x01\x00\x00\x21\x12\xa4\x42' + bytes(12)),
+        # QUIC initial
+        (443, b'\xc3\x00\x00\x00\x01\x08' + bytes(1194)),
+    ]
+    tcp_payloads = [
+        (443, b'\x16\x03\x01\x02\x00\x01\x00\x01\xfc\x03\x03' + bytes(64)),
+        (80, b'GET /index.html HTTP/1.1\r\nHost: example.com\r\n\r\n'),
+    ]
+    payloads = []
+    for _ in range(count):
+        if random_generator.random() < 0.3:
+            # unknown traffic tests every candidate signature
+            random_payload = bytes(random_generator.getrandbits(8) for _ in range(64))
+            payloads.append((random_generator.random() < 0.5, random_generator.randrange(1024, 65536), random_payload))
+        elif random_generator.random() < 0.7:
+            payloads.append((False, *random_generator.choice(udp_payloads)))
+        else:
+            payloads.append((True, *random_generator.choice(tcp_payloads)))
+    return payloads
+
+
+def run_legacy(patterns_callback_dicts, payloads):
+    """ Previous matching loop of MyDpi.feed_udp_first_packet and feed_tcp_first_packet
+    """
+    for is_tcp, dst_port, payload in payloads:
+        flow = Flow((b'\x00' * 4, b'\x00' * 4, is_tcp, 50000, dst_port))
+        application_packet = Packet(True, 0, payload)
+        patterns_callback_dict = patterns_callback_dicts[is_tcp]
+        for pattern in patterns_callback_dict:
+            if not re.search(pattern, application_packet.packet_data, re.DOTALL):
+                continue
+            patterns_callback_dict[pattern](flow, application_packet)
+
+
+def run_engine(my_dpi, payloads):
+    """ Current matching through the signature engines of MyDpi
+    """
+    for is_tcp, dst_port, payload in payloads:
+        flow = Flow((b'\x00' * 4, b'\x00' * 4, is_tcp, 50000, dst_port))
+        application_packet = Packet(True, 0, payload)
+        if is_tcp:
+            my_dpi.feed_tcp_first_packet(flow, application_packet)
+        else:
+            my_dpi.feed_udp_first_packet(flow, application_packet)
+
+
+def main(count=100000, repeat=5):
+    my_dpi = MyDpi()
+    patterns_callback_dicts = {
+        False: {signature.pattern: signature.callback
+                for signature in my_dpi.udp_first_packet_signatures.signatures},
+        True: {signature.pattern: signature.callback
+               for signature in my_dpi.tcp_first_packet_signatures.signatures},
+    }
+    payloads = get_sample_payloads(count)
+    legacy_time = min(timeit.repeat(
+        lambda: run_legacy(patterns_callback_dicts, payloads), number=1, repeat=repeat))
+    engine_time = min(timeit.repeat(
+        lambda: run_engine(my_dpi, payloads), number=1, repeat=repeat))
+    print(f'legacy re.search loop: {count / legacy_time:,.0f} first packets/s')
+    print(f'signature engine:      {count / engine_time:,.0f} first packets/s')
+    print(f'speedup: {legacy_time / engine_time:.2f}x')
+    for layer, statistics in my_dpi.get_signature_statistics().items():
+        for signature_statistics in statistics:
+            print(f'{layer} {signature_statistics["callback"]}: tests {signature_statistics["tests"]:,}, '
+                  f'matches {signature_statistics["matches"]:,}, detections {signature_statistics["detections"]:,}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+""" Check that every processing mode labels flows like the default mode
+
+Runs main.py on synthetic captures in the default mode and in the batch,
+sharded, multi file and sampling modes, with and without flow timeouts and
+max flows, exports the flows as CSV and compares them without the flow
+numbers, which depend on the order flows are reported in. Shard processes
+expire their last flows when their shard ends, so the reasons of sharded
+runs are not compared. The exit status is 1 when a mode labels or counts
+flows differently.
+
+Run from the repository root:
+    python -m benchmarks.check_modes
+    python -m benchmarks.check_modes --flows 2000 --packets-per-flow 20
+"""
+import os
+import sys
+import csv
+import tempfile
+import argparse
+import subprocess
+from collections import Counter
+from benchmarks.pcap_generator import generate_capture, add_capture_arguments
+
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+# timeouts shorter than the flows of the synthetic captures, so flows expire while packets are read
+TIMEOUT_OPTIONS = ('--idle-timeout', '0.02', '--active-timeout', '0.05')
+# fewer flows than the synthetic captures have at once, so flows are evicted while packets are read
+MAX_FLOWS_OPTIONS = ('--max-flows', '50')
+# number of capture files of the multi file checks
+CAPTURE_FILES_COUNT = 3
+# number of differing flows printed by a failed check
+PRINTED_DIFFERENCES = 5
+
+
+def run_main(capture_path, options, directory, compare_reasons=True):
+    """ Run main.py and read the flows it exports
+
+    Args:
+        capture_path (string): capture file, directory or glob path
+        options (tuple): main.py options
+        directory (string): directory of the export file
+        compare_reasons (bool, optional): keep the reason column. Defaults to True.
+
+    Raises:
+        RuntimeError: main.py failed
+
+    Returns:
+        Counter: flow rows without the flow number
+    """
+    export_path = os.path.join(directory, 'flows.csv')
+    process = subprocess.run(
+        [sys.executable, MAIN_PATH, '-r', capture_path, '--export-format', 'csv', '--export-file', export_path,
+         *options], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f'main.py {" ".join(options)} failed:\n{process.stderr}')
+    with open(export_path, newline='') as export_file:
+        rows = list(csv.reader(export_file))[1:]
+    os.remove(export_path)
+    last_column = None if compare_reasons else -1
+    return Counter(tuple(row[1:last_column]) for row in rows)
+
+
+def compare_flows(name, expected_flows, flows):
+    """ Print the result of a check
+
+    Args:
+        name (string): check name
+        expected_flows (Counter): flows of the default mode
+        flows (Counter): flows of the checked mode
+
+    Returns:
+        bool: True if both modes report the same flows
+    """
+    missing_flows = expected_flows - flows
+    unexpected_flows = flows - expected_flows
+    if not missing_flows and not unexpected_flows:
+        print(f'{name}: ok, {sum(flows.values())} flows')
+        return True
+    print(f'{name}: {sum(missing_flows.values())} flows missing, {sum(unexpected_flows.values())} unexpected flows')
+    for prefix, different_flows in (('-', missing_flows), ('+', unexpected_flows)):
+        for row in list(different_flows)[:PRINTED_DIFFERENCES]:
+            print(f'  {prefix} {",".join(row)}')
+    return False
+
+
+def run_checks(directory, flows_count, packets_per_flow, protocol_mix, tcp_ratio, seed):
+    """ Generate the captures and compare every mode with the default mode
+
+    Args:
+        directory (string): directory of the captures and export files
+        flows_count (int): flows of every capture
+        packets_per_flow (int): packets of every flow
+        protocol_mix (dict): protocol name -> weight
+        tcp_ratio (float): ratio of TCP flows
+        seed (int): random seed
+
+    Returns:
+        list: names of the failed checks
+    """
+    capture_path = os.path.join(directory, 'capture.pcap')
+    generate_capture(capture_path, flows_count, packets_per_flow, protocol_mix, tcp_ratio, seed)
+    # blocks of first packets only, the batch worker has no later packets to reduce
+    first_packets_path = os.path.join(directory, 'first_packets.pcap')
+    generate_capture(first_packets_path, flows_count, 1, protocol_mix, tcp_ratio, seed)
+    captures_directory = os.path.join(directory, 'captures')
+    os.mkdir(captures_directory)
+    for file_index in range(CAPTURE_FILES_COUNT):
+        generate_capture(os.path.join(captures_directory, f'capture_{file_index}.pcap'), flows_count,
+                         packets_per_flow, protocol_mix, tcp_ratio, seed + file_index)
+
+    failed_checks = []
+
+    def check(name, path, options, expected_flows, compare_reasons=True):
+        flows = run_main(path, options, directory, compare_reasons)
+        if not compare_flows(name, expected_flows, flows):
+            failed_checks.append(name)
+
+    for path in (capture_path, first_packets_path):
+        capture_name = os.path.basename(path)
+        expected_flows = run_main(path, (), directory)
+        for batch_size in ('1', '3', '7', '65536'):
+            check(f'{capture_name} --batch --batch-size {batch_size}', path, ('--batch', '--batch-size', batch_size),
+                  expected_flows)
+        for sample_mode in ('flow', 'first-packet'):
+            check(f'{capture_name} --sample-rate 1.0 --sample-mode {sample_mode}', path,
+                  ('--sample-rate', '1.0', '--sample-mode', sample_mode), expected_flows)
+        # flows leave the table at the same packets in batch mode
+        for table_options in (TIMEOUT_OPTIONS, MAX_FLOWS_OPTIONS, TIMEOUT_OPTIONS + MAX_FLOWS_OPTIONS):
+            expected_flows = run_main(path, table_options, directory)
+            for batch_size in ('7', '64', '65536'):
+                check(f'{capture_name} --batch --batch-size {batch_size} {" ".join(table_options)}', path,
+                      ('--batch', '--batch-size', batch_size, *table_options), expected_flows)
+        expected_flows = run_main(path, (), directory, False)
+        check(f'{capture_name} --workers 2', path, ('--workers', '2'), expected_flows, False)
+        expected_flows = run_main(path, TIMEOUT_OPTIONS, directory, False)
+        check(f'{capture_name} --workers 2 {" ".join(TIMEOUT_OPTIONS)}', path, ('--workers', '2', *TIMEOUT_OPTIONS),
+              expected_flows, False)
+
+    # files of a directory are read by one process each, the default mode reads them one by one
+    expected_flows = Counter()
+    timeout_expected_flows = Counter()
+    for file_name in sorted(os.listdir(captures_directory)):
+        expected_flows += run_main(os.path.join(captures_directory, file_name), (), directory)
+        timeout_expected_flows += run_main(os.path.join(captures_directory, file_name), TIMEOUT_OPTIONS, directory)
+    check('captures --workers 2', captures_directory, ('--workers', '2'), expected_flows)
+    check('captures --batch --batch-size 3', captures_directory, ('--batch', '--batch-size', '3'), expected_flows)
+    check(f'captures --workers 2 {" ".join(TIMEOUT_OPTIONS)}', captures_directory, ('--workers', '2', *TIMEOUT_OPTIONS),
+          timeout_expected_flows)
+    return failed_checks
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='compare the flows of every processing mode with the default mode')
+    add_capture_arguments(parser)
+    parser.set_defaults(flows_count=500)
+    args = parser.parse_args(arguments)
+
+    with tempfile.TemporaryDirectory() as directory:
+        failed_checks = run_checks(directory, args.flows_count, args.packets_per_flow, args.protocol_mix,
+                                   args.tcp_ratio, args.seed)
+    if failed_checks:
+        print(f'{len(failed_checks)} checks failed')
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+""" Deterministic synthetic pcap captures for benchmarks
+
+Every flow is an Ethernet/IPv4 TCP or UDP conversation whose first payload
+matches one of the DPI modules (or random bytes for unknown traffic), followed
+by packets of random bytes in both directions. The same arguments and seed
+always write the same file, so results of different commits are comparable.
+
+Run from the repository root:
+    python -m benchmarks.pcap_generator capture.pcap --flows 1000 --packets-per-flow 10
+"""
+import heapq
+import random
+import struct
+import argparse
+
+
+# quic_draft is an Initial packet of QUIC draft 29, which waits for the server version negotiation
+UDP_PROTOCOLS = ('dns', 'ntp', 'stun', 'quic', 'quic_draft')
+TCP_PROTOCOLS = ('tls', 'http')
+DEFAULT_MIX = {'dns': 4, 'quic': 4, 'quic_draft': 1, 'ntp': 1, 'stun': 1, 'tls': 4, 'http': 2, 'unknown': 1}
+
+# server port of every protocol
+SERVER_PORTS = {'dns': 53, 'ntp': 123, 'stun': 3478, 'quic': 443, 'quic_draft': 443, 'tls': 443, 'http': 80}
+
+PCAP_GLOBAL_HEADER = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+_pack_record_header = struct.Struct('<IIII').pack
+_pack_ipv4 = struct.Struct('!BBHHHBBH4s4s').pack
+_pack_tcp = struct.Struct('!HHIIBBHHH').pack
+_pack_udp = struct.Struct('!HHHH').pack
+ETHERNET_HEADER = b'\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xaa\xbb\x08\x00'
+
+
+def get_first_payload(protocol, random_generator):
+    """ Build a client first payload matched by the module of protocol
+
+    Args:
+        protocol (string): protocol name, 'unknown' for random bytes
+        random_generator (random.Random): random generator
+
+    Returns:
+        bytes: payload
+    """
+    if protocol == 'dns':
+        return (random_generator.randbytes(2) + b'\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00' +
+                b'\x07example\x03com\x00\x00\x01\x00\x01')
+    if protocol == 'ntp':
+        return b'\x23' + bytes(39) + random_generator.randbytes(8)
+    if protocol == 'stun':
+        return b'\x00\x01\x00\x00\x21\x12\xa4\x42' + random_generator.randbytes(12)
+    if protocol == 'quic':
+        return b'\xc3\x00\x00\x00\x01\x08' + random_generator.randbytes(8) + b'\x00' + bytes(1185)
+    if protocol == 'quic_draft':
+        return b'\xc3\xff\x00\x00\x1d\x08' + random_generator.randbytes(8) + b'\x00' + bytes(1185)
+    if protocol == 'tls':
+        client_hello = b'\x03\x03' + random_generator.randbytes(32) + b'\x00\x00\x02\x13\x01\x01\x00\x00\x00'
+        handshake = b'\x01' + len(client_hello).to_bytes(3, 'big') + client_hello
+        return b'\x16\x03\x01' + len(handshake).to_bytes(2, 'big') + handshake
+    if protocol == 'http':
+        return b'GET /index.html HTTP/1.1\r\nHost: example.com\r\nUser-Agent: bench\r\n\r\n'
+    return random_generator.randbytes(random_generator.randrange(16, 512))
+
+
+def build_packet(src_ip, dst_ip, is_tcp, src_port, dst_port, tcp_sequence, payload):
+    """ Build an Ethernet/IPv4/TCP or UDP packet
+
+    Args:
+        src_ip (bytes): source address
+        dst_ip (bytes): destination address
+        is_tcp (bool): True for TCP, False for UDP
+        src_port (int): source port
+        dst_port (int): destination port
+        tcp_sequence (int): TCP sequence number
+        payload (bytes): application layer payload
+
+    Returns:
+        bytes: packet bytes
+    """
+    if is_tcp:
+        # ACK and PSH flags, checksums are not verified by the DPI
+        layer4 = _pack_tcp(src_port, dst_port, tcp_sequence & 0xffffffff, 0, 5 << 4, 0x18, 65535, 0, 0)
+    else:
+        layer4 = _pack_udp(src_port, dst_port, 8 + len(payload), 0)
+    total_length = 20 + len(layer4) + len(payload)
+    ip_header = _pack_ipv4(0x45, 0, total_length, 0, 0, 64, 6 if is_tcp else 17, 0, src_ip, dst_ip)
+    return ETHERNET_HEADER + ip_header + layer4 + payload
+
+
+def iter_flow_packets(flow_index, start_time, packets_per_flow, packet_interval, protocol_mix, tcp_ratio, seed):
+    """ Generate timestamped packets of one flow
+
+    Args:
+        flow_index (int): index of the flow, used for addresses and the random seed
+        start_time (float): timestamp of the first packet
+        packets_per_flow (int): number of packets
+        packet_interval (float): seconds between two packets of the flow
+        protocol_mix (dict): protocol name -> weight
+        tcp_ratio (float): ratio of TCP flows
+        seed (int): random seed
+
+    Yields:
+        tuple: (timestamp, flow_index, packet bytes)
+    """
+    random_generator = random.Random(seed * 1000003 + flow_index)
+    is_tcp = random_generator.random() < tcp_ratio
+    layer_protocols = [protocol for protocol in (TCP_PROTOCOLS if is_tcp else UDP_PROTOCOLS) + ('unknown',)
+                       if protocol_mix.get(protocol)]
+    if not layer_protocols:
+        layer_protocols = ['unknown']
+    protocol = random_generator.choices(layer_protocols, [protocol_mix.get(name, 1) for name in layer_protocols])[0]
+    client_ip = bytes((10, (flow_index >> 16) & 0xff, (flow_index >> 8) & 0xff, flow_index & 0xff))
+    server_ip = bytes((172, 16, random_generator.randrange(256), random_generator.randrange(1, 255)))
+    client_port = random_generator.randrange(1024, 65536)
+    server_port = SERVER_PORTS.get(protocol, random_generator.randrange(1024, 65536))
+    sequences = [random_generator.getrandbits(32), random_generator.getrandbits(32)]
+    for packet_index in range(packets_per_flow):
+        if packet_index == 0:
+            from_client = True
+            payload = get_first_payload(protocol, random_generator)
+        else:
+            from_client = packet_index % 2 == 0
+            payload = random_generator.randbytes(random_generator.randrange(32, 1400))
+        direction = 0 if from_client else 1
+        if from_client:
+            packet = build_packet(client_ip, server_ip, is_tcp, client_port, server_port, sequences[0], payload)
+        else:
+            packet = build_packet(server_ip, client_ip, is_tcp, server_port, client_port, sequences[1], payload)
+        sequences[direction] += len(payload)
+        yield start_time + packet_index * packet_interval, flow_index, packet
+
+
+def generate_capture(path, flows_count=1000, packets_per_flow=10, protocol_mix=None, tcp_ratio=0.5,
+                     seed=0, flow_interval=0.001, packet_interval=0.01):
+    """ Write a synthetic pcap capture
+
+    Args:
+        path (string): output file path
+        flows_count (int, optional): number of flows. Defaults to 1000.
+        packets_per_flow (int, optional): packets of every flow. Defaults to 10.
+        protocol_mix (dict, optional): protocol name -> weight, 'unknown' for random payloads. Defaults to DEFAULT_MIX.
+        tcp_ratio (float, optional): ratio of TCP flows. Defaults to 0.5.
+        seed (int, optional): random seed. Defaults to 0.
+        flow_interval (float, optional): seconds between the starts of two flows. Defaults to 0.001.
+        packet_interval (float, optional): seconds between two packets of a flow. Defaults to 0.01.
+
+    Returns:
+        int: number of packets written
+    """
+    if protocol_mix is None:
+        protocol_mix = DEFAULT_MIX
+    start_time = 1600000000.0
+    # flows overlap, packets are written in timestamp order
+    flows_packets = [
+        iter_flow_packets(flow_index, start_time + flow_index * flow_interval, packets_per_flow,
+                          packet_interval, protocol_mix, tcp_ratio, seed)
+        for flow_index in range(flows_count)
+    ]
+    packets_count = 0
+    with open(path, 'wb') as capture:
+        capture.write(PCAP_GLOBAL_HEADER)
+        for timestamp, _, packet in heapq.merge(*flows_packets):
+            seconds = int(timestamp)
+            microseconds = int(round((timestamp - seconds) * 1e6))
+            if microseconds == 1000000:
+                seconds, microseconds = seconds + 1, 0
+            capture.write(_pack_record_header(seconds, microseconds, len(packet), len(packet)))
+            capture.write(packet)
+            packets_count += 1
+    return packets_count
+
+
+def parse_protocol_mix(text):
+    """ Parse a protocol mix like dns=4,quic=4,tls=2
+
+    Args:
+        text (string): comma separated name=weight pairs
+
+    Returns:
+        dict: protocol name -> weight
+    """
+    protocol_mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in SERVER_PORTS and name != 'unknown':
+            raise argparse.ArgumentTypeError(f'unknown protocol {name}')
+        protocol_mix[name] = float(weight) if weight else 1.0
+    return protocol_mix
+
+
+def add_capture_arguments(parser):
+    """ Add synthetic capture options to an argument parser
+
+    Args:
+        parser (argparse.ArgumentParser): parser
+    """
+    parser.add_argument('--flows', type=int, default=1000, dest='flows_count', metavar='N')
+    parser.add_argument('--packets-per-flow', type=int, default=10, dest='packets_per_flow', metavar='N')
+    parser.add_argument('--mix', type=parse_protocol_mix, default=DEFAULT_MIX, dest='protocol_mix',
+                        help='protocol weights, like dns=4,quic=4,quic_draft=1,tls=4,http=2,ntp=1,stun=1,unknown=1')
+    parser.add_argument('--tcp-ratio', type=float, default=0.5, dest='tcp_ratio')
+    parser.add_argument('--seed', type=int, default=0, dest='seed')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='write a deterministic synthetic pcap capture')
+    parser.add_argument('path', help='output pcap file')
+    add_capture_arguments(parser)
+    args = parser.parse_args()
+    packets_count = generate_capture(
+        args.path, args.flows_count, args.packets_per_flow, args.protocol_mix, args.tcp_ratio, args.seed)
+    print(f'{packets_count} packets written to {args.path}')
@@ -1,6 +1,19 @@
 import os
 import sys
+import stat
+import glob
+import datetime
+import functools
 from my_dpi.my_dpi import MyDpi
+from my_dpi.flow_table import FlowTable
+from my_dpi.metrics import Metrics
+from my_dpi.export import EXPORTERS, EXPORT_FORMATS, get_exporter
+from my_dpi.plugin_registry import get_plugins
+from my_dpi.sampling import Sampler
+from my_dpi.packet_filter import compile_filter
+from my_dpi.aggregates import Aggregates
+from my_dpi.tracing import FlowTracer
+from my_dpi.flow_index import FlowIndex, FlowIndexReader
 from worker import Worker
 import argparse
 
@@ -20,15 +33,500 @@ def get_arguments(args):
         description="DPI is a program that can be used to analyze packet streams.\n\r"
         "use -h or --help to see the help", formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument(
-        '-r', '--read', type=str, required=True, help='read a pcap file', dest='read_file', metavar='File Path')
-    args = parser.parse_args()
-    args.read_file = os.path.join('packets', args.read_file)
+        '-r', '--read', type=str, required=True,
+        help='read a pcap or pcapng file, a directory or a glob of captures, - reads a stream from stdin',
+        dest='read_file', metavar='File Path')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='number of processes, packets are sharded by flow\n'
+        'several capture files are processed one file per process, by every CPU unless N is given',
+        dest='workers', metavar='N')
+    parser.add_argument(
+        '--idle-timeout', type=float, default=None, help='expire flows without packets for this many seconds',
+        dest='idle_timeout', metavar='Seconds')
+    parser.add_argument(
+        '--active-timeout', type=float, default=None, help='expire flows older than this many seconds',
+        dest='active_timeout', metavar='Seconds')
+    parser.add_argument(
+        '--max-flows', type=int, default=None, help='maximum number of flows, least recently seen flows are evicted',
+        dest='max_flows', metavar='N')
+    parser.add_argument(
+        '--batch', action='store_true', help='decode packets in NumPy blocks, only first packets are inspected in Python',
+        dest='batch')
+    parser.add_argument(
+        '--batch-size', type=int, default=65536, help='number of packets in a NumPy block',
+        dest='batch_size', metavar='N')
+    parser.add_argument(
+        '--follow', action='store_true', help='keep reading a growing file, like tail -f', dest='follow')
+    parser.add_argument(
+        '--report-interval', type=float, default=10.0, help='seconds between interim reports of a stream',
+        dest='report_interval', metavar='Seconds')
+    parser.add_argument(
+        '--reassembly-bytes', type=int, default=4096,
+        help='reassemble this many first bytes of TCP flows not classified by their first segment, 0 disables it',
+        dest='reassembly_bytes', metavar='N')
+    parser.add_argument(
+        '--reassembly-memory', type=int, default=64, help='maximum MiB buffered by TCP reassembly of every flow',
+        dest='reassembly_memory', metavar='MiB')
+    parser.add_argument(
+        '--signature-stats', action='store_true', help='print tests, matches and detections of every signature',
+        dest='signature_stats')
+    parser.add_argument(
+        '--metrics', type=str, default=None,
+        help='write runtime metrics to PREFIX.json and PREFIX.prom (Prometheus text format)',
+        dest='metrics', metavar='PREFIX')
+    parser.add_argument(
+        '--metrics-interval', type=float, default=10.0, help='seconds between two metrics exports',
+        dest='metrics_interval', metavar='Seconds')
+    parser.add_argument(
+        '--metrics-sample', type=int, default=64, help='time the stages of one packet out of N',
+        dest='metrics_sample', metavar='N')
+    parser.add_argument(
+        '--export-format', type=str, default='text', choices=EXPORT_FORMATS,
+        help='format of flow records: text (terminal report), jsonl, csv, binary\n'
+        'or sqlite (database of --export-file that "main.py query" reads)', dest='export_format')
+    parser.add_argument(
+        '--export-file', type=str, default='-', help='write flow records to a file, - for the standard output',
+        dest='export_file', metavar='File Path')
+    parser.add_argument(
+        '--iso-timestamps', action='store_true', help='write ISO 8601 times instead of epoch seconds',
+        dest='iso_timestamps')
+    parser.add_argument(
+        '--raw-addresses', action='store_true', help='write addresses as hex of their bytes',
+        dest='raw_addresses')
+    parser.add_argument(
+        '--checkpoint-in', type=str, default=None,
+        help='continue the flows of a checkpoint written by --checkpoint-out for the previous capture file',
+        dest='checkpoint_in', metavar='File Path')
+    parser.add_argument(
+        '--checkpoint-out', type=str, default=None,
+        help='write flows left at the end of the capture to a checkpoint instead of reporting them',
+        dest='checkpoint_out', metavar='File Path')
+    parser.add_argument(
+        '--endpoint-cache', type=int, default=0,
+        help='label new flows to servers classified before without inspection, N servers are kept (0 disables it); '
+             'labelled flows have no TLS/QUIC server name and ALPN',
+        dest='endpoint_cache', metavar='N')
+    parser.add_argument(
+        '--endpoint-cache-ttl', type=float, default=300.0, help='seconds a server label is kept after it is seen',
+        dest='endpoint_cache_ttl', metavar='Seconds')
+    parser.add_argument(
+        '--endpoint-cache-confidence', type=int, default=3,
+        help='consistent classifications before a server label is used', dest='endpoint_cache_confidence',
+        metavar='N')
+    parser.add_argument(
+        '--endpoint-cache-verify', type=int, default=0,
+        help='inspect one flow out of N labelled by the endpoint cache (0 never does)',
+        dest='endpoint_cache_verify', metavar='N')
+    parser.add_argument(
+        '--protocols', type=str, default=None,
+        help='comma separated protocol modules to use, like dns,tls,quic (default: every module)',
+        dest='protocols', metavar='Names')
+    parser.add_argument(
+        '--plugin-entry-points', action='store_true',
+        help="also use protocol modules of installed packages ('my_dpi.protocols' entry points)",
+        dest='plugin_entry_points')
+    parser.add_argument(
+        '--sample-rate', type=float, default=None,
+        help='inspect this fraction of flows (or of later packets, see --sample-mode), counters are scaled up\n'
+        'and the report gives estimates of every protocol with 95%% confidence bounds',
+        dest='sample_rate', metavar='Rate')
+    parser.add_argument(
+        '--sample-mode', type=str, default=Sampler.FLOW, choices=Sampler.MODES,
+        help='flow: keep every packet of sampled flows, first-packet: inspect the first packet of every flow\n'
+        'and sample later packets', dest='sample_mode')
+    parser.add_argument(
+        '--sample-target-lag', type=float, default=None,
+        help='lower the sampling rate while processing lags the capture by more than this many seconds',
+        dest='sample_target_lag', metavar='Seconds')
+    parser.add_argument(
+        '--sample-min-rate', type=float, default=0.01, help='lowest rate used by --sample-target-lag',
+        dest='sample_min_rate', metavar='Rate')
+    parser.add_argument(
+        '--filter', type=str, default=None,
+        help='only process packets that match a pcap-filter like expression, checked before packets are decoded\n'
+        'like "udp and port 53 or net 10.0.0.0/8" (ip, ip6, tcp, udp, vlan, host, net, port, portrange)',
+        dest='packet_filter', metavar='Expression')
+    parser.add_argument(
+        '--top', type=int, default=None,
+        help='report bytes of every protocol and the N top talkers, server ports and conversations,\n'
+        'counted in fixed memory from the flows that leave the flow table', dest='top', metavar='N')
+    parser.add_argument(
+        '--top-capacity', type=int, default=1024,
+        help='counters kept for the top talkers, server ports and conversations, counts are over by at most\n'
+        'total bytes / N', dest='top_capacity', metavar='N')
+    parser.add_argument(
+        '--sketch-width', type=int, default=2048, help='counters of every Count-Min sketch row',
+        dest='sketch_width', metavar='N')
+    parser.add_argument(
+        '--sketch-depth', type=int, default=4, help='rows of every Count-Min sketch', dest='sketch_depth', metavar='N')
+    parser.add_argument(
+        '--aggregates-in', type=str, default=None,
+        help='add aggregates written by --aggregates-out of previous runs', dest='aggregates_in', metavar='File Path')
+    parser.add_argument(
+        '--aggregates-out', type=str, default=None, help='write aggregates to a JSON file that later runs can add',
+        dest='aggregates_out', metavar='File Path')
+    parser.add_argument(
+        '--trace', type=str, action='append', default=None,
+        help='write decoding and inspection of every packet of matching flows to the trace file, repeatable:\n'
+        'address, network (10.0.0.0/8), endpoint (10.0.0.1:53, [2001:db8::1]:443) or "udp 10.0.0.1:5353 10.0.0.2:53"',
+        dest='trace', metavar='Target')
+    parser.add_argument(
+        '--trace-file', type=str, default='-', help='trace file path, - for the standard error',
+        dest='trace_file', metavar='File Path')
+    parser.add_argument(
+        '--index-out', type=str, default=None,
+        help='write the record offsets of every flow to a flow index that "main.py extract" reads',
+        dest='index_out', metavar='File Path')
+    args = parser.parse_args(args)
+    if args.workers < 1:
+        parser.error('number of workers must be at least 1')
+    args.read_files = None
+    if args.read_file != '-':
+        args.read_file = os.path.abspath(os.path.join('packets', args.read_file))
+        args.read_files = get_capture_files(args.read_file)
+        if not args.read_files:
+            parser.error(f'no capture file matches {args.read_file}')
+        if len(args.read_files) > 1 and (args.follow or args.metrics or args.checkpoint_in or args.checkpoint_out):
+            parser.error('--follow, --metrics and checkpoints can not be used with several capture files')
+    if args.batch and args.workers > 1 and not (args.read_files and len(args.read_files) > 1):
+        parser.error('--batch can not be used with more than one worker')
+    # stdin, FIFOs and followed files are streams that can not be mapped in memory
+    args.stream = (args.read_file == '-' or args.follow or
+                   (os.path.exists(args.read_file) and stat.S_ISFIFO(os.stat(args.read_file).st_mode)))
+    if args.stream and (args.batch or args.workers > 1):
+        parser.error('streams can not be used with --batch or more than one worker')
+    if args.metrics and (args.batch or args.workers > 1):
+        parser.error('--metrics can not be used with --batch or more than one worker')
+    if args.metrics_sample < 1:
+        parser.error('--metrics-sample must be at least 1')
+    if args.index_out and (args.stream or args.batch or args.workers > 1 or len(args.read_files) > 1):
+        parser.error('--index-out can only be used with one capture file that is not a stream (stdin, a FIFO or '
+                     '--follow), without --batch or more than one worker')
+    if args.export_format == 'sqlite' and args.export_file == '-':
+        parser.error('--export-format sqlite needs a database path in --export-file')
+    args.sampling = args.sample_rate is not None or args.sample_target_lag is not None
+    if args.sampling:
+        if args.sample_rate is None:
+            args.sample_rate = 1.0
+        if not 0 < args.sample_min_rate <= args.sample_rate <= 1:
+            parser.error('sampling rates must be in (0, 1] and --sample-min-rate must not be above --sample-rate')
+        # sampled counters are estimates, they are not merged with exact counters of other processes or runs
+        if (args.batch or args.workers > 1 or args.metrics or args.checkpoint_in or args.checkpoint_out or
+                (args.read_files and len(args.read_files) > 1)):
+            parser.error('sampling can not be used with --batch, more than one worker or capture file, '
+                         '--metrics or checkpoints')
+    args.aggregating = args.top is not None or args.aggregates_in is not None or args.aggregates_out is not None
+    if args.aggregating:
+        if args.top is None:
+            args.top = 10
+        if args.top < 1 or args.top > args.top_capacity or args.sketch_width < 1 or args.sketch_depth < 1:
+            parser.error('--top must be between 1 and --top-capacity, sketch sizes must be at least 1')
+    if args.trace:
+        if (args.batch or args.workers > 1 or args.metrics or args.sampling or
+                (args.read_files and len(args.read_files) > 1)):
+            parser.error('--trace can not be used with --batch, more than one worker or capture file, '
+                         '--metrics or sampling')
+        try:
+            for target in args.trace:
+                FlowTracer.parse_target(target)
+        except ValueError as error:
+            parser.error(str(error))
+    if args.packet_filter is not None:
+        try:
+            compile_filter(args.packet_filter)
+        except ValueError as error:
+            parser.error(str(error))
+    if args.protocols is not None:
+        args.protocols = [name.strip() for name in args.protocols.split(',') if name.strip()]
+        try:
+            get_plugins(args.protocols, args.plugin_entry_points)
+        except ValueError as error:
+            parser.error(str(error))
+    return args
+
+
+def get_capture_files(path):
+    """ Get capture files of a file, directory or glob path
+
+    Args:
+        path (string): file, directory or glob path
+
+    Returns:
+        list: sorted capture file paths, [path] if path is neither a directory nor a glob
+    """
+    if os.path.isdir(path):
+        return sorted(entry.path for entry in os.scandir(path) if entry.is_file())
+    if glob.escape(path) != path:
+        return sorted(file_path for file_path in glob.glob(path) if os.path.isfile(file_path))
+    return [path]
+
+
+def parse_time(value):
+    """ Parse epoch seconds or an ISO 8601 local time
+
+    Args:
+        value (string): time
+
+    Raises:
+        argparse.ArgumentTypeError: value is not a time
+
+    Returns:
+        float: epoch seconds
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid time {value!r}, epoch seconds or ISO 8601 expected') from None
+
+
+def get_query_arguments(args):
+    """ Get arguments of the query subcommand
+
+    Args:
+        args (list): arguments after query
+
+    Returns:
+        argparse.Namespace: arguments
+    """
+    # Expect somthing like this: python3 main.py query flows.db --protocol QUIC --dst 10.0.0.1
+    parser = argparse.ArgumentParser(
+        prog='main.py query', description='write flows of a database written by --export-format sqlite',
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('database', type=str, help='database path', metavar='File Path')
+    parser.add_argument('--protocol', type=str, default=None, help='protocol label, like QUIC', dest='protocol')
+    parser.add_argument(
+        '--host', type=str, default=None, help='address or network of either endpoint', dest='host',
+        metavar='Address')
+    parser.add_argument(
+        '--src', type=str, default=None, help='address or network of the client', dest='src', metavar='Address')
+    parser.add_argument(
+        '--dst', type=str, default=None, help='address or network of the server', dest='dst', metavar='Address')
+    parser.add_argument('--port', type=int, default=None, help='port of either endpoint', dest='port')
+    parser.add_argument(
+        '--server-name', type=str, default=None, help='TLS or QUIC server name', dest='server_name')
+    parser.add_argument(
+        '--since', type=parse_time, default=None,
+        help='flows that started at or after this time, epoch seconds or ISO 8601 local time', dest='since',
+        metavar='Time')
+    parser.add_argument(
+        '--until', type=parse_time, default=None,
+        help='flows that started at or before this time, epoch seconds or ISO 8601 local time', dest='until',
+        metavar='Time')
+    parser.add_argument('--limit', type=int, default=None, help='write at most N flows', dest='limit', metavar='N')
+    parser.add_argument(
+        '--export-format', type=str, default='text', choices=sorted(EXPORTERS),
+        help='format of flow records', dest='export_format')
+    parser.add_argument(
+        '--iso-timestamps', action='store_true', help='write ISO 8601 times instead of epoch seconds',
+        dest='iso_timestamps')
+    parser.add_argument(
+        '--raw-addresses', action='store_true', help='write addresses as hex of their bytes',
+        dest='raw_addresses')
+    args = parser.parse_args(args)
+    from my_dpi.flow_store import get_address_range
+    # connecting to a missing database would create an empty one
+    if not os.path.isfile(args.database):
+        parser.error(f'no database {args.database}')
+    try:
+        for network in (args.host, args.src, args.dst):
+            if network is not None:
+                get_address_range(network)
+    except ValueError as error:
+        parser.error(str(error))
+    return args
+
+
+def query_flows(args):
+    """ Write flows of a database that match the query arguments
+
+    Args:
+        args (argparse.Namespace): arguments of get_query_arguments
+    """
+    from my_dpi.flow_store import FlowStore
+    flow_store = FlowStore(args.database, read_only=True)
+    flows = flow_store.query(
+        protocol=args.protocol, host=args.host, src=args.src, dst=args.dst, port=args.port,
+        server_name=args.server_name, start_time=args.since, end_time=args.until, limit=args.limit)
+    flow_store.close()
+    exporter = get_exporter(
+        args.export_format, format_addresses=not args.raw_addresses, format_timestamps=args.iso_timestamps)
+    for flow, reason in flows:
+        exporter.export_flow(flow, reason)
+    exporter.close()
+
+
+def get_extract_arguments(args):
+    """ Get arguments of the extract subcommand
+
+    Args:
+        args (list): arguments after extract
+
+    Returns:
+        argparse.Namespace: arguments, flow_keys holds the canonical keys of the flows
+    """
+    # Expect somthing like this: python3 main.py extract flows.idx --flow "udp 10.0.0.1:5353 10.0.0.2:53" -w flow.pcap
+    parser = argparse.ArgumentParser(
+        prog='main.py extract', description='write packets of some flows to a new capture with a flow index '
+        'written by --index-out', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('index', type=str, help='flow index path', metavar='File Path')
+    parser.add_argument(
+        '--flow', type=str, action='append', required=True,
+        help='5-tuple of a flow in either direction, like "udp 10.0.0.1:5353 10.0.0.2:53", repeatable',
+        dest='flows', metavar='5-tuple')
+    parser.add_argument(
+        '-w', '--write', type=str, required=True, help='capture file that is written', dest='write_file',
+        metavar='File Path')
+    parser.add_argument(
+        '--capture', type=str, default=None, help='indexed capture, when it is not at its indexed path anymore',
+        dest='capture', metavar='File Path')
+    args = parser.parse_args(args)
+    args.flow_keys = []
+    for flow in args.flows:
+        try:
+            kind, flow_key = FlowTracer.parse_target(flow)
+        except ValueError as error:
+            parser.error(str(error))
+        if kind != 'flow':
+            parser.error(f'invalid flow {flow!r}, "udp ADDRESS:PORT ADDRESS:PORT" or tcp expected')
+        args.flow_keys.append(flow_key)
     return args
 
 
+def extract_flows(args):
+    """ Write packets of the flows of the extract arguments to a new capture
+
+    Args:
+        args (argparse.Namespace): arguments of get_extract_arguments
+    """
+    try:
+        with FlowIndexReader(args.index) as flow_index:
+            records_count, missing_flow_keys = flow_index.extract(args.flow_keys, args.write_file, args.capture)
+    except (OSError, ValueError) as error:
+        sys.exit(f'main.py extract: error: {error}')
+    for flow, flow_key in zip(args.flows, args.flow_keys):
+        if flow_key in missing_flow_keys:
+            print(f'flow {flow!r} is not in the index', file=sys.stderr)
+    print(f'{records_count} packets written to {args.write_file}')
+
+
+def print_signature_statistics(my_dpi):
+    """ Print tests, matches and detections of every signature
+
+    Args:
+        my_dpi (MyDpi): DPI instance
+    """
+    for payload_type, signatures_statistics in my_dpi.get_signature_statistics().items():
+        for statistics in signatures_statistics:
+            print(f'{payload_type}: {statistics["callback"]}: tests: {statistics["tests"]}, '
+                  f'matches: {statistics["matches"]}, detections: {statistics["detections"]}')
+    if my_dpi.endpoint_cache is not None:
+        print('endpoint cache: ' + ', '.join(
+            f'{name}: {value}' for name, value in my_dpi.endpoint_cache.get_statistics().items()))
+
+
 if __name__ == "__main__":
-    my_dpi = MyDpi()
-    dpi_worker = Worker(my_dpi)
+    # main.py query reads flows stored by --export-format sqlite
+    if sys.argv[1:2] == ['query']:
+        query_flows(get_query_arguments(sys.argv[2:]))
+        sys.exit()
+    # main.py extract copies packets of flows indexed by --index-out
+    if sys.argv[1:2] == ['extract']:
+        extract_flows(get_extract_arguments(sys.argv[2:]))
+        sys.exit()
     args = get_arguments(sys.argv[1:])
-    dpi_worker.executor(os.path.abspath(args.read_file))
-    dpi_worker.print_conversation()
+    # flows are exported as soon as they leave the flow table
+    exporter = get_exporter(
+        args.export_format, args.export_file,
+        format_addresses=not args.raw_addresses, format_timestamps=args.iso_timestamps)
+    flow_table_factory = functools.partial(
+        FlowTable,
+        idle_timeout=args.idle_timeout,
+        active_timeout=args.active_timeout,
+        max_flows=args.max_flows,
+        expired_flow_callback=exporter.export_flow)
+    my_dpi_factory = functools.partial(
+        MyDpi,
+        reassembly_prefix_size=args.reassembly_bytes,
+        reassembly_global_budget=args.reassembly_memory * 1024 * 1024,
+        endpoint_cache_size=args.endpoint_cache,
+        endpoint_cache_ttl=args.endpoint_cache_ttl,
+        endpoint_cache_confidence=args.endpoint_cache_confidence,
+        endpoint_cache_verify_interval=args.endpoint_cache_verify,
+        protocols=args.protocols,
+        plugin_entry_points=args.plugin_entry_points)
+    metrics = None
+    if args.metrics:
+        metrics = Metrics(args.metrics, args.metrics_interval, args.metrics_sample)
+    sampler = None
+    if args.sampling:
+        # a rejected flow is a new flow again once the flow table would have expired it
+        rejected_flow_timeout = args.idle_timeout if args.idle_timeout is not None else 60.0
+        sampler = Sampler(args.sample_rate, args.sample_mode, args.sample_target_lag, args.sample_min_rate,
+                          rejected_flow_timeout=rejected_flow_timeout)
+    tracer = None
+    if args.trace:
+        tracer = FlowTracer(args.trace, args.trace_file)
+    # workers are imported when they are used, numpy, asyncio and multiprocessing
+    # would otherwise be imported by every run
+    if args.stream:
+        from stream_worker import StreamWorker
+        dpi_worker = StreamWorker(my_dpi_factory(), flow_table_factory(), args.report_interval, args.follow,
+                                  metrics=metrics, sampler=sampler, packet_filter=args.packet_filter, tracer=tracer)
+    elif len(args.read_files) > 1:
+        from batch_worker import BatchWorker
+        from multi_file_worker import MultiFileWorker
+        if args.batch:
+            worker_factory = functools.partial(
+                BatchWorker, batch_size=args.batch_size, packet_filter=args.packet_filter)
+        else:
+            worker_factory = functools.partial(Worker, packet_filter=args.packet_filter)
+        processes_count = args.workers if args.workers > 1 else min(len(args.read_files), os.cpu_count())
+        dpi_worker = MultiFileWorker(my_dpi_factory, processes_count, flow_table_factory, worker_factory)
+        args.read_file = args.read_files
+    elif args.workers > 1:
+        from sharded_worker import ShardedWorker
+        dpi_worker = ShardedWorker(my_dpi_factory, args.workers, flow_table_factory,
+                                   packet_filter=args.packet_filter)
+    elif args.batch:
+        from batch_worker import BatchWorker
+        dpi_worker = BatchWorker(my_dpi_factory(), flow_table_factory(), args.batch_size, args.packet_filter)
+    else:
+        my_dpi = my_dpi_factory()
+        dpi_worker = Worker(my_dpi, flow_table_factory(), metrics, sampler, args.packet_filter, tracer)
+    if args.aggregating:
+        dpi_worker.aggregates = Aggregates(args.top_capacity, args.sketch_width, args.sketch_depth)
+        if args.aggregates_in:
+            dpi_worker.aggregates.merge(Aggregates.load(args.aggregates_in))
+    if args.index_out:
+        dpi_worker.flow_index = FlowIndex(dpi_worker.decode_packet)
+    if args.checkpoint_in:
+        dpi_worker.load_checkpoint(args.checkpoint_in)
+    dpi_worker.executor(args.read_file)
+    if args.index_out:
+        dpi_worker.flow_index.save(args.index_out)
+    if metrics is not None:
+        metrics.export()
+    if args.checkpoint_out:
+        # flows are continued and reported by the run of the next capture file
+        dpi_worker.save_checkpoint(args.checkpoint_out)
+    else:
+        dpi_worker.export_flows(exporter)
+    exporter.close()
+    if tracer is not None:
+        tracer.close()
+    if sampler is not None:
+        # flow records may be written to the standard output in a machine readable format
+        print(sampler.get_report(), file=sys.stderr)
+    if args.aggregating:
+        if args.aggregates_out:
+            dpi_worker.aggregates.save(args.aggregates_out)
+        report_file = sys.stdout if args.export_format == 'text' or args.export_file != '-' else sys.stderr
+        print(dpi_worker.aggregates.get_report(args.top), file=report_file)
+    # signature counters live in the worker processes when flows are sharded
+    if args.signature_stats and dpi_worker.my_dpi is not None:
+        print_signature_statistics(dpi_worker.my_dpi)
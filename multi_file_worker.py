@@ -0,0 +1,135 @@
+import queue
+import multiprocessing
+from worker import Worker, ExpiredFlowSender, FLOWS
+from my_dpi.flow_table import FlowTable
+
+
+# factories and results queue of the pool processes, set by init_file_process
+file_process_factories = None
+file_process_results_queue = None
+
+
+def init_file_process(worker_factory, my_dpi_factory, flow_table_factory, results_queue):
+    """ Keep the factories and the results queue in the pool process, they are not sent with every task
+
+    Args:
+        worker_factory (callable): returns a new worker from a MyDpi and a FlowTable
+        my_dpi_factory (callable): returns a new MyDpi instance
+        flow_table_factory (callable): returns a new FlowTable instance
+        results_queue (multiprocessing.Queue): queue of the messages sent by file_process
+    """
+    global file_process_factories, file_process_results_queue
+    file_process_factories = (worker_factory, my_dpi_factory, flow_table_factory)
+    file_process_results_queue = results_queue
+
+
+def file_process(pcap_file_name, expired_batch_size=1024):
+    """ Process one capture file with its own worker, send expired flows to the main process
+        as they expire and the flows left at the end of the file once it is read
+
+    Args:
+        pcap_file_name (string): path of the pcap file
+        expired_batch_size (int, optional): expired flows sent in one message. Defaults to 1024.
+    """
+    worker_factory, my_dpi_factory, flow_table_factory = file_process_factories
+    dpi_worker = worker_factory(my_dpi_factory(), flow_table_factory())
+    # the exporter lives in the main process, the worker only keeps a batch of expired flows
+    expired_flow_sender = ExpiredFlowSender(file_process_results_queue, expired_batch_size)
+    dpi_worker.flow_reporter = expired_flow_sender
+    dpi_worker.executor(pcap_file_name)
+    expired_flow_sender.flush()
+    flows = list(dpi_worker.flows_dict.items())
+    for _, flow in flows:
+        # module callbacks stay in this process, the next file is inspected by another worker
+        if flow.is_inspecting():
+            flow.give_up()
+    file_process_results_queue.put((FLOWS, flows))
+
+
+class MultiFileWorker(Worker):
+    """ Worker that processes several capture files in a process pool, one file per task,
+        and merges flows left at the end of every file by their direction independent key
+    """
+
+    def __init__(self, my_dpi_factory, processes_count, flow_table_factory=FlowTable, worker_factory=Worker):
+        Worker.__init__(self, None)
+        self.my_dpi_factory = my_dpi_factory
+        self.flow_table_factory = flow_table_factory
+        self.worker_factory = worker_factory
+        # expired flows of the files are reported by the main process
+        self.flow_reporter = flow_table_factory().expired_flow_callback
+        self.processes_count = processes_count
+
+    def executor(self, pcap_file_names):
+        """ Process every capture file and merge their flows into flows_dict
+
+        Args:
+            pcap_file_names (list): paths of the pcap files
+        """
+        results_queue = multiprocessing.Queue()
+        # (key, flow) lists the files left at their end
+        files_flows = []
+        with multiprocessing.Pool(self.processes_count, init_file_process,
+                                  (self.worker_factory, self.my_dpi_factory, self.flow_table_factory,
+                                   results_queue)) as pool:
+            # one file per task, so a large file does not hold back the files queued after it
+            files_result = pool.map_async(file_process, pcap_file_names, chunksize=1)
+            # expired flows are reported while the files are read, workers do not hold them
+            while len(files_flows) < len(pcap_file_names):
+                try:
+                    message = results_queue.get(timeout=0.1)
+                except queue.Empty:
+                    if files_result.ready():
+                        # a failed file raises its exception here instead of leaving its flows missing forever
+                        files_result.get()
+                    continue
+                self.handle_process_message(message, files_flows)
+        self.merge_flows(files_flows)
+
+    def merge_flows(self, files_flows):
+        """ Merge flows of every file into flows_dict in start time order
+            parts of a flow are merged in start time order: counters are summed, times
+            are combined and the first label that is not UNKNOWN is kept
+
+        Args:
+            files_flows (list): (key, flow) list of every file
+        """
+        flows = [item for file_flows in files_flows for item in file_flows]
+        flows.sort(key=lambda item: item[1].flow_start_time)
+        merged_flows = {}
+        for flow_key, flow in flows:
+            merged_flow = merged_flows.get(flow_key)
+            if merged_flow is None:
+                merged_flows[flow_key] = flow
+            else:
+                MultiFileWorker.merge_flow(merged_flow, flow)
+        for flow_key, flow in merged_flows.items():
+            self.flows_dict[flow_key] = flow
+
+    @staticmethod
+    def merge_flow(merged_flow, flow):
+        """ Add a later part of a flow to its earlier part
+
+        Args:
+            merged_flow (Flow): earliest part of the flow, its client is kept
+            flow (Flow): later part of the flow, it may have seen the server first
+        """
+        if flow.client_endpoint_is_lower == merged_flow.client_endpoint_is_lower:
+            merged_flow.sent_packets_count += flow.sent_packets_count
+            merged_flow.recieved_packets_count += flow.recieved_packets_count
+            merged_flow.sent_bytes_count += flow.sent_bytes_count
+            merged_flow.recieved_bytes_count += flow.recieved_bytes_count
+        else:
+            # client of the later part is the server of the merged flow
+            merged_flow.sent_packets_count += flow.recieved_packets_count
+            merged_flow.recieved_packets_count += flow.sent_packets_count
+            merged_flow.sent_bytes_count += flow.recieved_bytes_count
+            merged_flow.recieved_bytes_count += flow.sent_bytes_count
+        merged_flow.flow_start_time = min(merged_flow.flow_start_time, flow.flow_start_time)
+        merged_flow.flow_last_time = max(merged_flow.flow_last_time, flow.flow_last_time)
+        if not merged_flow.is_protocol_detected() and flow.is_protocol_detected():
+            merged_flow.set_protocol(flow.protocol)
+        if merged_flow.server_name is None:
+            merged_flow.server_name = flow.server_name
+        if merged_flow.application_protocols is None:
+            merged_flow.application_protocols = flow.application_protocols
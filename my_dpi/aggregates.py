@@ -0,0 +1,354 @@
+""" Bounded memory aggregates of reported flows
+
+Flows are added when they leave the flow table or at the end of the capture,
+with their final label, so the flow table can be kept small with timeouts
+and --max-flows while the aggregates cover the whole capture:
+
+- packets, bytes and flows of every protocol label, exact
+- top talkers (bytes sent and received by an address), server ports (bytes
+  of flows to a layer 4 protocol and port) and conversations (bytes between
+  two addresses), each kept by a HeavyHitters summary of fixed size
+
+A HeavyHitters summary is a Space-Saving table of capacity counters and a
+Count-Min sketch of width x depth counters. For a stream of N bytes:
+
+- every key with more than N / capacity bytes is in the table
+- a counter overestimates its key by at most its error, which is at most
+  N / capacity, so count - error is a lower bound
+- the sketch overestimates a key by at most e * N / width with probability
+  1 - e^-depth, the reported estimate is the smaller of the two upper bounds
+
+Summaries of the same capacity and sketch size are merged by adding their
+sketches and combining their tables (Agarwal et al., Mergeable Summaries),
+the error bounds of the merged summary hold for the merged stream. State is
+saved to JSON, so aggregates of separate runs or processes are merged with
+Aggregates.merge.
+"""
+import os
+import json
+import heapq
+import socket
+import hashlib
+from array import array
+
+
+class SpaceSaving:
+    """ Top keys of a weighted stream in capacity counters (Space-Saving, Metwally et al. 2005)
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        # key -> [count, error]
+        self.counters = {}
+        # (count, key) of every counter, counts of the heap are only updated when they reach its top
+        self.heap = []
+        self.total = 0
+
+    def update(self, key, weight):
+        """ Add weight to the counter of a key, the smallest counter is replaced when the table is full
+
+        Args:
+            key (bytes): key
+            weight (int): weight of this occurrence
+        """
+        self.total += weight
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[key] = [weight, 0]
+            heapq.heappush(self.heap, (weight, key))
+            return
+        # counts only grow, an outdated top entry is pushed down with its current count
+        heap = self.heap
+        while True:
+            count, evicted_key = heap[0]
+            current_count = self.counters[evicted_key][0]
+            if current_count == count:
+                break
+            heapq.heapreplace(heap, (current_count, evicted_key))
+        del self.counters[evicted_key]
+        # the new key may have been counted up to the evicted count before
+        self.counters[key] = [count + weight, count]
+        heapq.heapreplace(heap, (count + weight, key))
+
+    def get_minimum(self):
+        """ Get the count a key that is not in a full table may have
+
+        Returns:
+            int: smallest count of a full table, 0 otherwise
+        """
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(counter[0] for counter in self.counters.values())
+
+    def merge(self, other):
+        """ Add the counters of a summary of the same capacity
+
+        Args:
+            other (SpaceSaving): summary of another stream
+        """
+        minimum = self.get_minimum()
+        other_minimum = other.get_minimum()
+        counters = {}
+        for key in self.counters.keys() | other.counters.keys():
+            # a key missing from a full table may have been counted up to its minimum there
+            count, error = self.counters.get(key, (minimum, minimum))
+            other_count, other_error = other.counters.get(key, (other_minimum, other_minimum))
+            counters[key] = [count + other_count, error + other_error]
+        largest = heapq.nlargest(self.capacity, counters.items(), key=lambda item: item[1][0])
+        self.counters = dict(largest)
+        self.heap = [(counter[0], key) for key, counter in largest]
+        heapq.heapify(self.heap)
+        self.total += other.total
+
+    def get_top(self, count):
+        """ Get the largest counters
+
+        Args:
+            count (int): number of keys
+
+        Returns:
+            list: (key, count, error) list, largest count first
+        """
+        largest = heapq.nlargest(count, self.counters.items(), key=lambda item: item[1][0])
+        return [(key, counter[0], counter[1]) for key, counter in largest]
+
+
+class CountMinSketch:
+    """ Counts of a weighted stream in depth rows of width counters (Cormode and Muthukrishnan 2005)
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('q', bytes(8 * width)) for _ in range(depth)]
+
+    def get_indexes(self, key):
+        """ Get the counter of every row for a key, rows use independent parts of one hash
+
+        Args:
+            key (bytes): key
+
+        Returns:
+            list: counter index of every row
+        """
+        digest = hashlib.blake2b(key, digest_size=4 * self.depth).digest()
+        width = self.width
+        return [int.from_bytes(digest[row * 4:row * 4 + 4], 'little') % width for row in range(self.depth)]
+
+    def update(self, key, weight):
+        for row, index in zip(self.rows, self.get_indexes(key)):
+            row[index] += weight
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self.rows, self.get_indexes(key)))
+
+    def merge(self, other):
+        """ Add the counters of a sketch of the same size
+
+        Args:
+            other (CountMinSketch): sketch of another stream
+        """
+        for row, other_row in zip(self.rows, other.rows):
+            for index, count in enumerate(other_row):
+                if count:
+                    row[index] += count
+
+
+class HeavyHitters:
+    """ Space-Saving table of the top keys with a Count-Min sketch that tightens their counts
+    """
+
+    def __init__(self, capacity=1024, sketch_width=2048, sketch_depth=4):
+        self.top = SpaceSaving(capacity)
+        self.sketch = CountMinSketch(sketch_width, sketch_depth)
+
+    def update(self, key, weight):
+        self.top.update(key, weight)
+        self.sketch.update(key, weight)
+
+    def merge(self, other):
+        if (self.top.capacity, self.sketch.width, self.sketch.depth) != \
+                (other.top.capacity, other.sketch.width, other.sketch.depth):
+            raise ValueError('aggregates of different capacities or sketch sizes can not be merged')
+        self.top.merge(other.top)
+        self.sketch.merge(other.sketch)
+
+    def get_top(self, count):
+        """ Get the top keys with their estimates
+
+        Args:
+            count (int): number of keys
+
+        Returns:
+            list: (key, estimate, lower bound) list, estimate is an upper bound of the true count
+        """
+        # keys are ranked by their tighter estimate, counters of keys that replaced others are mostly error
+        estimates = [(key, min(top_count, self.sketch.estimate(key)), top_count - error)
+                     for key, (top_count, error) in self.top.counters.items()]
+        return heapq.nlargest(count, estimates, key=lambda item: item[1])
+
+    def get_state(self):
+        return {
+            'capacity': self.top.capacity,
+            'total': self.top.total,
+            'counters': [[key.hex(), count, error] for key, (count, error) in self.top.counters.items()],
+            'sketch_width': self.sketch.width,
+            'sketch_depth': self.sketch.depth,
+            'sketch': [row.tolist() for row in self.sketch.rows],
+        }
+
+    @staticmethod
+    def from_state(state):
+        heavy_hitters = HeavyHitters(state['capacity'], state['sketch_width'], state['sketch_depth'])
+        top = heavy_hitters.top
+        top.total = state['total']
+        top.counters = {bytes.fromhex(key): [count, error] for key, count, error in state['counters']}
+        top.heap = [(counter[0], key) for key, counter in top.counters.items()]
+        heapq.heapify(top.heap)
+        heavy_hitters.sketch.rows = [array('q', row) for row in state['sketch']]
+        return heavy_hitters
+
+
+class Aggregates:
+    """ Per protocol totals and heavy hitters of reported flows
+    """
+
+    VERSION = 1
+    # heavy hitters summaries, in report order
+    SUMMARIES = ('talkers', 'server_ports', 'conversations')
+
+    def __init__(self, capacity=1024, sketch_width=2048, sketch_depth=4):
+        # label -> [flows, packets, bytes]
+        self.protocols = {}
+        self.talkers = HeavyHitters(capacity, sketch_width, sketch_depth)
+        self.server_ports = HeavyHitters(capacity, sketch_width, sketch_depth)
+        self.conversations = HeavyHitters(capacity, sketch_width, sketch_depth)
+
+    def add_flow(self, flow):
+        """ Add a flow that leaves the flow table
+
+        Args:
+            flow (Flow): reported flow, with its final label and counters
+        """
+        packets_count = flow.sent_packets_count + flow.recieved_packets_count
+        bytes_count = flow.sent_bytes_count + flow.recieved_bytes_count
+        totals = self.protocols.get(flow.protocol)
+        if totals is None:
+            totals = self.protocols[flow.protocol] = [0, 0, 0]
+        totals[0] += 1
+        totals[1] += packets_count
+        totals[2] += bytes_count
+        self.talkers.update(flow.src_ip, bytes_count)
+        self.talkers.update(flow.dst_ip, bytes_count)
+        # the server is the destination of the first packet
+        self.server_ports.update(bytes((flow.payload_type,)) + flow.dst_port.to_bytes(2, 'big'), bytes_count)
+        # one key for both directions of a conversation
+        src_ip, dst_ip = flow.src_ip, flow.dst_ip
+        self.conversations.update(src_ip + dst_ip if src_ip <= dst_ip else dst_ip + src_ip, bytes_count)
+
+    def merge(self, other):
+        """ Add aggregates of another run or process
+
+        Args:
+            other (Aggregates): aggregates of the same capacity and sketch size
+
+        Raises:
+            ValueError: capacities or sketch sizes differ
+        """
+        for protocol, (flows_count, packets_count, bytes_count) in other.protocols.items():
+            totals = self.protocols.setdefault(protocol, [0, 0, 0])
+            totals[0] += flows_count
+            totals[1] += packets_count
+            totals[2] += bytes_count
+        for name in Aggregates.SUMMARIES:
+            getattr(self, name).merge(getattr(other, name))
+
+    def save(self, path):
+        """ Write aggregates to a JSON file, the file is replaced at once
+
+        Args:
+            path (string): file path
+        """
+        state = {
+            'version': Aggregates.VERSION,
+            'protocols': [[protocol, *totals] for protocol, totals in self.protocols.items()],
+        }
+        for name in Aggregates.SUMMARIES:
+            state[name] = getattr(self, name).get_state()
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as aggregates_file:
+            json.dump(state, aggregates_file)
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def load(path):
+        """ Read aggregates written by save
+
+        Args:
+            path (string): file path
+
+        Raises:
+            ValueError: file is not an aggregates file of this version
+
+        Returns:
+            Aggregates: aggregates of the file
+        """
+        with open(path) as aggregates_file:
+            try:
+                state = json.load(aggregates_file)
+            except json.JSONDecodeError:
+                raise ValueError(f'invalid aggregates file: {path}') from None
+        if not isinstance(state, dict) or state.get('version') != Aggregates.VERSION:
+            raise ValueError(f'unsupported aggregates file: {path}')
+        aggregates = Aggregates.__new__(Aggregates)
+        aggregates.protocols = {protocol: totals for protocol, *totals in state['protocols']}
+        for name in Aggregates.SUMMARIES:
+            setattr(aggregates, name, HeavyHitters.from_state(state[name]))
+        return aggregates
+
+    @staticmethod
+    def format_address(ip_address):
+        if len(ip_address) == 16:
+            return socket.inet_ntop(socket.AF_INET6, ip_address)
+        return socket.inet_ntoa(ip_address)
+
+    @staticmethod
+    def format_conversation(key):
+        # both addresses of a key have the same length
+        address_length = len(key) // 2
+        return (f'{Aggregates.format_address(key[:address_length])} <-> '
+                f'{Aggregates.format_address(key[address_length:])}')
+
+    @staticmethod
+    def format_server_port(key):
+        return f'{"TCP" if key[0] else "UDP"}/{int.from_bytes(key[1:3], "big")}'
+
+    def get_report(self, count=10):
+        """ Get report of protocol totals and of the top keys of every summary
+
+        Args:
+            count (int, optional): number of keys of every summary. Defaults to 10.
+
+        Returns:
+            string: aggregates report
+        """
+        lines = ['### protocols']
+        for protocol, (flows_count, packets_count, bytes_count) in sorted(
+                self.protocols.items(), key=lambda item: -item[1][2]):
+            lines.append(f'{protocol}: flows: {flows_count}, packets: {packets_count}, bytes: {bytes_count}')
+        formatters = {
+            'talkers': Aggregates.format_address,
+            'server_ports': Aggregates.format_server_port,
+            'conversations': Aggregates.format_conversation,
+        }
+        for name in Aggregates.SUMMARIES:
+            heavy_hitters = getattr(self, name)
+            top = heavy_hitters.top
+            lines.append(f'### top {name.replace("_", " ")} by bytes '
+                         f'(of {top.total} bytes, counts are over by at most {top.total // top.capacity})')
+            for key, estimate, lower_bound in heavy_hitters.get_top(count):
+                lines.append(f'{formatters[name](key)}: bytes: {estimate} (at least {lower_bound})')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,171 @@
+""" Binary checkpoints of a flow table
+
+A checkpoint keeps every flow of a flow table, in table order, so a later run
+can continue the flows of a rotated capture file instead of starting them
+again. The file starts with a header of the magic b'DPIC', a format version,
+the number of strings and the number of flows (little endian), followed by
+the strings (two length bytes and UTF-8 bytes each) and one fixed width
+RECORD per flow. Protocol labels, server names and ALPN protocols are
+indexes of the string list, index 0 stands for None.
+
+Module callbacks and TCP reassembly buffers of flows that are still being
+inspected live in MyDpi and can not be written, so these flows are saved as
+given up and keep their UNKNOWN label.
+"""
+import os
+import struct
+from my_dpi.flow import Flow
+from my_dpi.five_tuple import FiveTuple
+from my_dpi.detection_state import DetectionState
+
+
+MAGIC = b'DPIC'
+VERSION = 2
+HEADER = struct.Struct('<4sHIQ')
+# source and destination address (IPv4 addresses are zero padded), IP version, TCP flag,
+# source and destination port, client endpoint is lower, sent and received packets,
+# sent and received bytes, start and end time, inspection state code, label, server name
+# and ALPN protocols indexes
+RECORD = struct.Struct('<16s16sB?HH?QQQQddBIII')
+# separator of ALPN protocols in their string
+ALPN_SEPARATOR = '\x00'
+
+STATE_CODES = {
+    DetectionState.PENDING: 0,
+    DetectionState.CLASSIFIED: 1,
+    DetectionState.GAVE_UP: 2,
+}
+# codes are read back as the state constants, so is_inspecting identity checks keep working
+STATES = {code: state for state, code in STATE_CODES.items()}
+
+
+def save_checkpoint(path, flows):
+    """ Write flows to a checkpoint file, the file is replaced at once
+
+    Args:
+        path (string): checkpoint file path
+        flows (iterable): flows in table order
+    """
+    # string -> index, in the order of the string list
+    strings = {None: 0}
+    records = []
+    pack = RECORD.pack
+    gave_up_code = STATE_CODES[DetectionState.GAVE_UP]
+    for flow in flows:
+        label_index = strings.setdefault(flow.protocol, len(strings))
+        server_name_index = strings.setdefault(flow.server_name, len(strings))
+        application_protocols = flow.application_protocols
+        if application_protocols is not None:
+            application_protocols = ALPN_SEPARATOR.join(application_protocols)
+        application_protocols_index = strings.setdefault(application_protocols, len(strings))
+        # pending flows can not be resumed without their MyDpi state
+        state_code = gave_up_code if flow.inspection_state is DetectionState.PENDING else \
+            STATE_CODES[flow.inspection_state]
+        records.append(pack(
+            flow.src_ip,
+            flow.dst_ip,
+            6 if len(flow.src_ip) == 16 else 4,
+            flow.payload_type,
+            flow.src_port,
+            flow.dst_port,
+            flow.client_endpoint_is_lower,
+            flow.sent_packets_count,
+            flow.recieved_packets_count,
+            flow.sent_bytes_count,
+            flow.recieved_bytes_count,
+            flow.flow_start_time,
+            flow.flow_last_time,
+            state_code,
+            label_index,
+            server_name_index,
+            application_protocols_index,
+        ))
+    strings_bytes = []
+    for string in strings:
+        if string is None:
+            continue
+        encoded_string = string.encode('utf-8')
+        strings_bytes.append(len(encoded_string).to_bytes(2, 'little') + encoded_string)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as checkpoint_file:
+        checkpoint_file.write(HEADER.pack(MAGIC, VERSION, len(strings_bytes), len(records)))
+        checkpoint_file.write(b''.join(strings_bytes))
+        checkpoint_file.write(b''.join(records))
+    os.replace(temporary_path, path)
+
+
+def load_checkpoint(path):
+    """ Read flows of a checkpoint file
+
+    Args:
+        path (string): checkpoint file path
+
+    Raises:
+        ValueError: file is not a checkpoint of this version or is truncated
+
+    Returns:
+        list: list of (flow key, flow) in table order
+    """
+    with open(path, 'rb') as checkpoint_file:
+        data = checkpoint_file.read()
+    if len(data) < HEADER.size:
+        raise ValueError(f'invalid checkpoint file: {path}')
+    magic, version, strings_count, flows_count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f'invalid checkpoint file: {path}')
+    if version != VERSION:
+        raise ValueError(f'unsupported checkpoint version {version}: {path}')
+    offset = HEADER.size
+    strings = [None]
+    for _ in range(strings_count):
+        string_length = int.from_bytes(data[offset:offset + 2], 'little')
+        strings.append(data[offset + 2:offset + 2 + string_length].decode('utf-8'))
+        offset += 2 + string_length
+    # ALPN strings are split once, flows of a server share their tuple
+    application_protocols_of_strings = {}
+    records = memoryview(data)[offset:]
+    if len(records) != flows_count * RECORD.size:
+        raise ValueError(f'truncated checkpoint file: {path}')
+
+    flows = []
+    get_flow_key = FiveTuple.get_flow_key
+    new_flow = Flow.__new__
+    for (src_ip, dst_ip, ip_version, payload_type, src_port, dst_port, client_endpoint_is_lower,
+         sent_packets_count, recieved_packets_count, sent_bytes_count, recieved_bytes_count,
+         flow_start_time, flow_last_time, state_code, label_index, server_name_index,
+         application_protocols_index) in RECORD.iter_unpack(records):
+        if ip_version == 4:
+            src_ip = src_ip[:4]
+            dst_ip = dst_ip[:4]
+        # slots are set directly, __init__ would only set defaults that are overwritten
+        flow = new_flow(Flow)
+        flow.src_ip = src_ip
+        flow.dst_ip = dst_ip
+        flow.payload_type = payload_type
+        flow.src_port = src_port
+        flow.dst_port = dst_port
+        flow.client_endpoint_is_lower = client_endpoint_is_lower
+        flow.sent_packets_count = sent_packets_count
+        flow.recieved_packets_count = recieved_packets_count
+        flow.sent_bytes_count = sent_bytes_count
+        flow.recieved_bytes_count = recieved_bytes_count
+        flow.flow_start_time = flow_start_time
+        flow.flow_last_time = flow_last_time
+        flow.sampling_weight = 1
+        flow.sampling_variance = 0
+        flow.protocol = strings[label_index]
+        flow.inspection_state = STATES[state_code]
+        flow.inspection_callback = None
+        flow.inspection_budget = 0
+        flow.inspection_direction = None
+        flow.server_name = strings[server_name_index]
+        application_protocols = None
+        if application_protocols_index:
+            application_protocols = application_protocols_of_strings.get(application_protocols_index)
+            if application_protocols is None:
+                application_protocols = tuple(strings[application_protocols_index].split(ALPN_SEPARATOR))
+                application_protocols_of_strings[application_protocols_index] = application_protocols
+        flow.application_protocols = application_protocols
+        flow_key, _ = get_flow_key(src_ip, dst_ip, payload_type, src_port, dst_port)
+        flows.append((flow_key, flow))
+    return flows
@@ -1,13 +1,90 @@
 class DetectionState():
 
+    # attributes are stored in Flow __slots__
+    __slots__ = ()
+
+    # label of flows that no module has detected yet
+    UNKNOWN_LABEL = "UNKNOWN"
+
+    # inspection states, only pending flows are passed to MyDpi
+    PENDING = 'pending'
+    CLASSIFIED = 'classified'
+    GAVE_UP = 'gave_up'
+
     def __init__(self):
-        unknown_label = "UNKNOWN"
-        self.protocol = unknown_label
+        self.protocol = DetectionState.UNKNOWN_LABEL
+        self.inspection_state = DetectionState.PENDING
+        # callback of the module that asked for more packets, with the number of
+        # packets it may still see and the direction it wants (None for both)
+        self.inspection_callback = None
+        self.inspection_budget = 0
+        self.inspection_direction = None
+        # handshake fields read by TLS and QUIC modules
+        self.server_name = None
+        self.application_protocols = None
 
     def set_protocol(self, protocol_label):
-        """ Set protocl label to flow
+        """ Set protocl label to flow, the flow is classified and not inspected anymore
 
         Args:
             protocol_label (string): protocol label
         """
         self.protocol = protocol_label
+        self.inspection_state = DetectionState.CLASSIFIED
+        self.inspection_callback = None
+
+    def is_protocol_detected(self):
+        """ Check if a module has set the flow protocol label
+
+        Returns:
+            bool: True if protocol label is not UNKNOWN
+        """
+        return self.protocol != DetectionState.UNKNOWN_LABEL
+
+    def is_inspecting(self):
+        """ Check if next packets of the flow must be passed to MyDpi
+
+        Returns:
+            bool: True if flow is neither classified nor given up
+        """
+        return self.inspection_state is DetectionState.PENDING
+
+    def give_up(self):
+        """ Stop inspection of a flow that no module can classify, its label stays UNKNOWN
+        """
+        self.inspection_state = DetectionState.GAVE_UP
+        self.inspection_callback = None
+
+    def request_more_packets(self, callback, packets_count, from_client=None):
+        """ Ask for the next packets of the flow before deciding, used by modules that
+            need more than the first packet, like the server response
+
+        Args:
+            callback (function): called as callback(flow, application_packet) with the next packets
+            packets_count (int): number of next packets of the flow, in both directions, before giving up
+            from_client (bool, optional): only pass packets of this direction to callback. Defaults to None.
+        """
+        self.inspection_callback = callback
+        self.inspection_budget = packets_count
+        self.inspection_direction = from_client
+
+    def take_inspection_callback(self, application_packet):
+        """ Spend one packet of the inspection budget
+
+        Args:
+            application_packet (Packet): next packet of the flow
+
+        Returns:
+            function: callback that must inspect the packet, None if the packet is not requested
+        """
+        callback = self.inspection_callback
+        if callback is None:
+            return None
+        self.inspection_budget -= 1
+        if self.inspection_budget <= 0:
+            # the callback can request more packets again
+            self.inspection_callback = None
+        if self.inspection_direction is not None and \
+                application_packet.is_packet_from_client != self.inspection_direction:
+            return None
+        return callback
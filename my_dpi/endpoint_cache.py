@@ -0,0 +1,125 @@
+from collections import OrderedDict
+
+
+class EndpointCache:
+    """ Protocol labels of server endpoints (address, layer 4 protocol, port)
+
+    A label is trusted once confidence flows to the endpoint were classified
+    with it by the signatures, new flows to a trusted endpoint are then
+    labelled without inspection. Entries expire ttl seconds (of packet time)
+    after their last classification and least recently used entries are
+    evicted above max_entries. One trusted hit out of verify_interval is
+    inspected anyway, so an endpoint that changed protocol is learned again,
+    and an endpoint whose inspected flow is not classified is forgotten.
+
+    Labelled flows are not inspected, so metadata that modules read while
+    they classify a flow, like TLS and QUIC server names and ALPN protocols,
+    stays empty for them.
+    """
+
+    def __init__(self, max_entries=65536, ttl=300.0, confidence=3, verify_interval=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.confidence = confidence
+        # 0 never verifies trusted labels
+        self.verify_interval = verify_interval
+        self.hits_until_verification = verify_interval
+        # endpoint -> [label, consistent classifications, expiry time], least recently used first
+        self.entries = OrderedDict()
+        self.hits_count = 0
+        self.misses_count = 0
+        self.evictions_count = 0
+        self.expirations_count = 0
+        self.verifications_count = 0
+        # trusted labels contradicted by the signatures
+        self.verification_failures_count = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, flow):
+        """ Get trusted label of the server endpoint of a new flow
+
+        Args:
+            flow (Flow): new flow, after its first packet is counted
+
+        Returns:
+            string: protocol label, None if the flow must be inspected
+        """
+        # the server is the destination of the first packet
+        endpoint = (flow.dst_ip, flow.payload_type, flow.dst_port)
+        entry = self.entries.get(endpoint)
+        if entry is None:
+            self.misses_count += 1
+            return None
+        if entry[2] < flow.flow_last_time:
+            del self.entries[endpoint]
+            self.expirations_count += 1
+            self.misses_count += 1
+            return None
+        if entry[1] < self.confidence:
+            self.misses_count += 1
+            return None
+        if self.verify_interval:
+            self.hits_until_verification -= 1
+            if self.hits_until_verification <= 0:
+                self.hits_until_verification = self.verify_interval
+                self.verifications_count += 1
+                return None
+        self.entries.move_to_end(endpoint)
+        self.hits_count += 1
+        return entry[0]
+
+    def learn(self, flow):
+        """ Add the label of a flow classified by the signatures to its server endpoint
+
+        Args:
+            flow (Flow): flow classified by its last packet
+        """
+        timestamp = flow.flow_last_time
+        endpoint = (flow.dst_ip, flow.payload_type, flow.dst_port)
+        entries = self.entries
+        entry = entries.get(endpoint)
+        if entry is None:
+            entries[endpoint] = [flow.protocol, 1, timestamp + self.ttl]
+            if len(entries) > self.max_entries:
+                entries.popitem(last=False)
+                self.evictions_count += 1
+            return
+        if entry[0] == flow.protocol:
+            entry[1] += 1
+        else:
+            if entry[1] >= self.confidence:
+                self.verification_failures_count += 1
+            # inconsistent labels start over, the new label must be confirmed again
+            entry[0] = flow.protocol
+            entry[1] = 1
+        entry[2] = timestamp + self.ttl
+        entries.move_to_end(endpoint)
+
+    def forget(self, flow):
+        """ Remove the label of the server endpoint of a flow the signatures gave up on
+
+        Args:
+            flow (Flow): flow that is not classified
+        """
+        entry = self.entries.pop((flow.dst_ip, flow.payload_type, flow.dst_port), None)
+        if entry is not None and entry[1] >= self.confidence:
+            # a verification, or a flow inspected before the endpoint was trusted, contradicts the label
+            self.verification_failures_count += 1
+
+    def get_statistics(self):
+        """ Get cache counters
+
+        Returns:
+            dict: entries, hits, misses, evictions, expirations, verifications and verification failures
+        """
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits_count,
+            'misses': self.misses_count,
+            'evictions': self.evictions_count,
+            'expirations': self.expirations_count,
+            'verifications': self.verifications_count,
+            'verification_failures': self.verification_failures_count,
+        }
@@ -0,0 +1,290 @@
+""" Flow exporters: text, JSON Lines, CSV and binary records
+
+Exporters format a flow when it leaves the flow table (or at the end of the
+capture) and write records through a buffer that is flushed when it holds
+buffer_size bytes, every flush_interval seconds and when the exporter is
+closed. Addresses are formatted through a cache, so servers seen by many
+flows are converted once, and timestamps are written as epoch seconds
+unless ISO formatting is asked for.
+
+Binary files start with a header of the magic b'DPIF', a format version and
+the size of BinaryExporter.RECORD (little endian), followed by records of
+BinaryExporter.RECORD, each followed by its UTF-8 protocol label of the
+length given in the record.
+
+The sqlite format writes flows to a queryable database through FlowStore
+of my_dpi.flow_store, which has the same export_flow, flush and close.
+"""
+import io
+import abc
+import sys
+import csv
+import json
+import time
+import struct
+import datetime
+from my_dpi.flow import Flow
+from my_dpi.flow_table import FlowTable
+
+
+FIELDS = (
+    'flow', 'src_ip', 'dst_ip', 'l4', 'src_port', 'dst_port', 'protocol', 'server_name', 'alpn',
+    'sent_packets', 'received_packets', 'sent_bytes', 'received_bytes',
+    'start_time', 'end_time', 'reason',
+)
+
+
+class FlowExporter(abc.ABC):
+    """ Base of the exporters, subclasses implement format_flow
+    """
+
+    # text exporters are written to a binary file through this encoding
+    encoding = 'utf-8'
+
+    def __init__(self, file, buffer_size=1 << 20, flush_interval=1.0, format_addresses=True,
+                 format_timestamps=False, address_cache_size=65536):
+        self.file = file
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        # False writes addresses as hex of their packed bytes
+        self.format_addresses = format_addresses
+        # True writes ISO 8601 local times instead of epoch seconds
+        self.format_timestamps = format_timestamps
+        self.address_cache_size = address_cache_size
+        self.address_cache = {}
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.next_flush_time = time.monotonic() + flush_interval
+        # flow number written with every record
+        self.flows_count = 0
+
+    def format_address(self, ip_address):
+        """ Format a packed address, through the address cache
+
+        Args:
+            ip_address (bytes): 4 or 16 bytes address
+
+        Returns:
+            string: address string
+        """
+        address = self.address_cache.get(ip_address)
+        if address is None:
+            if self.format_addresses:
+                address = Flow.ip_to_string(ip_address)
+            else:
+                address = ip_address.hex()
+            if len(self.address_cache) >= self.address_cache_size:
+                self.address_cache.clear()
+            self.address_cache[ip_address] = address
+        return address
+
+    def format_timestamp(self, timestamp):
+        """ Format a timestamp
+
+        Args:
+            timestamp (float): epoch seconds
+
+        Returns:
+            float or string: epoch seconds, or an ISO 8601 string if format_timestamps is set
+        """
+        if self.format_timestamps:
+            return datetime.datetime.fromtimestamp(timestamp).isoformat()
+        return timestamp
+
+    def get_record_fields(self, flow, reason):
+        """ Get fields of a flow record in FIELDS order
+
+        Args:
+            flow (Flow): flow
+            reason (string): why the flow left the flow table
+
+        Returns:
+            tuple: record fields
+        """
+        return (
+            self.flows_count,
+            self.format_address(flow.src_ip),
+            self.format_address(flow.dst_ip),
+            'TCP' if flow.payload_type else 'UDP',
+            flow.src_port,
+            flow.dst_port,
+            flow.protocol,
+            flow.server_name,
+            ','.join(flow.application_protocols) if flow.application_protocols is not None else None,
+            flow.sent_packets_count,
+            flow.recieved_packets_count,
+            flow.sent_bytes_count,
+            flow.recieved_bytes_count,
+            self.format_timestamp(flow.flow_start_time),
+            self.format_timestamp(flow.flow_last_time),
+            reason,
+        )
+
+    @abc.abstractmethod
+    def format_flow(self, flow, reason):
+        """ Format a flow record
+
+        Args:
+            flow (Flow): flow
+            reason (string): why the flow left the flow table
+
+        Returns:
+            bytes: record
+        """
+
+    def export_flow(self, flow, reason=FlowTable.END_OF_CAPTURE):
+        """ Buffer the record of a flow, usable as FlowTable expired_flow_callback
+
+        Args:
+            flow (Flow): flow
+            reason (string, optional): why the flow left the flow table. Defaults to FlowTable.END_OF_CAPTURE.
+        """
+        record = self.format_flow(flow, reason)
+        self.flows_count += 1
+        self.buffer.append(record)
+        self.buffered_bytes += len(record)
+        if self.buffered_bytes >= self.buffer_size or time.monotonic() >= self.next_flush_time:
+            self.flush()
+
+    def flush(self):
+        """ Write buffered records to the file
+        """
+        if self.buffer:
+            self.file.write(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered_bytes = 0
+        self.file.flush()
+        self.next_flush_time = time.monotonic() + self.flush_interval
+
+    def close(self):
+        """ Flush buffered records and close the file, standard output is only flushed
+        """
+        self.flush()
+        if self.file is not sys.stdout.buffer:
+            self.file.close()
+
+
+class TextExporter(FlowExporter):
+    """ Flow.get_state_string records, the terminal report of the DPI
+    """
+
+    def format_flow(self, flow, reason):
+        return (flow.get_state_string(self.flows_count) + '\n').encode(self.encoding)
+
+
+class JsonLinesExporter(FlowExporter):
+    """ One JSON object per line
+    """
+
+    def format_flow(self, flow, reason):
+        record = dict(zip(FIELDS, self.get_record_fields(flow, reason)))
+        return (json.dumps(record) + '\n').encode(self.encoding)
+
+
+class CsvExporter(FlowExporter):
+    """ Comma separated values with a header line
+    """
+
+    def __init__(self, file, *args, **kwargs):
+        FlowExporter.__init__(self, file, *args, **kwargs)
+        self.text_buffer = io.StringIO()
+        self.writer = csv.writer(self.text_buffer, lineterminator='\n')
+        self.writer.writerow(FIELDS)
+        header = self.text_buffer.getvalue().encode(self.encoding)
+        self.buffer.append(header)
+        self.buffered_bytes += len(header)
+
+    def format_flow(self, flow, reason):
+        self.text_buffer.seek(0)
+        self.text_buffer.truncate()
+        self.writer.writerow(self.get_record_fields(flow, reason))
+        return self.text_buffer.getvalue().encode(self.encoding)
+
+
+class BinaryExporter(FlowExporter):
+    """ Little endian records, addresses are not formatted
+
+    Record: source and destination address (16 bytes each, IPv4 addresses are
+    zero padded), IP version, TCP flag, source and destination port, sent and
+    received packets, sent and received bytes, start and end time (epoch
+    seconds), the reason code and the length of the protocol label, followed
+    by the UTF-8 protocol label.
+    """
+
+    MAGIC = b'DPIF'
+    VERSION = 2
+    RECORD = struct.Struct('<16s16sBBHHQQQQddBH')
+    HEADER = struct.Struct('<4sHH')
+    REASON_CODES = {
+        FlowTable.END_OF_CAPTURE: 0,
+        FlowTable.IDLE_TIMEOUT: 1,
+        FlowTable.ACTIVE_TIMEOUT: 2,
+        FlowTable.EVICTED: 3,
+    }
+
+    def __init__(self, file, *args, **kwargs):
+        FlowExporter.__init__(self, file, *args, **kwargs)
+        header = BinaryExporter.HEADER.pack(BinaryExporter.MAGIC, BinaryExporter.VERSION, BinaryExporter.RECORD.size)
+        self.buffer.append(header)
+        self.buffered_bytes += len(header)
+        # protocol label -> UTF-8 label
+        self.encoded_labels = {}
+
+    def format_flow(self, flow, reason):
+        label = self.encoded_labels.get(flow.protocol)
+        if label is None:
+            label = self.encoded_labels[flow.protocol] = flow.protocol.encode('utf-8')
+        return BinaryExporter.RECORD.pack(
+            flow.src_ip,
+            flow.dst_ip,
+            6 if len(flow.src_ip) == 16 else 4,
+            flow.payload_type,
+            flow.src_port,
+            flow.dst_port,
+            flow.sent_packets_count,
+            flow.recieved_packets_count,
+            flow.sent_bytes_count,
+            flow.recieved_bytes_count,
+            flow.flow_start_time,
+            flow.flow_last_time,
+            BinaryExporter.REASON_CODES.get(reason, 0),
+            len(label),
+        ) + label
+
+
+EXPORTERS = {
+    'text': TextExporter,
+    'jsonl': JsonLinesExporter,
+    'csv': CsvExporter,
+    'binary': BinaryExporter,
+}
+# formats of get_exporter, sqlite3 is imported only by runs that store flows
+EXPORT_FORMATS = sorted([*EXPORTERS, 'sqlite'])
+
+
+def get_exporter(export_format, path=None, **kwargs):
+    """ Create an exporter that writes to a file or the standard output
+
+    Args:
+        export_format (string): one of EXPORT_FORMATS
+        path (string, optional): output file path, None or '-' for the standard output. Defaults to None.
+        kwargs: options of FlowExporter, not used by the sqlite format
+
+    Raises:
+        ValueError: sqlite format without a database path
+
+    Returns:
+        FlowExporter: exporter, or FlowStore for the sqlite format
+    """
+    if export_format == 'sqlite':
+        if path is None or path == '-':
+            raise ValueError('the sqlite export format needs a database path')
+        from my_dpi.flow_store import FlowStore
+        return FlowStore(path)
+    if path is None or path == '-':
+        # text printed before the exporter was created is written first
+        sys.stdout.flush()
+        file = sys.stdout.buffer
+    else:
+        file = open(path, 'wb')
+    return EXPORTERS[export_format](file, **kwargs)
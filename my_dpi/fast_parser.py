@@ -0,0 +1,142 @@
+""" struct based decoder of Ethernet/VLAN/IPv4/IPv6/TCP/UDP headers
+
+decode_packet reads only the header fields needed by the Worker straight
+from the packet buffer and returns the payload as a memoryview slice
+of it, no header objects are built and the payload is not copied.
+"""
+import struct
+
+
+# value returned when the packet must be decoded by dpkt
+FALLBACK = object()
+# reasons returned for packets that are not inspected
+MALFORMED = 'malformed'
+NON_IP = 'non_ip'
+FRAGMENT = 'fragment'
+NON_L4 = 'non_l4'
+ZERO_PAYLOAD = 'zero_payload'
+
+ETHERNET_HEADER_LENGTH = 14
+VLAN_TAG_LENGTH = 4
+IPV4_HEADER_LENGTH = 20
+IPV6_HEADER_LENGTH = 40
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+# 802.1Q, 802.1ad (QinQ) and the old QinQ tag
+ETHERTYPES_VLAN = frozenset((0x8100, 0x88a8, 0x9100))
+# MPLS and PPPoE session, left to dpkt
+ETHERTYPES_FALLBACK = frozenset((0x8847, 0x8848, 0x8864))
+
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+# IPv6 extension headers with (length + 1) * 8 bytes
+IPV6_EXTENSION_HEADERS = frozenset((0, 43, 60))
+IPV6_FRAGMENT_HEADER = 44
+IPV6_AUTHENTICATION_HEADER = 51
+
+_unpack_ethertype = struct.Struct('!H').unpack_from
+# version/ihl, total length, flags/fragment offset, protocol, source, destination
+_unpack_ipv4 = struct.Struct('!BxH2xHxB2x4s4s').unpack_from
+# payload length, next header, source, destination
+_unpack_ipv6 = struct.Struct('!4xHBx16s16s').unpack_from
+# next header, header length
+_unpack_ipv6_extension = struct.Struct('!BB').unpack_from
+# fragment offset and flags of the IPv6 fragment header
+_unpack_ipv6_fragment = struct.Struct('!2xH').unpack_from
+# source port, destination port, sequence number, data offset
+_unpack_tcp = struct.Struct('!HHI4xB').unpack_from
+TCP_HEADER_LENGTH = 13
+# source port, destination port
+_unpack_udp = struct.Struct('!HH').unpack_from
+UDP_HEADER_LENGTH = 8
+
+
+def decode_packet(packet_payload, keep_empty_payload=False):
+    """ Decode L2-L4 headers of an Ethernet frame
+
+    Args:
+        packet_payload (bytes or memoryview): packet bytes
+        keep_empty_payload (bool, optional): return TCP/UDP packets without payload too,
+            for readers of every packet of a flow. Defaults to False.
+
+    Returns:
+        tuple: (src_ip, dst_ip, is_tcp, src_port, dst_port, payload, tcp_sequence) where payload
+            is a memoryview and tcp_sequence is None for UDP, a drop reason string if packet is not
+            a TCP/UDP packet with payload, FALLBACK if packet encapsulation must be decoded by dpkt
+    """
+    packet_length = len(packet_payload)
+    if packet_length < ETHERNET_HEADER_LENGTH:
+        return MALFORMED
+    offset = 12
+    ethertype, = _unpack_ethertype(packet_payload, offset)
+    offset = ETHERNET_HEADER_LENGTH
+    # skip VLAN tags, each one ends with the ethertype of the next header
+    while ethertype in ETHERTYPES_VLAN:
+        if packet_length < offset + VLAN_TAG_LENGTH:
+            return MALFORMED
+        ethertype, = _unpack_ethertype(packet_payload, offset + 2)
+        offset += VLAN_TAG_LENGTH
+
+    if ethertype == ETHERTYPE_IPV4:
+        if packet_length < offset + IPV4_HEADER_LENGTH:
+            return MALFORMED
+        version_ihl, total_length, fragment, ip_protocol, src_ip, dst_ip = _unpack_ipv4(packet_payload, offset)
+        header_length = (version_ihl & 0x0f) * 4
+        if version_ihl >> 4 != 4 or header_length < IPV4_HEADER_LENGTH:
+            return MALFORMED
+        # non first fragments have no layer 4 header
+        if fragment & 0x1fff:
+            return FRAGMENT
+        # ignore Ethernet padding after the IP packet
+        payload_end = min(offset + total_length, packet_length)
+        offset += header_length
+    elif ethertype == ETHERTYPE_IPV6:
+        if packet_length < offset + IPV6_HEADER_LENGTH:
+            return MALFORMED
+        payload_length, ip_protocol, src_ip, dst_ip = _unpack_ipv6(packet_payload, offset)
+        payload_end = min(offset + IPV6_HEADER_LENGTH + payload_length, packet_length)
+        offset += IPV6_HEADER_LENGTH
+        # walk extension headers up to the layer 4 header
+        while ip_protocol != IPPROTO_TCP and ip_protocol != IPPROTO_UDP:
+            if payload_end < offset + 8:
+                return MALFORMED
+            if ip_protocol in IPV6_EXTENSION_HEADERS:
+                next_header, extension_length = _unpack_ipv6_extension(packet_payload, offset)
+                offset += (extension_length + 1) * 8
+            elif ip_protocol == IPV6_FRAGMENT_HEADER:
+                next_header, _ = _unpack_ipv6_extension(packet_payload, offset)
+                fragment, = _unpack_ipv6_fragment(packet_payload, offset)
+                if fragment & 0xfff8:
+                    return FRAGMENT
+                offset += 8
+            elif ip_protocol == IPV6_AUTHENTICATION_HEADER:
+                next_header, extension_length = _unpack_ipv6_extension(packet_payload, offset)
+                offset += (extension_length + 2) * 4
+            else:
+                return NON_L4
+            ip_protocol = next_header
+    elif ethertype in ETHERTYPES_FALLBACK:
+        return FALLBACK
+    else:
+        return NON_IP
+
+    if ip_protocol == IPPROTO_TCP:
+        if payload_end < offset + TCP_HEADER_LENGTH:
+            return MALFORMED
+        src_port, dst_port, tcp_sequence, data_offset = _unpack_tcp(packet_payload, offset)
+        offset += (data_offset >> 4) * 4
+        is_tcp = True
+    elif ip_protocol == IPPROTO_UDP:
+        if payload_end < offset + UDP_HEADER_LENGTH:
+            return MALFORMED
+        src_port, dst_port = _unpack_udp(packet_payload, offset)
+        offset += UDP_HEADER_LENGTH
+        is_tcp = False
+        tcp_sequence = None
+    else:
+        return NON_L4
+    # skip UDP/TCP zero length payload
+    if offset >= payload_end and not keep_empty_payload:
+        return ZERO_PAYLOAD
+    return src_ip, dst_ip, is_tcp, src_port, dst_port, memoryview(packet_payload)[offset:payload_end], tcp_sequence
@@ -1,11 +1,18 @@
 class FiveTuple():
 
-    def __init__(self, five_tuple):
+    # attributes are stored in Flow __slots__
+    __slots__ = ()
+
+    def __init__(self, five_tuple, client_endpoint_is_lower=None):
         self.src_ip = five_tuple[0]
         self.dst_ip = five_tuple[1]
         self.payload_type = five_tuple[2]
         self.src_port = five_tuple[3]
         self.dst_port = five_tuple[4]
+        if client_endpoint_is_lower is None:
+            _, client_endpoint_is_lower = FiveTuple.get_flow_key(*five_tuple)
+        # direction of the flow key: True if client (src) endpoint is the first endpoint of the key
+        self.client_endpoint_is_lower = client_endpoint_is_lower
 
     def get_five_tuple(self):
         """ Get 5-tuple
@@ -23,6 +30,48 @@ class FiveTuple():
         """
         return (self.dst_ip, self.src_ip, self.payload_type, self.dst_port, self.src_port)
 
+    def get_flow_key_of_flow(self):
+        """ Get direction independent flow key
+
+        Returns:
+            bytes: flow key
+        """
+        return FiveTuple.get_flow_key(*self.get_five_tuple())[0]
+
+    def is_packet_from_client(self, src_endpoint_is_lower):
+        """ Check packet direction using the direction returned by get_flow_key
+
+        Args:
+            src_endpoint_is_lower (bool): True if packet source is the first endpoint of the flow key
+
+        Returns:
+            bool: True if packet is sent by the flow client
+        """
+        return src_endpoint_is_lower == self.client_endpoint_is_lower
+
+    @staticmethod
+    def get_flow_key(src_ip, dst_ip, payload_type, src_port, dst_port):
+        """ Static method for getting direction independent flow key
+            endpoints (address and port) are sorted and packed in one bytes object,
+            so both directions of a flow have the same key
+
+        Args:
+            src_ip (bytes): packed source address
+            dst_ip (bytes): packed destination address
+            payload_type (bool): True if layer 4 protocol is TCP
+            src_port (int): source port
+            dst_port (int): destination port
+
+        Returns:
+            bytes, bool: flow key and True if source endpoint is the first endpoint of the key
+        """
+        src_endpoint = src_ip + src_port.to_bytes(2, 'big')
+        dst_endpoint = dst_ip + dst_port.to_bytes(2, 'big')
+        payload_type_byte = b'\x01' if payload_type else b'\x00'
+        if src_endpoint <= dst_endpoint:
+            return src_endpoint + dst_endpoint + payload_type_byte, True
+        return dst_endpoint + src_endpoint + payload_type_byte, False
+
     @staticmethod
     def get_five_tuple_of_packet(ip_packet):
         """ Static method for getting 5-tuple and reverse 5-tuple from IP packet
@@ -8,33 +8,73 @@ import datetime
 
 class Flow(FlowStats, FiveTuple, DetectionState):
 
-    def __init__(self, five_tuple):
+    # one slot layout for the attributes of every base class, flows have no __dict__
+    __slots__ = (
+        # FlowStats
+        'sent_packets_count',
+        'recieved_packets_count',
+        'sent_bytes_count',
+        'recieved_bytes_count',
+        'flow_start_time',
+        'flow_last_time',
+        'sampling_weight',
+        'sampling_variance',
+        # FiveTuple
+        'src_ip',
+        'dst_ip',
+        'payload_type',
+        'src_port',
+        'dst_port',
+        'client_endpoint_is_lower',
+        # DetectionState
+        'protocol',
+        'inspection_state',
+        'inspection_callback',
+        'inspection_budget',
+        'inspection_direction',
+        'server_name',
+        'application_protocols',
+    )
+
+    def __init__(self, five_tuple, client_endpoint_is_lower=None):
         FlowStats.__init__(self)
-        FiveTuple.__init__(self, five_tuple)
+        FiveTuple.__init__(self, five_tuple, client_endpoint_is_lower)
         DetectionState.__init__(self)
 
-    # index used to count flow number
-    index = -1
+    @staticmethod
+    def ip_to_string(ip_address):
+        """ Convert binary format of IPv4 or IPv6 address to string
+
+        Args:
+            ip_address (bytes): 4 or 16 bytes address
+
+        Returns:
+            string: address string
+        """
+        if len(ip_address) == 16:
+            return socket.inet_ntop(socket.AF_INET6, ip_address)
+        return socket.inet_ntoa(ip_address)
 
-    def get_state_string(self):
+    def get_state_string(self, flow_number):
         """ Get flow state string
 
+        Args:
+            flow_number (int): number of the flow in the report
+
         Returns:
             string: change flow state information to string
         """
         # convert binary format of ip address to string
-        src_ip_str = socket.inet_ntoa(self.src_ip)
+        src_ip_str = Flow.ip_to_string(self.src_ip)
         # convert binary format of ip address to string
-        dst_ip_str = socket.inet_ntoa(self.dst_ip)
+        dst_ip_str = Flow.ip_to_string(self.dst_ip)
         # if payload type is True, then it is TCP, otherwise it is UDP
         payload_type = 'TCP' if self.payload_type else 'UDP'
         # five tuple consists of source ip address, destination ip address, source port, destination port, protocol
         # five tuple is used to identify flow
         five_tuple = (src_ip_str, dst_ip_str, payload_type,
                       *self.get_five_tuple()[3:])
-        # index used to count flow number
-        Flow.index += 1
-        return (f'### flow number {Flow.index}' +
+        return (f'### flow number {flow_number}' +
                 ' ' * 3 +
                 f'### five tuple: {five_tuple}' +
                 '\n'
@@ -0,0 +1,311 @@
+""" Sidecar flow index of a capture file
+
+While a capture is read, FlowIndex keeps the record offsets of every packet
+by canonical flow key, packets without payload (handshakes, acknowledgments)
+included. The index is saved next to the analysis results and later used to
+copy the records of some flows into a new capture without reading the rest of
+the file.
+
+The file starts with a header of the magic b'DPIX', a format version, the
+length of the capture path, the capture size and modification time, the
+number of pcapng header blocks and the number of flows (little endian),
+followed by the UTF-8 capture path, the offsets of the pcapng section header
+and interface description blocks, a directory of (key hash, entry offset)
+sorted by hash and one entry per flow: ENTRY, the flow key and the
+differences between consecutive record offsets as an array of the smallest
+width that holds them. A flow is found by a binary search of the directory
+and only its own entry is read.
+
+Non first IPv4 fragments, and packets that only dpkt decodes and have no
+payload, have no flow key and are not indexed.
+"""
+import os
+import sys
+import mmap
+import heapq
+import struct
+import hashlib
+import itertools
+from array import array
+from my_dpi import fast_parser
+from my_dpi.five_tuple import FiveTuple
+from my_dpi.pcap_reader import (
+    PcapReader, PCAP_MAGIC_NUMBERS, PCAP_GLOBAL_HEADER_LENGTH, PCAP_RECORD_HEADER_LENGTH,
+    PCAPNG_SECTION_HEADER_BLOCK, PCAPNG_BYTE_ORDER_MAGIC)
+
+
+MAGIC = b'DPIX'
+VERSION = 1
+# magic, version, capture path length, capture size, capture modification time in nanoseconds,
+# header blocks count and flows count
+HEADER = struct.Struct('<4sHHQqQQ')
+# key hash and offset of the flow entry in the index file
+DIRECTORY_ENTRY = struct.Struct('<QQ')
+# key length, width of the offset differences, packets count and offset of the first record
+ENTRY = struct.Struct('<BBIQ')
+# width of the offset differences -> array typecode
+DELTA_TYPECODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+
+def get_key_hash(flow_key):
+    """ Get the directory hash of a flow key
+
+    Args:
+        flow_key (bytes): canonical flow key
+
+    Returns:
+        int: 64 bits hash
+    """
+    return int.from_bytes(hashlib.blake2b(flow_key, digest_size=8).digest(), 'little')
+
+
+def get_little_endian_bytes(values):
+    """ Get bytes of an array in little endian order
+
+    Args:
+        values (array): array
+
+    Returns:
+        bytes: array bytes
+    """
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def encode_offsets(offsets):
+    """ Delta encode increasing record offsets
+
+    Args:
+        offsets (array): record offsets of a flow
+
+    Returns:
+        tuple: width of the differences and their bytes
+    """
+    deltas = [offset - previous_offset for previous_offset, offset in zip(offsets, offsets[1:])]
+    max_delta = max(deltas, default=0)
+    width = 1 if max_delta <= 0xff else 2 if max_delta <= 0xffff else 4 if max_delta <= 0xffffffff else 8
+    return width, get_little_endian_bytes(array(DELTA_TYPECODES[width], deltas))
+
+
+class FlowIndex:
+    """ Builder of the flow index of one capture file
+    """
+
+    def __init__(self, fallback_decoder=None):
+        # flow key -> record offsets in the order they were read
+        self.flows = {}
+        # decoder of the encapsulations the fast parser leaves to dpkt, like Worker.decode_packet
+        self.fallback_decoder = fallback_decoder
+        self.capture_path = None
+        self.capture_size = 0
+        self.capture_mtime_ns = 0
+        self.header_block_offsets = []
+
+    def add_packet(self, record_offset, packet_payload):
+        """ Add the record of a packet to the offsets of its flow
+
+        Args:
+            record_offset (int): offset of the record in the capture file, PcapReader.record_offset
+            packet_payload (bytes): packet bytes
+        """
+        decoded_packet = fast_parser.decode_packet(packet_payload, True)
+        if decoded_packet is fast_parser.FALLBACK:
+            if self.fallback_decoder is None:
+                return
+            decoded_packet = self.fallback_decoder(packet_payload)
+        if not isinstance(decoded_packet, tuple):
+            return
+        flow_key, _ = FiveTuple.get_flow_key(*decoded_packet[:5])
+        offsets = self.flows.get(flow_key)
+        if offsets is None:
+            offsets = self.flows[flow_key] = array('Q')
+        offsets.append(record_offset)
+
+    def finish_capture(self, pcap_file_name, pcap):
+        """ Record the capture file the offsets belong to, called once every record is read
+
+        Args:
+            pcap_file_name (string): capture path
+            pcap (PcapReader): reader of the capture
+        """
+        capture_stat = os.stat(pcap_file_name)
+        self.capture_path = os.path.abspath(pcap_file_name)
+        self.capture_size = capture_stat.st_size
+        self.capture_mtime_ns = capture_stat.st_mtime_ns
+        self.header_block_offsets = list(pcap.header_block_offsets)
+
+    def save(self, path):
+        """ Write the index file, the file is replaced at once
+
+        Args:
+            path (string): index file path
+        """
+        encoded_path = self.capture_path.encode('utf-8')
+        header_block_offsets = get_little_endian_bytes(array('Q', self.header_block_offsets))
+        entries_offset = (HEADER.size + len(encoded_path) + len(header_block_offsets) +
+                          len(self.flows) * DIRECTORY_ENTRY.size)
+        directory = []
+        entries = []
+        for flow_key, offsets in self.flows.items():
+            width, deltas = encode_offsets(offsets)
+            directory.append((get_key_hash(flow_key), entries_offset))
+            entry = ENTRY.pack(len(flow_key), width, len(offsets), offsets[0]) + flow_key + deltas
+            entries.append(entry)
+            entries_offset += len(entry)
+        directory.sort()
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as index_file:
+            index_file.write(HEADER.pack(MAGIC, VERSION, len(encoded_path), self.capture_size, self.capture_mtime_ns,
+                                         len(self.header_block_offsets), len(self.flows)))
+            index_file.write(encoded_path)
+            index_file.write(header_block_offsets)
+            index_file.write(b''.join(DIRECTORY_ENTRY.pack(*directory_entry) for directory_entry in directory))
+            index_file.write(b''.join(entries))
+        os.replace(temporary_path, path)
+
+
+class FlowIndexReader:
+    """ Read flows of an index file from a memory mapping
+
+    Usage:
+        with FlowIndexReader(index_path) as flow_index:
+            flow_index.extract(flow_keys, output_path)
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        try:
+            self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file can not be mapped
+            self.file.close()
+            raise ValueError(f'invalid flow index file: {path}')
+        if len(self.mapping) < HEADER.size:
+            self.close()
+            raise ValueError(f'invalid flow index file: {path}')
+        (magic, version, path_length, self.capture_size, self.capture_mtime_ns, header_blocks_count,
+         self.flows_count) = HEADER.unpack_from(self.mapping)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f'invalid flow index file: {path}')
+        if version != VERSION:
+            self.close()
+            raise ValueError(f'unsupported flow index version {version}: {path}')
+        offset = HEADER.size
+        self.capture_path = self.mapping[offset:offset + path_length].decode('utf-8')
+        offset += path_length
+        self.header_block_offsets = self.read_array('Q', offset, header_blocks_count)
+        self.directory_offset = offset + header_blocks_count * 8
+        if self.directory_offset + self.flows_count * DIRECTORY_ENTRY.size > len(self.mapping):
+            self.close()
+            raise ValueError(f'truncated flow index file: {path}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.mapping.close()
+        self.file.close()
+
+    def read_array(self, typecode, offset, count):
+        values = array(typecode)
+        values.frombytes(self.mapping[offset:offset + count * values.itemsize])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def get_record_offsets(self, flow_key):
+        """ Get record offsets of a flow
+
+        Args:
+            flow_key (bytes): canonical flow key
+
+        Returns:
+            list: increasing record offsets, None if the flow is not in the index
+        """
+        key_hash = get_key_hash(flow_key)
+        mapping = self.mapping
+        directory_offset = self.directory_offset
+        unpack_directory_entry = DIRECTORY_ENTRY.unpack_from
+        # first directory entry whose hash is not below key_hash
+        low, high = 0, self.flows_count
+        while low < high:
+            middle = (low + high) // 2
+            if unpack_directory_entry(mapping, directory_offset + middle * DIRECTORY_ENTRY.size)[0] < key_hash:
+                low = middle + 1
+            else:
+                high = middle
+        # keys whose hashes collide are next to each other
+        for position in range(low, self.flows_count):
+            entry_hash, entry_offset = unpack_directory_entry(mapping, directory_offset + position * DIRECTORY_ENTRY.size)
+            if entry_hash != key_hash:
+                break
+            key_length, width, packets_count, first_offset = ENTRY.unpack_from(mapping, entry_offset)
+            key_offset = entry_offset + ENTRY.size
+            if mapping[key_offset:key_offset + key_length] != flow_key:
+                continue
+            deltas = self.read_array(DELTA_TYPECODES[width], key_offset + key_length, packets_count - 1)
+            return list(itertools.accumulate(deltas, initial=first_offset))
+        return None
+
+    def extract(self, flow_keys, output_path, capture_path=None):
+        """ Write the records of some flows to a new capture, in the format of the indexed capture
+
+        Args:
+            flow_keys (iterable): canonical flow keys
+            output_path (string): capture file path, the file is replaced at once
+            capture_path (string, optional): copy of the indexed capture at another path. Defaults to None.
+
+        Raises:
+            ValueError: capture file is not the one that was indexed
+
+        Returns:
+            tuple: number of records written and flow keys that are not in the index
+        """
+        offsets_of_flows = []
+        missing_flow_keys = []
+        for flow_key in flow_keys:
+            offsets = self.get_record_offsets(flow_key)
+            if offsets is None:
+                missing_flow_keys.append(flow_key)
+            else:
+                offsets_of_flows.append(offsets)
+        # a flow given twice is written once
+        record_offsets = sorted(set(itertools.chain.from_iterable(offsets_of_flows)))
+        if capture_path is None:
+            capture_path = self.capture_path
+            is_changed = os.stat(capture_path).st_mtime_ns != self.capture_mtime_ns
+        else:
+            # copies do not keep the modification time
+            is_changed = False
+        if is_changed or os.path.getsize(capture_path) != self.capture_size:
+            raise ValueError(f'capture file changed since it was indexed: {capture_path}')
+        temporary_path = output_path + '.tmp'
+        with PcapReader(capture_path) as pcap, open(temporary_path, 'wb') as output_file:
+            view = pcap.view
+            magic = bytes(view[:4])
+            if magic in PCAP_MAGIC_NUMBERS:
+                # records are copied with their header, after the global header of the capture
+                unpack_captured_length = struct.Struct(PCAP_MAGIC_NUMBERS[magic][0] + 'I').unpack_from
+                output_file.write(view[:PCAP_GLOBAL_HEADER_LENGTH])
+                for record_offset in record_offsets:
+                    captured_length, = unpack_captured_length(view, record_offset + 8)
+                    output_file.write(view[record_offset:record_offset + PCAP_RECORD_HEADER_LENGTH + captured_length])
+            else:
+                # packet blocks are copied after the section header and interface description blocks before them,
+                # so interface ids keep their meaning
+                byte_order = '<'
+                for block_offset in heapq.merge(self.header_block_offsets, record_offsets):
+                    block_type, = struct.unpack_from('<I', view, block_offset)
+                    if block_type == PCAPNG_SECTION_HEADER_BLOCK:
+                        byte_order_magic, = struct.unpack_from('<I', view, block_offset + 8)
+                        byte_order = '<' if byte_order_magic == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                    block_length, = struct.unpack_from(byte_order + 'I', view, block_offset + 4)
+                    output_file.write(view[block_offset:block_offset + block_length])
+        os.replace(temporary_path, output_path)
+        return len(record_offsets), missing_flow_keys
@@ -1,5 +1,8 @@
 class FlowStats():
 
+    # attributes are stored in Flow __slots__
+    __slots__ = ()
+
     def __init__(self):
         # Initialize flow stats parameters
         self.sent_packets_count = 0
@@ -8,6 +11,10 @@ class FlowStats():
         self.recieved_bytes_count = 0
         self.flow_start_time = 0
         self.flow_last_time = 0
+        # packets are counted this many times by sampling workers, see my_dpi.sampling
+        self.sampling_weight = 1
+        # sum of weight * (weight - 1) of the packets counted by update_sampled_stats
+        self.sampling_variance = 0
 
     def get_total_packets_count(self):
         """ Return totol number of flow packets
@@ -53,3 +60,22 @@ class FlowStats():
             # Check if packet is from server and update recieved packets and bytes status
             self.recieved_packets_count += 1
             self.recieved_bytes_count += len(packet.packet_data)
+
+    def update_sampled_stats(self, packet, weight):
+        """ Update flow stats parameters with a packet that stands for weight packets
+
+        Args:
+            packet (Packet): application packet instance of Packet class
+            weight (float): inverse of the rate the packet was sampled with
+        """
+        # variance of the Horvitz-Thompson estimate of one packet
+        self.sampling_variance += weight * (weight - 1)
+        self.flow_last_time = packet.packet_timestamp
+        if self.get_total_packets_count() == 0:
+            self.flow_start_time = packet.packet_timestamp
+        if packet.is_packet_from_client:
+            self.sent_packets_count += weight
+            self.sent_bytes_count += weight * len(packet.packet_data)
+        else:
+            self.recieved_packets_count += weight
+            self.recieved_bytes_count += weight * len(packet.packet_data)
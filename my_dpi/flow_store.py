@@ -0,0 +1,288 @@
+""" SQLite flow store
+
+Flows are written to a flows table whose columns are the FiveTuple,
+FlowStats and DetectionState attributes of Flow, plus the reason the flow
+left the flow table. Addresses are stored as their packed bytes, so a
+network is a range of the address index. Rows are buffered and inserted
+with one prepared statement in large transactions, the database is in WAL
+mode, so queries of another process can read it while flows are written.
+
+Indexes on addresses, ports and protocol label are followed by the
+start time, so the usual questions ("QUIC flows to X between T1 and T2")
+are answered by one index range scan. A new database gets its indexes when
+the store is closed, building them once is faster than updating them for
+every batch; a database that already has them keeps updating them.
+"""
+import time
+import sqlite3
+import ipaddress
+import urllib.parse
+from my_dpi.flow import Flow
+from my_dpi.flow_table import FlowTable
+from my_dpi.detection_state import DetectionState
+
+
+# FiveTuple, FlowStats and DetectionState attributes, in column order
+FLOW_COLUMNS = (
+    'src_ip', 'dst_ip', 'payload_type', 'src_port', 'dst_port', 'client_endpoint_is_lower',
+    'sent_packets_count', 'recieved_packets_count', 'sent_bytes_count', 'recieved_bytes_count',
+    'flow_start_time', 'flow_last_time',
+    'protocol', 'inspection_state', 'server_name', 'application_protocols',
+)
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS flows (
+    id INTEGER PRIMARY KEY,
+    src_ip BLOB NOT NULL,
+    dst_ip BLOB NOT NULL,
+    payload_type INTEGER NOT NULL,
+    src_port INTEGER NOT NULL,
+    dst_port INTEGER NOT NULL,
+    client_endpoint_is_lower INTEGER NOT NULL,
+    sent_packets_count INTEGER NOT NULL,
+    recieved_packets_count INTEGER NOT NULL,
+    sent_bytes_count INTEGER NOT NULL,
+    recieved_bytes_count INTEGER NOT NULL,
+    flow_start_time REAL NOT NULL,
+    flow_last_time REAL NOT NULL,
+    protocol TEXT NOT NULL,
+    inspection_state TEXT NOT NULL,
+    server_name TEXT,
+    application_protocols TEXT,
+    reason TEXT NOT NULL
+)
+'''
+INDEXES = (
+    'CREATE INDEX IF NOT EXISTS flows_src_ip ON flows (src_ip, flow_start_time)',
+    'CREATE INDEX IF NOT EXISTS flows_dst_ip ON flows (dst_ip, flow_start_time)',
+    'CREATE INDEX IF NOT EXISTS flows_src_port ON flows (src_port, flow_start_time)',
+    'CREATE INDEX IF NOT EXISTS flows_dst_port ON flows (dst_port, flow_start_time)',
+    'CREATE INDEX IF NOT EXISTS flows_protocol ON flows (protocol, flow_start_time)',
+    'CREATE INDEX IF NOT EXISTS flows_start_time ON flows (flow_start_time)',
+)
+INSERT = (f'INSERT INTO flows ({", ".join(FLOW_COLUMNS)}, reason) '
+          f'VALUES ({", ".join("?" * (len(FLOW_COLUMNS) + 1))})')
+# separator of ALPN protocols in their column
+ALPN_SEPARATOR = ','
+
+# stored inspection states are read back as the state constants, is_inspecting checks identity
+STATES = {state: state for state in (DetectionState.PENDING, DetectionState.CLASSIFIED, DetectionState.GAVE_UP)}
+
+
+def get_address_range(network):
+    """ Get the first and last packed address of a network, or of a single address
+
+    Args:
+        network (string): address or network like 10.0.0.0/8
+
+    Raises:
+        ValueError: network is not valid
+
+    Returns:
+        tuple: first and last packed address, and the address length
+    """
+    network = ipaddress.ip_network(network, strict=False)
+    return network.network_address.packed, network.broadcast_address.packed, len(network.network_address.packed)
+
+
+def get_address_condition(column, network):
+    """ Get condition of an address column in a network
+
+    Args:
+        column (string): src_ip or dst_ip
+        network (string): address or network like 10.0.0.0/8
+
+    Raises:
+        ValueError: network is not valid
+
+    Returns:
+        tuple: condition and its parameters
+    """
+    first_address, last_address, address_length = get_address_range(network)
+    if first_address == last_address:
+        # an equality leaves the start time of the index for the time range
+        return f'{column} = ?', (first_address,)
+    # blobs are compared byte by byte, IPv6 addresses that start with the bytes of an IPv4 range are not in it
+    return f'({column} BETWEEN ? AND ? AND length({column}) = ?)', (first_address, last_address, address_length)
+
+
+class FlowStore:
+    """ Writer and reader of a flow database, usable as a flow exporter
+    """
+
+    def __init__(self, path, batch_size=65536, flush_interval=1.0, read_only=False):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.read_only = read_only
+        self.rows = []
+        self.next_flush_time = time.monotonic() + flush_interval
+        # flows written by this store
+        self.flows_count = 0
+        if read_only:
+            # queries never create the database, its schema or its indexes
+            self.connection = sqlite3.connect(f'file:{urllib.parse.quote(path)}?mode=ro', uri=True)
+            return
+        # transactions are opened explicitly by flush
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # a crash may lose the last transactions but can not corrupt the database
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA cache_size=-65536')
+        self.connection.execute(SCHEMA)
+        # indexes of a new database are created by close
+        self.has_indexes = self.connection.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'index' AND tbl_name = 'flows'").fetchone()[0] > 0
+
+    def export_flow(self, flow, reason=FlowTable.END_OF_CAPTURE):
+        """ Buffer a flow row, usable as FlowTable expired_flow_callback
+
+        Args:
+            flow (Flow): flow
+            reason (string, optional): why the flow left the flow table. Defaults to FlowTable.END_OF_CAPTURE.
+        """
+        application_protocols = flow.application_protocols
+        self.rows.append((
+            flow.src_ip,
+            flow.dst_ip,
+            flow.payload_type,
+            flow.src_port,
+            flow.dst_port,
+            flow.client_endpoint_is_lower,
+            flow.sent_packets_count,
+            flow.recieved_packets_count,
+            flow.sent_bytes_count,
+            flow.recieved_bytes_count,
+            flow.flow_start_time,
+            flow.flow_last_time,
+            flow.protocol,
+            flow.inspection_state,
+            flow.server_name,
+            ALPN_SEPARATOR.join(application_protocols) if application_protocols is not None else None,
+            reason,
+        ))
+        if len(self.rows) >= self.batch_size or time.monotonic() >= self.next_flush_time:
+            self.flush()
+
+    def flush(self):
+        """ Insert buffered rows in one transaction
+        """
+        if self.rows:
+            connection = self.connection
+            connection.execute('BEGIN')
+            # one prepared statement for every row of the batch
+            connection.executemany(INSERT, self.rows)
+            connection.execute('COMMIT')
+            self.flows_count += len(self.rows)
+            self.rows = []
+        self.next_flush_time = time.monotonic() + self.flush_interval
+
+    def close(self):
+        """ Insert buffered rows, create the indexes of a new database and close it
+        """
+        if self.read_only:
+            self.connection.close()
+            return
+        self.flush()
+        if not self.has_indexes:
+            for index in INDEXES:
+                self.connection.execute(index)
+            self.connection.execute('ANALYZE')
+        self.connection.close()
+
+    def query(self, **conditions):
+        """ Get flows that match every given condition, ordered by start time
+
+        Args:
+            conditions: arguments of get_query_statement
+
+        Raises:
+            ValueError: an address or network is not valid
+
+        Returns:
+            list: (flow, reason) list
+        """
+        statement, parameters = FlowStore.get_query_statement(**conditions)
+        return [FlowStore.get_flow(row) for row in self.connection.execute(statement, parameters)]
+
+    @staticmethod
+    def get_query_statement(protocol=None, host=None, src=None, dst=None, port=None, server_name=None,
+                            start_time=None, end_time=None, limit=None):
+        """ Get the SELECT statement of flows that match every given condition
+
+        Args:
+            protocol (string, optional): protocol label. Defaults to None.
+            host (string, optional): address or network of either endpoint. Defaults to None.
+            src (string, optional): address or network of the client. Defaults to None.
+            dst (string, optional): address or network of the server. Defaults to None.
+            port (int, optional): port of either endpoint. Defaults to None.
+            server_name (string, optional): TLS/QUIC server name. Defaults to None.
+            start_time (float, optional): flows that started at or after this time. Defaults to None.
+            end_time (float, optional): flows that started at or before this time. Defaults to None.
+            limit (int, optional): maximum number of flows. Defaults to None.
+
+        Raises:
+            ValueError: an address or network is not valid
+
+        Returns:
+            tuple: statement and its parameters
+        """
+        conditions = []
+        parameters = []
+        for column, network in (('src_ip', src), ('dst_ip', dst)):
+            if network is not None:
+                condition, condition_parameters = get_address_condition(column, network)
+                conditions.append(condition)
+                parameters += condition_parameters
+        if host is not None:
+            src_condition, condition_parameters = get_address_condition('src_ip', host)
+            dst_condition, _ = get_address_condition('dst_ip', host)
+            # two ranges, SQLite answers them with the two address indexes
+            conditions.append(f'({src_condition} OR {dst_condition})')
+            parameters += condition_parameters * 2
+        if port is not None:
+            conditions.append('(src_port = ? OR dst_port = ?)')
+            parameters += (port, port)
+        for column, value in (('protocol', protocol), ('server_name', server_name)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                parameters.append(value)
+        if start_time is not None:
+            conditions.append('flow_start_time >= ?')
+            parameters.append(start_time)
+        if end_time is not None:
+            conditions.append('flow_start_time <= ?')
+            parameters.append(end_time)
+        statement = f'SELECT {", ".join(FLOW_COLUMNS)}, reason FROM flows'
+        if conditions:
+            statement += ' WHERE ' + ' AND '.join(conditions)
+        statement += ' ORDER BY flow_start_time'
+        if limit is not None:
+            statement += ' LIMIT ?'
+            parameters.append(limit)
+        return statement, parameters
+
+    @staticmethod
+    def get_flow(row):
+        """ Create the flow of a row
+
+        Args:
+            row (tuple): FLOW_COLUMNS values and reason
+
+        Returns:
+            tuple: flow and reason
+        """
+        # slots are set directly, like flows of a checkpoint
+        flow = Flow.__new__(Flow)
+        for column, value in zip(FLOW_COLUMNS, row):
+            setattr(flow, column, value)
+        flow.payload_type = bool(flow.payload_type)
+        flow.client_endpoint_is_lower = bool(flow.client_endpoint_is_lower)
+        flow.inspection_state = STATES.get(flow.inspection_state, DetectionState.GAVE_UP)
+        if flow.application_protocols is not None:
+            flow.application_protocols = tuple(flow.application_protocols.split(ALPN_SEPARATOR))
+        flow.inspection_callback = None
+        flow.inspection_budget = 0
+        flow.inspection_direction = None
+        flow.sampling_weight = 1
+        flow.sampling_variance = 0
+        return flow, row[-1]
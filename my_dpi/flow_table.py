@@ -0,0 +1,177 @@
+from collections import OrderedDict
+
+
+class FlowTable:
+    """ Flow table with idle/active timeouts and a maximum number of flows
+
+    Timeouts are driven by packet timestamps. Flows are kept in least recently
+    seen order, so idle flows and flows evicted by max_flows are always at the
+    front of the table. Every flow removed from the table is passed to
+    expired_flow_callback(flow, reason) as soon as it expires.
+    Without timeouts and max_flows it behaves like a plain dictionary.
+    """
+
+    # reasons passed to expired_flow_callback
+    IDLE_TIMEOUT = 'idle'
+    ACTIVE_TIMEOUT = 'active'
+    EVICTED = 'evicted'
+    END_OF_CAPTURE = 'end'
+
+    def __init__(self, idle_timeout=None, active_timeout=None, max_flows=None, expired_flow_callback=None):
+        self.idle_timeout = idle_timeout
+        self.active_timeout = active_timeout
+        self.max_flows = max_flows
+        self.expired_flow_callback = expired_flow_callback
+        # flows in least recently seen order when lru is True, otherwise in creation order
+        self.flows = OrderedDict()
+        self.lru = idle_timeout is not None or max_flows is not None
+        # key -> flow in creation order, only used for active timeout,
+        # flows leave it when they leave the table so it never holds more than max_flows flows
+        self.flows_by_start_time = OrderedDict()
+        # True if expire has something to do
+        self.expiring = idle_timeout is not None or active_timeout is not None
+
+    def __len__(self):
+        return len(self.flows)
+
+    def __contains__(self, key):
+        return key in self.flows
+
+    def __getitem__(self, key):
+        return self.flows[key]
+
+    def __iter__(self):
+        return iter(self.flows)
+
+    def get(self, key, default=None):
+        return self.flows.get(key, default)
+
+    def keys(self):
+        return self.flows.keys()
+
+    def values(self):
+        return self.flows.values()
+
+    def items(self):
+        return self.flows.items()
+
+    def lookup(self, key):
+        """ Get flow of key and mark it as the most recently seen one
+
+        Args:
+            key (bytes): flow key
+
+        Returns:
+            Flow: flow, None if key is not in the table
+        """
+        if self.lru:
+            try:
+                self.flows.move_to_end(key)
+            except KeyError:
+                return None
+        return self.flows.get(key)
+
+    def add(self, key, flow):
+        """ Add a new flow, key must not be in the table
+            adding a flow above max_flows evicts the least recently seen flow
+
+        Args:
+            key (bytes): flow key
+            flow (Flow): flow
+        """
+        flows = self.flows
+        flows[key] = flow
+        if self.active_timeout is not None:
+            self.flows_by_start_time[key] = flow
+        if self.max_flows is not None and len(flows) > self.max_flows:
+            evicted_key, evicted_flow = flows.popitem(last=False)
+            self.flows_by_start_time.pop(evicted_key, None)
+            self.export_flow(evicted_flow, FlowTable.EVICTED)
+
+    def __setitem__(self, key, flow):
+        """ Add a new flow or mark an existing flow as the most recently seen one
+            adding a flow above max_flows evicts the least recently seen flow
+
+        Args:
+            key (bytes): flow key
+            flow (Flow): flow
+        """
+        flows = self.flows
+        if key not in flows:
+            self.add(key, flow)
+            return
+        if self.lru:
+            flows.move_to_end(key)
+        flows[key] = flow
+        if key in self.flows_by_start_time:
+            self.flows_by_start_time[key] = flow
+
+    def pop(self, key):
+        self.flows_by_start_time.pop(key, None)
+        return self.flows.pop(key)
+
+    def expire(self, timestamp):
+        """ Remove and export flows whose idle or active timeout passed
+
+        Args:
+            timestamp (float): current packet timestamp
+        """
+        flows = self.flows
+        if self.idle_timeout is not None:
+            deadline = timestamp - self.idle_timeout
+            while flows:
+                key = next(iter(flows))
+                flow = flows[key]
+                if flow.flow_last_time > deadline:
+                    break
+                del flows[key]
+                self.flows_by_start_time.pop(key, None)
+                self.export_flow(flow, FlowTable.IDLE_TIMEOUT)
+        if self.active_timeout is not None:
+            deadline = timestamp - self.active_timeout
+            flows_by_start_time = self.flows_by_start_time
+            while flows_by_start_time:
+                key = next(iter(flows_by_start_time))
+                flow = flows_by_start_time[key]
+                if flow.flow_start_time > deadline:
+                    break
+                del flows_by_start_time[key]
+                del flows[key]
+                self.export_flow(flow, FlowTable.ACTIVE_TIMEOUT)
+
+    def get_oldest_times(self):
+        """ Get the times expire compares with the timeouts, a packet expires a flow
+            when its timestamp minus a timeout reaches the time of that timeout
+
+        Returns:
+            tuple: last time of the least recently seen flow and start time of the oldest flow,
+                None for a timeout that is not set or a table without flows
+        """
+        flows = self.flows
+        oldest_last_time = None
+        if self.idle_timeout is not None and flows:
+            oldest_last_time = flows[next(iter(flows))].flow_last_time
+        oldest_start_time = None
+        flows_by_start_time = self.flows_by_start_time
+        if flows_by_start_time:
+            oldest_start_time = flows_by_start_time[next(iter(flows_by_start_time))].flow_start_time
+        return oldest_last_time, oldest_start_time
+
+    def flush(self):
+        """ Remove and export every flow, used at the end of capture
+        """
+        flows = self.flows
+        self.flows = OrderedDict()
+        self.flows_by_start_time = OrderedDict()
+        for flow in flows.values():
+            self.export_flow(flow, FlowTable.END_OF_CAPTURE)
+
+    def export_flow(self, flow, reason):
+        """ Pass a flow that left the table to expired_flow_callback
+
+        Args:
+            flow (Flow): expired flow
+            reason (string): why the flow expired
+        """
+        if self.expired_flow_callback is not None:
+            self.expired_flow_callback(flow, reason)
@@ -0,0 +1,254 @@
+""" Runtime metrics of the packet pipeline
+
+Packets and bytes of every stage, dropped packets by reason, signature
+counters and flow table gauges are counted for every packet. Stage timings
+are sampled on one packet out of timing_interval, so measuring them costs a
+few perf_counter calls per thousand packets. Metrics are written every
+export_interval seconds, and at the end of the capture, as a JSON file and a
+Prometheus text format file that can be read by the node exporter textfile
+collector. Exports are due on sampled packets, packets dropped by the packet
+filter included, and the report stage of a stream exports them while no
+packet arrives.
+"""
+import os
+import json
+import time
+
+
+def escape_label_value(value):
+    """ Escape a Prometheus label value
+
+    Args:
+        value (string): label value
+
+    Returns:
+        string: value with backslashes, double quotes and line feeds escaped
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    # stages of Worker.process_packet
+    DECODE = 'decode'
+    FLOW_LOOKUP = 'flow_lookup'
+    STATS_UPDATE = 'stats_update'
+    INSPECTION = 'inspection'
+    STAGES = (DECODE, FLOW_LOOKUP, STATS_UPDATE, INSPECTION)
+    # drop reason of packets that do not match the packet filter
+    FILTERED = 'filtered'
+
+    def __init__(self, path_prefix, export_interval=10.0, timing_interval=64):
+        # metrics are written to path_prefix.json and path_prefix.prom
+        self.path_prefix = path_prefix
+        self.export_interval = export_interval
+        self.timing_interval = timing_interval
+        self.packets_until_timing = timing_interval
+        # packets and bytes counted by Worker.process_packet_with_metrics as plain attributes,
+        # flow lookup and stats update stages see the same decoded packets
+        self.packets_count = 0
+        self.bytes_count = 0
+        self.decoded_packets_count = 0
+        self.decoded_bytes_count = 0
+        self.inspected_packets_count = 0
+        self.inspected_bytes_count = 0
+        # sampled timings: number of samples and their total seconds
+        self.stage_samples = dict.fromkeys(Metrics.STAGES, 0)
+        self.stage_seconds = dict.fromkeys(Metrics.STAGES, 0.0)
+        # fast_parser drop reason -> packets
+        self.dropped_packets = {}
+        self.flows_created_count = 0
+        self.flow_table = None
+        self.my_dpi = None
+        self.start_time = time.monotonic()
+        self.next_export_time = self.start_time + export_interval
+        # flows created count and time of the previous export, for the creation rate
+        self.last_export_flows_created_count = 0
+        self.last_export_time = self.start_time
+
+    def attach(self, flow_table, my_dpi):
+        """ Read gauges of a flow table and signature counters of a MyDpi
+
+        Args:
+            flow_table (FlowTable): flow table
+            my_dpi (MyDpi): DPI instance, signature callbacks are timed from now on
+        """
+        self.flow_table = flow_table
+        self.my_dpi = my_dpi
+        if my_dpi is not None:
+            my_dpi.udp_first_packet_signatures.callback_timing = True
+            my_dpi.tcp_first_packet_signatures.callback_timing = True
+
+    def start_timing(self):
+        """ Start the timing sample of a packet, called when packets_until_timing reaches 0
+            exports metrics when they are due
+
+        Returns:
+            float: perf_counter value at the start of the first stage
+        """
+        self.packets_until_timing = self.timing_interval
+        # the clock is only read on sampled packets
+        self.export_if_due()
+        return time.perf_counter()
+
+    def export_if_due(self):
+        """ Export metrics if export_interval passed since the previous export
+        """
+        if time.monotonic() >= self.next_export_time:
+            self.export()
+
+    def add_stage_time(self, stage, start_time):
+        """ Add a timing sample of a stage
+
+        Args:
+            stage (string): stage name
+            start_time (float): perf_counter value at the start of the stage
+
+        Returns:
+            float: perf_counter value at the end of the stage, the start of the next one
+        """
+        end_time = time.perf_counter()
+        self.stage_samples[stage] += 1
+        self.stage_seconds[stage] += end_time - start_time
+        return end_time
+
+    def count_drop(self, reason):
+        """ Count a packet that is not inspected
+
+        Args:
+            reason (string): fast_parser drop reason
+        """
+        self.dropped_packets[reason] = self.dropped_packets.get(reason, 0) + 1
+
+    def count_filtered_packet(self):
+        """ Count a packet dropped by the packet filter, filtered packets are sampled
+            like the others so a filter that drops most packets does not stop exports
+        """
+        self.dropped_packets[Metrics.FILTERED] = self.dropped_packets.get(Metrics.FILTERED, 0) + 1
+        self.packets_until_timing -= 1
+        if self.packets_until_timing <= 0:
+            self.packets_until_timing = self.timing_interval
+            self.export_if_due()
+
+    def get_snapshot(self):
+        """ Get every metric
+
+        Returns:
+            dict: metrics
+        """
+        now = time.monotonic()
+        elapsed_time = now - self.last_export_time
+        flows_created = self.flows_created_count - self.last_export_flows_created_count
+        stage_counts = {
+            Metrics.DECODE: (self.packets_count, self.bytes_count),
+            Metrics.FLOW_LOOKUP: (self.decoded_packets_count, self.decoded_bytes_count),
+            Metrics.STATS_UPDATE: (self.decoded_packets_count, self.decoded_bytes_count),
+            Metrics.INSPECTION: (self.inspected_packets_count, self.inspected_bytes_count),
+        }
+        stages = {}
+        for stage in Metrics.STAGES:
+            samples = self.stage_samples[stage]
+            stages[stage] = {
+                'packets': stage_counts[stage][0],
+                'bytes': stage_counts[stage][1],
+                'timing_samples': samples,
+                'sampled_seconds': self.stage_seconds[stage],
+                'seconds_per_packet': self.stage_seconds[stage] / samples if samples else None,
+            }
+        signatures = {}
+        endpoint_cache = {}
+        if self.my_dpi is not None:
+            signatures = self.my_dpi.get_signature_statistics()
+            if self.my_dpi.endpoint_cache is not None:
+                endpoint_cache = self.my_dpi.endpoint_cache.get_statistics()
+        return {
+            'uptime_seconds': now - self.start_time,
+            'stages': stages,
+            'dropped_packets': dict(self.dropped_packets),
+            'signatures': signatures,
+            'endpoint_cache': endpoint_cache,
+            'flow_table_flows': len(self.flow_table) if self.flow_table is not None else 0,
+            'flows_created': self.flows_created_count,
+            'flows_created_per_second': flows_created / elapsed_time if elapsed_time > 0 else 0.0,
+        }
+
+    def get_prometheus_text(self, snapshot):
+        """ Format a snapshot in Prometheus text exposition format
+
+        Args:
+            snapshot (dict): snapshot returned by get_snapshot
+
+        Returns:
+            string: metrics text
+        """
+        lines = []
+
+        def add_metric(name, metric_type, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{escape_label_value(label)}"' for key, label in labels)
+                lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+
+        stages = snapshot['stages']
+        add_metric('dpi_stage_packets_total', 'counter', 'Packets that went through a stage.',
+                   [((('stage', stage),), stages[stage]['packets']) for stage in stages])
+        add_metric('dpi_stage_bytes_total', 'counter', 'Bytes handled by a stage.',
+                   [((('stage', stage),), stages[stage]['bytes']) for stage in stages])
+        add_metric('dpi_stage_timing_samples_total', 'counter', 'Sampled timings of a stage.',
+                   [((('stage', stage),), stages[stage]['timing_samples']) for stage in stages])
+        add_metric('dpi_stage_sampled_seconds_total', 'counter', 'Seconds spent in a stage by sampled packets.',
+                   [((('stage', stage),), stages[stage]['sampled_seconds']) for stage in stages])
+        add_metric('dpi_dropped_packets_total', 'counter', 'Packets that are not inspected.',
+                   [((('reason', reason),), count) for reason, count in snapshot['dropped_packets'].items()])
+        signature_samples = {'tests': [], 'matches': [], 'detections': [], 'callback_seconds': []}
+        for payload_type, signatures_statistics in snapshot['signatures'].items():
+            for statistics in signatures_statistics:
+                labels = (('l4', payload_type), ('callback', statistics['callback']))
+                for key, samples in signature_samples.items():
+                    samples.append((labels, statistics[key]))
+        add_metric('dpi_signature_tests_total', 'counter', 'Regex searches of a signature.',
+                   signature_samples['tests'])
+        add_metric('dpi_signature_matches_total', 'counter', 'Regex matches of a signature.',
+                   signature_samples['matches'])
+        add_metric('dpi_signature_detections_total', 'counter', 'Flows classified by a signature callback.',
+                   signature_samples['detections'])
+        add_metric('dpi_signature_callback_seconds_total', 'counter', 'Seconds spent in a signature callback.',
+                   signature_samples['callback_seconds'])
+        endpoint_cache = snapshot['endpoint_cache']
+        if endpoint_cache:
+            add_metric('dpi_endpoint_cache_entries', 'gauge', 'Server endpoints in the endpoint cache.',
+                       [((), endpoint_cache['entries'])])
+            add_metric('dpi_endpoint_cache_lookups_total', 'counter', 'Endpoint cache lookups of new flows.',
+                       [((('result', 'hit'),), endpoint_cache['hits']),
+                        ((('result', 'miss'),), endpoint_cache['misses'])])
+        add_metric('dpi_flow_table_flows', 'gauge', 'Flows in the flow table.',
+                   [((), snapshot['flow_table_flows'])])
+        add_metric('dpi_flows_created_total', 'counter', 'Flows created.', [((), snapshot['flows_created'])])
+        add_metric('dpi_flows_created_per_second', 'gauge', 'Flows created per second since the previous export.',
+                   [((), snapshot['flows_created_per_second'])])
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        """ Write metrics files, files are replaced at once so readers never see a partial file
+        """
+        snapshot = self.get_snapshot()
+        # signature patterns are bytes, written with escaped non ASCII bytes
+        self.write_file(self.path_prefix + '.json', json.dumps(
+            snapshot, indent=2, default=lambda value: value.decode('ascii', 'backslashreplace')))
+        self.write_file(self.path_prefix + '.prom', self.get_prometheus_text(snapshot))
+        self.last_export_time = time.monotonic()
+        self.last_export_flows_created_count = self.flows_created_count
+        self.next_export_time = self.last_export_time + self.export_interval
+
+    @staticmethod
+    def write_file(path, text):
+        """ Write a file through a temporary file
+
+        Args:
+            path (string): file path
+            text (string): file content
+        """
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(text)
+        os.replace(temporary_path, path)
@@ -1,10 +1,17 @@
+# signatures read by my_dpi.plugin_registry without importing this module
+PROTOCOL = {
+    'class': 'Http',
+    'priority': 40,
+    'signatures': (
+        {'l4': 'tcp', 'pattern': rb'^(GET|POST|HEAD|PUT|DELETE|OPTIONS|TRACE) .{0,5000}HTTP\/1\.(0|1)(|\x0d)\x0a',
+         'callback': 'callback_function', 'ports': (80, 8000, 8008, 8080, 3128)},
+    ),
+}
+
+
 class Http:
     def __init__(self, my_dpi):
         self.http_label = 'HTTP'
-        my_dpi.register_tcp_first_packet_callback(
-            rb'^(GET|POST|HEAD|PUT|DELETE|OPTIONS|TRACE) .{0,5000}HTTP\/1\.(0|1)(|\x0d)\x0a',
-            self.callback_function
-        )
 
     def callback_function(self, flow, application_packet):
         flow.set_protocol(self.http_label)
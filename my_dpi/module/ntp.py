@@ -1,10 +1,20 @@
+import functools
+
+
+# signatures read by my_dpi.plugin_registry without importing this module
+PROTOCOL = {
+    'class': 'Ntp',
+    'priority': 20,
+    'signatures': (
+        {'l4': 'udp', 'pattern': br'^.{12}\x00{4}', 'callback': 'callback_function',
+         'ports': (123,), 'min_length': 48},
+    ),
+}
+
+
 class Ntp:
     def __init__(self, my_dpi):
         self.ntp_label = 'NTP'
-        my_dpi.register_udp_first_packet_callback(
-            br'^.{12}\x00{4}',
-            self.callback_function
-        )
 
     def callback_function(self, flow, application_packet):
         flow_dst_port = flow.get_five_tuple()[4]
@@ -12,3 +22,15 @@ class Ntp:
         if (application_packet.packet_data[0] & 56 >> 3) < 4:
             if flow_dst_port == expected_dst_port:
                 flow.set_protocol(self.ntp_label)
+            elif application_packet.packet_data[0] & 7 == 3 and len(application_packet.packet_data) >= 48:
+                # client request to another port, the server reply decides
+                transmit_timestamp = bytes(application_packet.packet_data[40:48])
+                flow.request_more_packets(
+                    functools.partial(self.reply_callback, transmit_timestamp), 2, from_client=False)
+
+    def reply_callback(self, transmit_timestamp, flow, application_packet):
+        application_packet_data = application_packet.packet_data
+        # server reply carries the transmit timestamp of the request as its originate timestamp
+        if len(application_packet_data) >= 48 and application_packet_data[0] & 7 == 4:
+            if application_packet_data[24:32] == transmit_timestamp:
+                flow.set_protocol(self.ntp_label)
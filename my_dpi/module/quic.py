@@ -1,3 +1,215 @@
+import sys
+import hmac
+import hashlib
+import functools
+from my_dpi.module.tls import parse_client_hello
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+
+# signatures read by my_dpi.plugin_registry without importing this module
+# The payload of a UDP datagram carrying the Initial packet MUST be
+# expanded to at least 1200 octets (see Section 8), by adding PADDING
+# frames to the Initial packet and/or by combining the Initial packet
+# with a 0-RTT packet (see Section 4.6).
+# https://datatracker.ietf.org/doc/html/draft-ietf-quic-transport-13#section-4.4.1.4
+# Shorter payloads are not passed to the callbacks.
+PROTOCOL = {
+    'class': 'Quic',
+    'priority': 60,
+    'signatures': (
+        {'l4': 'udp', 'pattern': rb'^[\xc0-\xff]\x00{3}\x01', 'callback': 'callback_function',
+         'ports': (443,), 'min_length': 1200},
+        # long header of another version with a valid DCID length
+        {'l4': 'udp', 'pattern': rb'^[\xc0-\xff](?!\x00{3}\x01).{4}[\x00-\x14]',
+         'callback': 'version_negotiation_callback', 'ports': (443,), 'min_length': 1200},
+    ),
+}
+
+# message printed once per process when Initial packets can not be decrypted
+MISSING_CRYPTOGRAPHY_MESSAGE = ('warning: the cryptography package is not installed, QUIC Initial packets are not '
+                                'decrypted and QUIC flows have no server name and ALPN')
+missing_cryptography_reported = False
+
+# salt of the QUIC version 1 initial secret, https://datatracker.ietf.org/doc/html/rfc9001#section-5.2
+INITIAL_SALT_V1 = bytes.fromhex('38762cf7f55934b34d179ae6a4c80cadccbb7f0a')
+# frame types of client Initial packets
+PADDING_FRAME = 0x00
+PING_FRAME = 0x01
+ACK_FRAMES = (0x02, 0x03)
+CRYPTO_FRAME = 0x06
+
+
+def read_variable_length_integer(data, offset):
+    """ Read a QUIC variable length integer, its 2 most significant bits give its length
+
+    Args:
+        data (memoryview): packet data
+        offset (int): offset of the integer
+
+    Returns:
+        int, int: value and offset of the next field, None and offset if the integer is cut
+    """
+    if offset >= len(data):
+        return None, offset
+    length = 1 << (data[offset] >> 6)
+    if offset + length > len(data):
+        return None, offset
+    value = data[offset] & 0x3f
+    for index in range(offset + 1, offset + length):
+        value = (value << 8) | data[index]
+    return value, offset + length
+
+
+def expand_label(secret, label, length):
+    """ TLS 1.3 HKDF-Expand-Label with an empty context, length is at most one SHA-256 block
+
+    Args:
+        secret (bytes): pseudorandom key
+        label (bytes): label without the 'tls13 ' prefix
+        length (int): output length
+
+    Returns:
+        bytes: output keying material
+    """
+    full_label = b'tls13 ' + label
+    info = length.to_bytes(2, 'big') + bytes((len(full_label),)) + full_label + b'\x00'
+    return hmac.digest(secret, info + b'\x01', hashlib.sha256)[:length]
+
+
+def get_client_initial_keys(dcid):
+    """ Derive packet protection keys of client Initial packets from the client Destination Connection ID
+        https://datatracker.ietf.org/doc/html/rfc9001#section-5.2
+
+    Args:
+        dcid (bytes): Destination Connection ID of the first client Initial packet
+
+    Returns:
+        bytes, bytes, bytes: AEAD key, IV and header protection key
+    """
+    initial_secret = hmac.digest(INITIAL_SALT_V1, dcid, hashlib.sha256)
+    client_secret = expand_label(initial_secret, b'client in', 32)
+    return (expand_label(client_secret, b'quic key', 16),
+            expand_label(client_secret, b'quic iv', 12),
+            expand_label(client_secret, b'quic hp', 16))
+
+
+def decrypt_initial_packet(data, keys=None):
+    """ Remove header protection of a version 1 client Initial packet and decrypt its payload
+        https://datatracker.ietf.org/doc/html/rfc9001#section-5.4
+
+    Args:
+        data (memoryview): UDP payload starting with the Initial packet
+        keys (tuple, optional): keys returned by get_client_initial_keys, derived from the packet if None.
+            Defaults to None.
+
+    Returns:
+        bytes, tuple: decrypted frames and the keys, None and the keys if the packet can not be decrypted
+    """
+    # long header, fixed bit, Initial packet type and version 1
+    if len(data) < 7 or data[0] & 0xf0 != 0xc0 or data[1:5] != b'\x00\x00\x00\x01':
+        return None, keys
+    dcid_length = data[5]
+    offset = 6 + dcid_length
+    if offset >= len(data):
+        return None, keys
+    dcid = data[6:offset]
+    offset += 1 + data[offset]
+    token_length, offset = read_variable_length_integer(data, offset)
+    if token_length is None:
+        return None, keys
+    offset += token_length
+    payload_length, packet_number_offset = read_variable_length_integer(data, offset)
+    if payload_length is None or packet_number_offset + payload_length > len(data) or payload_length < 20:
+        return None, keys
+    if keys is None:
+        keys = get_client_initial_keys(bytes(dcid))
+    key, iv, header_protection_key = keys
+    # the sample starts 4 bytes after the packet number, whatever its length
+    sample = data[packet_number_offset + 4:packet_number_offset + 20]
+    encryptor = Cipher(algorithms.AES(header_protection_key), modes.ECB()).encryptor()
+    mask = encryptor.update(sample) + encryptor.finalize()
+    first_byte = data[0] ^ (mask[0] & 0x0f)
+    packet_number_length = (first_byte & 0x03) + 1
+    header = bytearray(data[:packet_number_offset + packet_number_length])
+    header[0] = first_byte
+    for index in range(packet_number_length):
+        header[packet_number_offset + index] ^= mask[1 + index]
+    packet_number = int.from_bytes(header[packet_number_offset:], 'big')
+    nonce = (int.from_bytes(iv, 'big') ^ packet_number).to_bytes(12, 'big')
+    try:
+        frames = AESGCM(key).decrypt(
+            nonce, bytes(data[packet_number_offset + packet_number_length:packet_number_offset + payload_length]),
+            bytes(header))
+    except ValueError:
+        return None, keys
+    return frames, keys
+
+
+def add_crypto_frames(frames, crypto_fragments):
+    """ Collect data of CRYPTO frames by offset, stops at the first frame type a client Initial does not use
+
+    Args:
+        frames (bytes): decrypted Initial packet payload
+        crypto_fragments (dict): offset -> CRYPTO frame bytes, updated in place
+    """
+    frames = memoryview(frames)
+    offset = 0
+    frames_length = len(frames)
+    while offset < frames_length:
+        frame_type = frames[offset]
+        if frame_type == PADDING_FRAME or frame_type == PING_FRAME:
+            offset += 1
+        elif frame_type == CRYPTO_FRAME:
+            crypto_offset, offset = read_variable_length_integer(frames, offset + 1)
+            crypto_length, offset = read_variable_length_integer(frames, offset)
+            if crypto_offset is None or crypto_length is None:
+                return
+            # fragments are kept by the continuation callback, copies do not hold the frames buffer
+            # and let pending flows be pickled
+            crypto_fragments[crypto_offset] = bytes(frames[offset:offset + crypto_length])
+            offset += crypto_length
+        elif frame_type in ACK_FRAMES:
+            # largest acknowledged, ack delay, range count, first range, then gap and length of every range
+            values = []
+            offset += 1
+            for _ in range(4):
+                value, offset = read_variable_length_integer(frames, offset)
+                if value is None:
+                    return
+                values.append(value)
+            fields_count = 2 * values[2] + (3 if frame_type == 0x03 else 0)
+            for _ in range(fields_count):
+                value, offset = read_variable_length_integer(frames, offset)
+                if value is None:
+                    return
+        else:
+            return
+
+
+def get_crypto_stream_prefix(crypto_fragments):
+    """ Join CRYPTO frame data that is contiguous from offset 0
+
+    Args:
+        crypto_fragments (dict): offset -> CRYPTO frame bytes
+
+    Returns:
+        memoryview: contiguous CRYPTO stream prefix
+    """
+    if len(crypto_fragments) == 1 and 0 in crypto_fragments:
+        return memoryview(crypto_fragments[0])
+    prefix = bytearray()
+    for crypto_offset in sorted(crypto_fragments):
+        if crypto_offset > len(prefix):
+            break
+        fragment = crypto_fragments[crypto_offset]
+        prefix += fragment[len(prefix) - crypto_offset:]
+    return memoryview(prefix)
+
+
 class Quic:
     ''' QUIC common header: long and short
     Long form packets are used for the initial exchange - 
@@ -207,23 +419,17 @@ class Quic:
     '''
 
     def __init__(self, my_dpi):
+        global missing_cryptography_reported
         self.quic_label = 'QUIC'
-        my_dpi.register_udp_first_packet_callback(
-            rb'^[\xc0-\xff]\x00{3}\x01',
-            self.callback_function
-        )
+        if AESGCM is None and not missing_cryptography_reported:
+            missing_cryptography_reported = True
+            print(MISSING_CRYPTOGRAPHY_MESSAGE, file=sys.stderr)
+        # ClientHello split over several Initial packets is read from the next
+        # packets of the flow, at most this many of them
+        self.continuation_packets_count = 6
 
     def callback_function(self, flow, application_packet):
         application_packet_data = application_packet.packet_data
-        '''
-        The payload of a UDP datagram carrying the Initial packet MUST be
-        expanded to at least 1200 octets (see Section 8), by adding PADDING
-        frames to the Initial packet and/or by combining the Initial packet
-        with a 0-RTT packet (see Section 4.6).
-        https://datatracker.ietf.org/doc/html/draft-ietf-quic-transport-13#section-4.4.1.4
-        '''
-        if len(application_packet_data) < 1200:
-            return
         # Long Header Check for first packet # Long: 1
         if not (application_packet_data[0] >> 7):
             return
@@ -233,4 +439,65 @@ class Quic:
             version and MUST be discarded.
             '''
             return
+        # SNI and ALPN are read from the ClientHello in the CRYPTO frames, Initial packets are
+        # only protected by keys derived from their DCID, cryptography is an optional dependency
+        if AESGCM is not None:
+            frames, keys = decrypt_initial_packet(memoryview(application_packet_data))
+            if frames is not None:
+                crypto_fragments = {}
+                add_crypto_frames(frames, crypto_fragments)
+                flow.server_name, flow.application_protocols, truncated = parse_client_hello(
+                    get_crypto_stream_prefix(crypto_fragments))
+                if truncated:
+                    flow.request_more_packets(
+                        functools.partial(self.initial_continuation_callback, keys, crypto_fragments),
+                        self.continuation_packets_count)
+                    return
+        flow.set_protocol(self.quic_label)
+
+    def initial_continuation_callback(self, keys, crypto_fragments, flow, application_packet):
+        if application_packet.is_packet_from_client:
+            frames, _ = decrypt_initial_packet(memoryview(application_packet.packet_data), keys)
+            if frames is not None:
+                add_crypto_frames(frames, crypto_fragments)
+                flow.server_name, flow.application_protocols, truncated = parse_client_hello(
+                    get_crypto_stream_prefix(crypto_fragments))
+                if not truncated:
+                    flow.set_protocol(self.quic_label)
+                    return
+        # the callback is cleared with the last packet of the budget, the flow is QUIC with the fields found so far
+        if flow.inspection_callback is None:
+            flow.set_protocol(self.quic_label)
+
+    def version_negotiation_callback(self, flow, application_packet):
+        application_packet_data = application_packet.packet_data
+        dcid_length = application_packet_data[5]
+        dcid = bytes(application_packet_data[6:6 + dcid_length])
+        scid_length = application_packet_data[6 + dcid_length]
+        scid = bytes(application_packet_data[7 + dcid_length:7 + dcid_length + scid_length])
+        # the version is unknown, the server Version Negotiation or Initial packet decides
+        flow.request_more_packets(
+            functools.partial(self.version_negotiation_reply_callback, dcid, scid), 4, from_client=False)
+
+    def version_negotiation_reply_callback(self, client_dcid, client_scid, flow, application_packet):
+        '''
+        Version Negotiation packet: long header with version 0x00000000, its
+        Destination Connection ID is the Source Connection ID of the client packet
+        and its Source Connection ID is the client Destination Connection ID.
+        A server that supports the version answers with a long header packet
+        sent to the client Source Connection ID as well.
+        https://datatracker.ietf.org/doc/html/rfc9000#section-17.2.1
+        '''
+        application_packet_data = application_packet.packet_data
+        if len(application_packet_data) < 7 or not (application_packet_data[0] >> 7):
+            return
+        dcid_length = application_packet_data[5]
+        if application_packet_data[6:6 + dcid_length] != client_scid:
+            return
+        if application_packet_data[1:5] == b'\x00' * 4:
+            scid_length = application_packet_data[6 + dcid_length:7 + dcid_length]
+            if scid_length != bytes((len(client_dcid),)):
+                return
+            if application_packet_data[7 + dcid_length:7 + dcid_length + len(client_dcid)] != client_dcid:
+                return
         flow.set_protocol(self.quic_label)
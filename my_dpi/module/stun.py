@@ -1,10 +1,40 @@
+import functools
+
+
+# signatures read by my_dpi.plugin_registry without importing this module
+PROTOCOL = {
+    'class': 'Stun',
+    'priority': 50,
+    'signatures': (
+        {'l4': 'udp', 'pattern': rb"^.{4}\x21\x12\xa4\x42", 'callback': 'callback_function',
+         'ports': (3478, 3479, 5349, 19302), 'min_length': 20},
+        # RFC 3489 binding request, without the magic cookie
+        {'l4': 'udp', 'pattern': rb"^\x00\x01.{18}", 'callback': 'classic_callback_function',
+         'ports': (3478, 3479)},
+    ),
+}
+
+
 class Stun:
     def __init__(self, my_dpi):
         self.stun_label = 'STUN'
-        my_dpi.register_udp_first_packet_callback(
-            rb"^.{4}\x21\x12\xa4\x42",
-            self.callback_function
-        )
 
     def callback_function(self, flow, application_packet):
         flow.set_protocol(self.stun_label)
+
+    def classic_callback_function(self, flow, application_packet):
+        application_packet_data = application_packet.packet_data
+        # message length does not count the 20 bytes header
+        if int.from_bytes(application_packet_data[2:4], 'big') != len(application_packet_data) - 20:
+            return
+        # the header is too weak alone, the server response must echo the transaction ID
+        transaction_id = bytes(application_packet_data[4:20])
+        flow.request_more_packets(
+            functools.partial(self.classic_response_callback, transaction_id), 4, from_client=False)
+
+    def classic_response_callback(self, transaction_id, flow, application_packet):
+        application_packet_data = application_packet.packet_data
+        # binding success or error response
+        if application_packet_data[:2] in (b'\x01\x01', b'\x01\x11'):
+            if application_packet_data[4:20] == transaction_id:
+                flow.set_protocol(self.stun_label)
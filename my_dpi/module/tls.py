@@ -1,10 +1,112 @@
+# signatures read by my_dpi.plugin_registry without importing this module
+PROTOCOL = {
+    'class': 'Tls',
+    'priority': 30,
+    'signatures': (
+        {'l4': 'tcp', 'pattern': rb'^\x16\x03[\x00-\x03].{2}\x01', 'callback': 'callback_function',
+         'ports': (443, 465, 853, 993, 995, 8443)},
+    ),
+}
+
+# ClientHello extensions read by parse_client_hello
+SERVER_NAME_EXTENSION = 0
+APPLICATION_LAYER_PROTOCOL_NEGOTIATION_EXTENSION = 16
+
+
+def parse_client_hello(handshake):
+    """ Read server name (SNI) and ALPN protocols of a ClientHello handshake message
+        fields are read in place, extensions are walked until both fields are found
+
+    ClientHello {
+        Handshake Type (8) = 1,
+        Length (24),
+        Legacy Version (16),
+        Random (256),
+        Legacy Session ID Length (8), Legacy Session ID (..),
+        Cipher Suites Length (16), Cipher Suites (..),
+        Legacy Compression Methods Length (8), Legacy Compression Methods (..),
+        Extensions Length (16),
+        Extensions (..): Extension Type (16), Extension Data Length (16), Extension Data (..),
+    }
+    https://datatracker.ietf.org/doc/html/rfc8446#section-4.1.2
+
+    Args:
+        handshake (memoryview): handshake messages, starting with the ClientHello type byte
+
+    Returns:
+        string, tuple, bool: server name or None, ALPN protocols or None,
+            True if the message is cut before both fields could be found
+    """
+    server_name = None
+    application_protocols = None
+    data_length = len(handshake)
+    if data_length < 4 or handshake[0] != 1:
+        return None, None, False
+    message_end = 4 + int.from_bytes(handshake[1:4], 'big')
+    truncated = message_end > data_length
+    end = min(message_end, data_length)
+    # legacy version and random
+    offset = 4 + 2 + 32
+    if offset >= end:
+        return None, None, truncated
+    offset += 1 + handshake[offset]
+    if offset + 2 > end:
+        return None, None, truncated
+    offset += 2 + int.from_bytes(handshake[offset:offset + 2], 'big')
+    if offset >= end:
+        return None, None, truncated
+    offset += 1 + handshake[offset]
+    if offset + 2 > end:
+        return None, None, truncated
+    extensions_end = min(offset + 2 + int.from_bytes(handshake[offset:offset + 2], 'big'), end)
+    offset += 2
+    while offset + 4 <= extensions_end:
+        extension_type = int.from_bytes(handshake[offset:offset + 2], 'big')
+        extension_end = offset + 4 + int.from_bytes(handshake[offset + 2:offset + 4], 'big')
+        if extension_end > extensions_end:
+            # the extension is cut, fields after it can only be in the next bytes
+            return server_name, application_protocols, truncated
+        if extension_type == SERVER_NAME_EXTENSION:
+            # server name list length (16), name type (8) = 0 (host name), name length (16), name
+            if extension_end - offset >= 9 and handshake[offset + 6] == 0:
+                name_length = int.from_bytes(handshake[offset + 7:offset + 9], 'big')
+                server_name = str(handshake[offset + 9:min(offset + 9 + name_length, extension_end)],
+                                  'ascii', 'replace')
+        elif extension_type == APPLICATION_LAYER_PROTOCOL_NEGOTIATION_EXTENSION:
+            # protocol name list length (16), then protocol name length (8) and protocol name
+            protocols = []
+            protocol_offset = offset + 6
+            while protocol_offset < extension_end:
+                protocol_end = min(protocol_offset + 1 + handshake[protocol_offset], extension_end)
+                protocols.append(str(handshake[protocol_offset + 1:protocol_end], 'ascii', 'replace'))
+                protocol_offset = protocol_end
+            application_protocols = tuple(protocols)
+        if server_name is not None and application_protocols is not None:
+            return server_name, application_protocols, False
+        offset = extension_end
+    return server_name, application_protocols, truncated
+
+
 class Tls:
     def __init__(self, my_dpi):
         self.tls_label = 'TLS'
-        my_dpi.register_tcp_first_packet_callback(
-            rb'^\x16\x03[\x00-\x03].{2}\x01',
-            self.callback_function
-        )
+        # ClientHello cut by the end of the first segment is read again from
+        # the reassembled prefix, for at most this many next packets
+        self.continuation_packets_count = 6
+        self.reassembly_enabled = my_dpi.tcp_reassembler is not None
 
     def callback_function(self, flow, application_packet):
+        # handshake record: content type (8) = 22, version (16), length (16), handshake messages
+        flow.server_name, flow.application_protocols, truncated = parse_client_hello(
+            memoryview(application_packet.packet_data)[5:])
+        if truncated and self.reassembly_enabled:
+            # the reassembled prefix is matched again by this callback when next segments arrive
+            if flow.inspection_callback is None:
+                flow.request_more_packets(self.continuation_callback, self.continuation_packets_count)
+            return
         flow.set_protocol(self.tls_label)
+
+    def continuation_callback(self, flow, application_packet):
+        # the callback is cleared with the last packet of the budget, the flow is TLS with the fields found so far
+        if flow.inspection_callback is None:
+            flow.set_protocol(self.tls_label)
@@ -1,83 +1,121 @@
-import re
-from my_dpi.module.dns import Dns
-from my_dpi.module.ntp import Ntp
-from my_dpi.module.quic import Quic
-from my_dpi.module.stun import Stun
-from my_dpi.module.tls import Tls
-from my_dpi.module.http import Http
+from my_dpi.plugin_registry import get_plugins, LazyCallback
+from my_dpi.signature_engine import SignatureEngine
+from my_dpi.tcp_reassembly import TcpReassembler
+from my_dpi.endpoint_cache import EndpointCache
+from my_dpi.packet import Packet
 
 
 class MyDpi:
 
-    def __init__(self):
-        self.udp_first_packet_patterns_callback_dict = {}
-        self.tcp_first_packet_patterns_callback_dict = {}
-        # Add new modules to this list
-        self.protocols_list = [
-            Dns,
-            Ntp,
-            Tls,
-            Http,
-            Stun,
-            Quic
-        ]
+    def __init__(self, reassembly_prefix_size=4096, reassembly_flow_budget=None,
+                 reassembly_global_budget=64 * 1024 * 1024, endpoint_cache_size=0, endpoint_cache_ttl=300.0,
+                 endpoint_cache_confidence=3, endpoint_cache_verify_interval=0, protocols=None,
+                 plugin_entry_points=False):
+        self.udp_first_packet_signatures = SignatureEngine()
+        self.tcp_first_packet_signatures = SignatureEngine()
+        # TCP signatures are matched again on the reassembled prefix of flows whose
+        # first segment is not classified, a prefix size of 0 disables reassembly
+        self.tcp_reassembler = None
+        if reassembly_prefix_size:
+            if reassembly_flow_budget is None:
+                # room for the prefix of both directions
+                reassembly_flow_budget = 2 * reassembly_prefix_size
+            self.tcp_reassembler = TcpReassembler(
+                reassembly_prefix_size, reassembly_flow_budget, reassembly_global_budget)
+        # labels of server endpoints that new flows get without inspection, a size of 0 disables it
+        self.endpoint_cache = None
+        if endpoint_cache_size:
+            self.endpoint_cache = EndpointCache(
+                endpoint_cache_size, endpoint_cache_ttl, endpoint_cache_confidence, endpoint_cache_verify_interval)
+        # Add new modules to my_dpi/module with a PROTOCOL declaration, protocols
+        # selects some of them by name, every module is used when it is None
+        self.protocols_list = get_plugins(protocols, plugin_entry_points)
+        # protocol name -> module object, modules are created by the first call of their signatures
         self.modules_objects = dict()
-        for module_name in self.protocols_list:
-            module_name(self)
+        # protocol name -> (signature, callback method name) list of modules that are not loaded yet
+        self.lazy_signatures = dict()
+        for plugin in self.protocols_list:
+            lazy_signatures = self.lazy_signatures[plugin.name] = []
+            for signature_metadata in plugin.signatures:
+                if signature_metadata['l4'] == 'tcp':
+                    signature_engine = self.tcp_first_packet_signatures
+                else:
+                    signature_engine = self.udp_first_packet_signatures
+                signature = signature_engine.register(
+                    signature_metadata['pattern'],
+                    LazyCallback(self, plugin, signature_metadata['callback']),
+                    signature_metadata.get('ports', ()),
+                    signature_metadata.get('min_length', 0),
+                    signature_metadata.get('strict_ports', False))
+                lazy_signatures.append((signature, signature_metadata['callback']))
 
-    def register_udp_first_packet_callback(self, pattern, callback):
-        """ Add pattern and its corresponding callback to UDP dictionary
+    def load_protocol_module(self, plugin):
+        """ Import a protocol module and create its object, once
+            its signatures then call the module methods without LazyCallback
+
+        Args:
+            plugin (ProtocolPlugin): protocol plugin
+
+        Returns:
+            object: module object
+        """
+        module_object = self.modules_objects.get(plugin.name)
+        if module_object is None:
+            module_object = self.modules_objects[plugin.name] = plugin.load_class()(self)
+            for signature, method_name in self.lazy_signatures.pop(plugin.name, ()):
+                signature.callback = getattr(module_object, method_name)
+        return module_object
+
+    def load_protocol_modules(self):
+        """ Load every protocol module now, for long runs that should not pay it on first matches
+        """
+        for plugin in self.protocols_list:
+            self.load_protocol_module(plugin)
+
+    def register_udp_first_packet_callback(self, pattern, callback, ports=(), min_length=0, strict_ports=False):
+        """ Compile pattern and add it with its corresponding callback to UDP signature engine
 
         Args:
             pattern (byte raw string): regular expression pattern
             callback (function): callback function
+            ports (iterable, optional): expected source or destination ports, tried first. Defaults to ().
+            min_length (int, optional): minimum payload length. Defaults to 0.
+            strict_ports (bool, optional): only try the pattern when a port matches. Defaults to False.
         """
-        self.udp_first_packet_patterns_callback_dict[pattern] = callback
+        self.udp_first_packet_signatures.register(pattern, callback, ports, min_length, strict_ports)
 
-    def register_tcp_first_packet_callback(self, pattern, callback):
-        """ Add pattern and its corresponding callback to TCP dictionary
+    def register_tcp_first_packet_callback(self, pattern, callback, ports=(), min_length=0, strict_ports=False):
+        """ Compile pattern and add it with its corresponding callback to TCP signature engine
 
         Args:
             pattern (byte raw string): regular expression pattern
             callback (function): callback function
+            ports (iterable, optional): expected source or destination ports, tried first. Defaults to ().
+            min_length (int, optional): minimum payload length. Defaults to 0.
+            strict_ports (bool, optional): only try the pattern when a port matches. Defaults to False.
         """
-        self.tcp_first_packet_patterns_callback_dict[pattern] = callback
+        self.tcp_first_packet_signatures.register(pattern, callback, ports, min_length, strict_ports)
 
     def feed_udp_first_packet(self, flow, application_packet):
-        """ Match registered pattern with UDP application packet data
-            then call the corresponding callback function if pattern is matched
+        """ Match registered patterns that can start with the first byte of UDP application packet data
+            then call the corresponding callback function, first detected protocol wins
 
         Args:
             flow (Flow): flow
             application_packet (Packet): application layer packet
         """
-        for pattern in self.udp_first_packet_patterns_callback_dict:
-            # Match (using re library) every regex pattern in udp_first_packet_patterns_callback_dict
-            if not re.search(pattern, application_packet.packet_data, re.DOTALL):
-                continue
-            # keys with application_packet.packet_data, if it matched call the callback function
-            # that previously registered in udp_first_packet_patterns_callback_dict
-            self.udp_first_packet_patterns_callback_dict[pattern](
-                flow,
-                application_packet,
-            )
+        self.udp_first_packet_signatures.feed(flow, application_packet)
 
     def feed_tcp_first_packet(self, flow, application_packet):
-        """ Match registered pattern with TCP application packet data
-            then call the corresponding callback function if pattern is matched
+        """ Match registered patterns that can start with the first byte of TCP application packet data
+            then call the corresponding callback function, first detected protocol wins
 
         Args:
             flow (Flow): flow
             application_packet (Packet): application layer packet
         """
-        for pattern in self.tcp_first_packet_patterns_callback_dict:
-            # Similar to feed_udp_first_packet
-            if not re.search(pattern, application_packet.packet_data, re.DOTALL):
-                continue
-            self.tcp_first_packet_patterns_callback_dict[pattern](
-                flow,
-                application_packet,
-            )
+        # Similar to feed_udp_first_packet
+        self.tcp_first_packet_signatures.feed(flow, application_packet)
 
     def inspect_packet(self, five_tuple_key, flow, application_packet):
         """ Inspection logic of the DPI
@@ -87,19 +125,99 @@ class MyDpi:
             flow (Flow): flow
             application_packet (Pakcet): application layer packet
         """
-        # Only inspect first packet
+        # Signatures only match the first packet, next packets go to the module
+        # that asked for them and to the TCP reassembler
         if flow.get_total_packets_count() > 1:
+            self.inspect_next_packet(flow, application_packet)
             return
 
+        # known servers are labelled without matching signatures
+        if self.endpoint_cache is not None:
+            protocol_label = self.endpoint_cache.lookup(flow)
+            if protocol_label is not None:
+                flow.set_protocol(protocol_label)
+                return
+
         # Feed TCP first packet
         if five_tuple_key[2]:
             self.feed_tcp_first_packet(
                 flow,
                 application_packet,
             )
+            # signature may be split over next segments
+            if self.tcp_reassembler is not None and not flow.is_protocol_detected():
+                self.tcp_reassembler.start(flow, application_packet)
         else:
             # feed UDP first packet
             self.feed_udp_first_packet(
                 flow,
                 application_packet,
             )
+        self.update_inspection_state(flow)
+
+    def inspect_next_packet(self, flow, application_packet):
+        """ Inspect a packet after the first one of a flow that is still pending
+
+        Args:
+            flow (Flow): flow
+            application_packet (Packet): application layer packet
+        """
+        callback = flow.take_inspection_callback(application_packet)
+        if callback is not None:
+            callback(flow, application_packet)
+        if flow.payload_type and not flow.is_protocol_detected():
+            self.reassemble_tcp_segment(flow, application_packet)
+        self.update_inspection_state(flow)
+
+    def update_inspection_state(self, flow):
+        """ Stop inspection of a flow that is classified or that nothing waits packets for
+
+        Args:
+            flow (Flow): flow
+        """
+        if flow.is_protocol_detected():
+            self.release_flow(flow)
+            if self.endpoint_cache is not None:
+                self.endpoint_cache.learn(flow)
+        elif flow.inspection_callback is None and (
+                self.tcp_reassembler is None or flow not in self.tcp_reassembler):
+            flow.give_up()
+            if self.endpoint_cache is not None:
+                self.endpoint_cache.forget(flow)
+
+    def reassemble_tcp_segment(self, flow, application_packet):
+        """ Add a TCP segment to the reassembled prefix of its flow and match
+            TCP signatures again if the prefix grew
+
+        Args:
+            flow (Flow): flow
+            application_packet (Packet): application layer packet
+        """
+        if self.tcp_reassembler is None or flow not in self.tcp_reassembler:
+            return
+        reassembled_data = self.tcp_reassembler.add_segment(flow, application_packet)
+        if reassembled_data is None:
+            return
+        reassembled_packet = Packet(
+            application_packet.is_packet_from_client, application_packet.packet_timestamp, reassembled_data)
+        self.feed_tcp_first_packet(flow, reassembled_packet)
+
+    def get_signature_statistics(self):
+        """ Get tests, matches and detections of every signature
+
+        Returns:
+            dict: lists of signature counters by layer 4 protocol
+        """
+        return {
+            'UDP': self.udp_first_packet_signatures.get_statistics(),
+            'TCP': self.tcp_first_packet_signatures.get_statistics(),
+        }
+
+    def release_flow(self, flow):
+        """ Release inspection state of a flow that is classified or left the flow table
+
+        Args:
+            flow (Flow): flow
+        """
+        if self.tcp_reassembler is not None:
+            self.tcp_reassembler.release(flow)
@@ -1,6 +1,10 @@
 class Packet():
 
-    def __init__(self, is_packet_from_client, packet_timestamp, packet_data):
+    __slots__ = ('is_packet_from_client', 'packet_timestamp', 'packet_data', 'tcp_sequence')
+
+    def __init__(self, is_packet_from_client, packet_timestamp, packet_data, tcp_sequence=None):
         self.is_packet_from_client = is_packet_from_client
         self.packet_timestamp = packet_timestamp
         self.packet_data = packet_data
+        # TCP sequence number of the first payload byte, None for UDP
+        self.tcp_sequence = tcp_sequence
@@ -0,0 +1,327 @@
+""" Pre-filter expressions evaluated on raw packet bytes
+
+A filter expression is compiled once into a Python function that reads the
+Ethernet frame at fixed offsets, after the VLAN tags, and returns whether
+the packet is kept. No header object is built, a packet that does not match
+costs a few byte comparisons and is dropped before it is decoded.
+
+The syntax is a subset of pcap-filter (tcpdump):
+
+    ip, ip6, tcp, udp, vlan [ID]
+    [src|dst] host ADDRESS          IPv4 or IPv6 address
+    [src|dst] net ADDRESS/PREFIX    IPv4 or IPv6 network
+    [tcp|udp] [src|dst] port N
+    [tcp|udp] [src|dst] portrange N-M
+    not EXPRESSION, ! EXPRESSION
+    EXPRESSION and EXPRESSION, EXPRESSION && EXPRESSION
+    EXPRESSION or EXPRESSION, EXPRESSION || EXPRESSION
+    ( EXPRESSION )
+
+As in pcap-filter, not binds tighter than and and or, which have the same
+precedence and are grouped from left to right: 'udp and port 53 or net
+10.0.0.0/8' is '(udp and port 53) or net 10.0.0.0/8'. Ports of IPv4
+fragments after the first one never match, and IPv6 extension headers are
+not walked, so tcp, udp and ports only match IPv6 packets whose next header
+is TCP or UDP. Frames of other encapsulations (MPLS, PPPoE) are not IP
+packets for the filter.
+"""
+import re
+import ipaddress
+from my_dpi.fast_parser import ETHERTYPES_VLAN, ETHERTYPE_IPV4, ETHERTYPE_IPV6, IPPROTO_TCP, IPPROTO_UDP
+
+
+TOKEN_PATTERN = re.compile(r'\s*(\(|\)|&&|\|\||!|[^\s()!&|]+)')
+# offsets of the source and destination addresses in the IPv4 and IPv6 headers
+IPV4_ADDRESS_OFFSETS = {'src': 12, 'dst': 16}
+IPV6_ADDRESS_OFFSETS = {'src': 8, 'dst': 24}
+# offsets of the source and destination ports in the TCP and UDP headers
+PORT_OFFSETS = {'src': 0, 'dst': 2}
+DIRECTIONS = ('src', 'dst')
+
+
+class FilterCompiler:
+    """ Parser of a filter expression that generates the source of its predicate
+
+    Header fields read by the primitives are recorded while the expression is
+    parsed, the predicate only reads the fields its expression needs.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = self.tokenize(expression)
+        self.position = 0
+        self.uses_protocol = False
+        self.uses_ports = False
+        self.uses_vlan_id = False
+
+    @staticmethod
+    def tokenize(expression):
+        """ Split an expression into operators, parentheses and words
+
+        Args:
+            expression (string): filter expression
+
+        Raises:
+            ValueError: expression has a character that starts no token
+
+        Returns:
+            list: tokens
+        """
+        tokens = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = TOKEN_PATTERN.match(expression, position)
+            if match is None:
+                raise ValueError(f'invalid filter expression at {expression[position:]!r}')
+            tokens.append(match.group(1))
+            position = match.end()
+        return tokens
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def next(self, expected=None):
+        """ Consume the next token
+
+        Args:
+            expected (string, optional): what the token stands for, in the error message. Defaults to None.
+
+        Raises:
+            ValueError: expression ends here
+
+        Returns:
+            string: token
+        """
+        token = self.peek()
+        if token is None:
+            raise ValueError(f'filter expression ends where {expected or "a primitive"} is expected')
+        self.position += 1
+        return token
+
+    def compile(self):
+        """ Parse the whole expression
+
+        Raises:
+            ValueError: expression is not valid
+
+        Returns:
+            string: Python source of the predicate function
+        """
+        if not self.tokens:
+            raise ValueError('empty filter expression')
+        condition = self.parse_expression()
+        if self.peek() is not None:
+            raise ValueError(f'unexpected {self.peek()!r} in filter expression')
+        return self.get_source(condition)
+
+    def parse_expression(self):
+        # and and or have the same precedence and are grouped from left to right
+        condition = self.parse_unary()
+        while self.peek() in ('and', '&&', 'or', '||'):
+            operator = 'and' if self.next() in ('and', '&&') else 'or'
+            condition = f'({condition} {operator} {self.parse_unary()})'
+        return condition
+
+    def parse_unary(self):
+        token = self.peek()
+        if token in ('not', '!'):
+            self.next()
+            return f'(not {self.parse_unary()})'
+        if token == '(':
+            self.next()
+            condition = self.parse_expression()
+            if self.next("')'") != ')':
+                raise ValueError('missing \')\' in filter expression')
+            return condition
+        return self.parse_primitive()
+
+    def parse_primitive(self):
+        token = self.next()
+        if token == 'ip':
+            return f'ethertype == {ETHERTYPE_IPV4}'
+        if token == 'ip6':
+            return f'ethertype == {ETHERTYPE_IPV6}'
+        if token == 'vlan':
+            vlan_id = self.peek()
+            self.uses_vlan_id = True
+            if vlan_id is not None and vlan_id.isdigit():
+                self.next()
+                return f'vlan_id == {self.parse_number(vlan_id, 0xfff)}'
+            return 'vlan_id is not None'
+        ip_protocols = (IPPROTO_TCP, IPPROTO_UDP)
+        if token in ('tcp', 'udp'):
+            ip_protocols = (IPPROTO_TCP,) if token == 'tcp' else (IPPROTO_UDP,)
+            if self.peek() not in ('src', 'dst', 'port', 'portrange'):
+                self.uses_protocol = True
+                return f'protocol == {ip_protocols[0]}'
+            token = self.next()
+        directions = DIRECTIONS
+        if token in DIRECTIONS:
+            directions = (token,)
+            token = self.next('host, net, port or portrange')
+        if token in ('host', 'net'):
+            if len(ip_protocols) == 1:
+                raise ValueError(f'{token} can not follow a protocol in filter expression')
+            return self.get_address_condition(token, self.next(f'{token} address'), directions)
+        if token in ('port', 'portrange'):
+            return self.get_port_condition(token, self.next(f'{token} number'), directions, ip_protocols)
+        raise ValueError(f'unknown filter primitive {token!r}')
+
+    @staticmethod
+    def parse_number(token, maximum):
+        if not token.isdigit() or int(token) > maximum:
+            raise ValueError(f'invalid number {token!r} in filter expression')
+        return int(token)
+
+    def get_address_condition(self, kind, token, directions):
+        """ Get condition of a host or net primitive
+
+        Args:
+            kind (string): host or net
+            token (string): address or network
+            directions (tuple): address fields that are compared, src and/or dst
+
+        Raises:
+            ValueError: token is not an address or a network
+
+        Returns:
+            string: Python condition
+        """
+        try:
+            if kind == 'host':
+                address = ipaddress.ip_address(token)
+                network = ipaddress.ip_network(f'{address}/{address.max_prefixlen}')
+            else:
+                network = ipaddress.ip_network(token, strict=False)
+        except ValueError:
+            raise ValueError(f'invalid {kind} {token!r} in filter expression') from None
+        if network.version == 4:
+            ethertype, offsets, address_length = ETHERTYPE_IPV4, IPV4_ADDRESS_OFFSETS, 4
+        else:
+            ethertype, offsets, address_length = ETHERTYPE_IPV6, IPV6_ADDRESS_OFFSETS, 16
+        prefix_length = network.prefixlen
+        if prefix_length == 0:
+            return f'ethertype == {ethertype}'
+        network_bytes = network.network_address.packed
+        comparisons = []
+        for direction in directions:
+            offset = offsets[direction]
+            if prefix_length % 8 == 0:
+                # whole bytes of the prefix are compared at once
+                prefix_end = offset + prefix_length // 8
+                comparisons.append(f'packet[l3 + {offset}:l3 + {prefix_end}] == {network_bytes[:prefix_length // 8]!r}')
+            else:
+                mask = int(network.netmask)
+                comparisons.append(f'int.from_bytes(packet[l3 + {offset}:l3 + {offset + address_length}], "big") '
+                                   f'& {mask:#x} == {int(network.network_address):#x}')
+        return f'(ethertype == {ethertype} and ({" or ".join(comparisons)}))'
+
+    def get_port_condition(self, kind, token, directions, ip_protocols):
+        """ Get condition of a port or portrange primitive
+
+        Args:
+            kind (string): port or portrange
+            token (string): port or first-last range
+            directions (tuple): port fields that are compared, src and/or dst
+            ip_protocols (tuple): IP protocols the ports belong to
+
+        Raises:
+            ValueError: token is not a port or a range of ports
+
+        Returns:
+            string: Python condition
+        """
+        self.uses_protocol = True
+        self.uses_ports = True
+        if kind == 'port':
+            port_bytes = self.parse_number(token, 0xffff).to_bytes(2, 'big')
+            comparisons = [f'packet[l4 + {PORT_OFFSETS[direction]}:l4 + {PORT_OFFSETS[direction] + 2}] == {port_bytes!r}'
+                           for direction in directions]
+        else:
+            first_port, separator, last_port = token.partition('-')
+            if not separator:
+                raise ValueError(f'invalid portrange {token!r} in filter expression')
+            first_port = self.parse_number(first_port, 0xffff)
+            last_port = self.parse_number(last_port, 0xffff)
+            comparisons = [f'{first_port} <= (packet[l4 + {PORT_OFFSETS[direction]}] << 8 | '
+                           f'packet[l4 + {PORT_OFFSETS[direction] + 1}]) <= {last_port}' for direction in directions]
+        if len(ip_protocols) == 1:
+            protocol_condition = f'protocol == {ip_protocols[0]}'
+        else:
+            protocol_condition = f'(protocol == {IPPROTO_TCP} or protocol == {IPPROTO_UDP})'
+        return f'({protocol_condition} and not fragment and ({" or ".join(comparisons)}))'
+
+    def get_source(self, condition):
+        """ Get source of the predicate function of a condition
+
+        Args:
+            condition (string): Python condition of the whole expression
+
+        Returns:
+            string: Python source of packet_filter(packet)
+        """
+        lines = [
+            'def packet_filter(packet):',
+            '    try:',
+            '        ethertype = packet[12] << 8 | packet[13]',
+            '        l3 = 14',
+        ]
+        if self.uses_vlan_id:
+            lines.append('        vlan_id = (packet[14] & 0x0f) << 8 | packet[15] '
+                         'if ethertype in ETHERTYPES_VLAN else None')
+        lines += [
+            '        while ethertype in ETHERTYPES_VLAN:',
+            '            ethertype = packet[l3 + 2] << 8 | packet[l3 + 3]',
+            '            l3 += 4',
+        ]
+        if self.uses_protocol:
+            lines += [
+                f'        if ethertype == {ETHERTYPE_IPV4}:',
+                '            protocol = packet[l3 + 9]',
+            ]
+            if self.uses_ports:
+                lines += [
+                    '            l4 = l3 + (packet[l3] & 0x0f) * 4',
+                    '            fragment = packet[l3 + 6] & 0x1f or packet[l3 + 7]',
+                ]
+            lines += [
+                f'        elif ethertype == {ETHERTYPE_IPV6}:',
+                '            protocol = packet[l3 + 6]',
+            ]
+            if self.uses_ports:
+                lines += [
+                    '            l4 = l3 + 40',
+                    '            fragment = 0',
+                ]
+            lines += [
+                '        else:',
+                '            protocol = None',
+            ]
+        lines += [
+            f'        return {condition}',
+            '    except IndexError:',
+            '        # truncated headers are dropped by the decoder anyway',
+            '        return False',
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+def compile_filter(expression):
+    """ Compile a filter expression into a predicate of raw packet bytes
+
+    Args:
+        expression (string): filter expression, see the module documentation
+
+    Raises:
+        ValueError: expression is not valid
+
+    Returns:
+        callable: packet_filter(packet) returning True for packets that are kept
+    """
+    source = FilterCompiler(expression).compile()
+    namespace = {'ETHERTYPES_VLAN': ETHERTYPES_VLAN}
+    exec(compile(source, f'<packet filter {expression!r}>', 'exec'), namespace)
+    packet_filter = namespace['packet_filter']
+    packet_filter.expression = expression
+    return packet_filter
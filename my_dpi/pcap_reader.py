@@ -0,0 +1,447 @@
+""" pcap and pcapng readers
+
+PcapReader maps the capture file in memory and yields (timestamp, memoryview)
+records, each record is a slice of the mapping so packet bytes are never copied.
+PcapStreamReader reads records from a stream (stdin, a FIFO or a growing file).
+Packets are decoded as Ethernet frames, captures with interfaces of another
+link type are rejected with a ValueError.
+"""
+import os
+import mmap
+import stat
+import select
+import struct
+import time
+
+
+# pcap magic numbers as written in the first 4 bytes of the file
+PCAP_MAGIC_NUMBERS = {
+    # (byte order, timestamp fraction units per second)
+    b'\xd4\xc3\xb2\xa1': ('<', 1000000),
+    b'\xa1\xb2\xc3\xd4': ('>', 1000000),
+    b'\x4d\x3c\xb2\xa1': ('<', 1000000000),
+    b'\xa1\xb2\x3c\x4d': ('>', 1000000000),
+}
+PCAP_GLOBAL_HEADER_LENGTH = 24
+PCAP_RECORD_HEADER_LENGTH = 16
+
+PCAPNG_SECTION_HEADER_BLOCK = 0x0a0d0d0a
+PCAPNG_INTERFACE_DESCRIPTION_BLOCK = 0x00000001
+PCAPNG_PACKET_BLOCK = 0x00000002
+PCAPNG_SIMPLE_PACKET_BLOCK = 0x00000003
+PCAPNG_ENHANCED_PACKET_BLOCK = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_OPTION_IF_TSRESOL = 9
+PCAPNG_OPTION_IF_TSOFFSET = 14
+
+LINKTYPE_ETHERNET = 1
+
+
+def check_link_type(link_type, capture_name):
+    """ Check that packets of an interface are Ethernet frames, the only link layer the decoders read
+
+    Args:
+        link_type (int): link type of the interface
+        capture_name (string): capture path or description used in the error
+
+    Raises:
+        ValueError: link type is not Ethernet
+    """
+    if link_type != LINKTYPE_ETHERNET:
+        raise ValueError(f'unsupported link type {link_type}, only Ethernet interfaces are supported: {capture_name}')
+
+
+def get_interface(interfaces, interface_id, capture_name):
+    """ Get timestamp options of the interface of a packet block
+
+    Args:
+        interfaces (list): (units per second, offset in seconds) of every interface of the section
+        interface_id (int): interface id of the packet block
+        capture_name (string): capture path or description used in the error
+
+    Raises:
+        ValueError: no interface description block of the section has this id
+
+    Returns:
+        tuple: units per second and offset in seconds
+    """
+    if interface_id >= len(interfaces):
+        raise ValueError(f'packet block of unknown interface {interface_id}: {capture_name}')
+    return interfaces[interface_id]
+
+
+def read_interface_options(buffer, byte_order, offset, end_offset):
+    """ Read timestamp resolution and offset options of a pcapng interface description block
+
+    Args:
+        buffer (bytes or memoryview): buffer of the block
+        byte_order (string): struct byte order of the section
+        offset (int): offset of the first option
+        end_offset (int): offset of the end of options
+
+    Returns:
+        int, int: timestamp units per second and timestamp offset in seconds
+    """
+    units_per_second = 1000000
+    timestamp_offset = 0
+    while offset + 4 <= end_offset:
+        option_code, option_length = struct.unpack_from(byte_order + 'HH', buffer, offset)
+        if option_code == 0:
+            break
+        value_offset = offset + 4
+        if option_code == PCAPNG_OPTION_IF_TSRESOL and option_length >= 1:
+            resolution = buffer[value_offset]
+            if resolution & 0x80:
+                units_per_second = 2 ** (resolution & 0x7f)
+            else:
+                units_per_second = 10 ** resolution
+        elif option_code == PCAPNG_OPTION_IF_TSOFFSET and option_length >= 8:
+            timestamp_offset, = struct.unpack_from(byte_order + 'q', buffer, value_offset)
+        # option values are padded to 32 bits
+        offset = value_offset + ((option_length + 3) & ~3)
+    return units_per_second, timestamp_offset
+
+
+class PcapReader:
+    """ Read pcap (microsecond and nanosecond) and pcapng captures from a memory mapping
+
+    Usage:
+        with PcapReader(pcap_file_name) as pcap:
+            for timestamp, buffer in pcap:
+                ...
+    """
+
+    def __init__(self, pcap_file_name):
+        self.file = open(pcap_file_name, 'rb')
+        try:
+            self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file can not be mapped
+            self.file.close()
+            raise ValueError(f'invalid capture file: {pcap_file_name}')
+        self.view = memoryview(self.mapping)
+        self.pcap_file_name = pcap_file_name
+        # offset of the last record returned by the iterator in the file
+        self.record_offset = 0
+        # offsets of the pcapng section header and interface description blocks read so far,
+        # a file of some of the records is valid with these blocks in front of them
+        self.header_block_offsets = []
+        magic = bytes(self.view[:4])
+        if magic in PCAP_MAGIC_NUMBERS:
+            if len(self.view) >= PCAP_GLOBAL_HEADER_LENGTH:
+                link_type, = struct.unpack_from(PCAP_MAGIC_NUMBERS[magic][0] + 'I', self.view, 20)
+                try:
+                    check_link_type(link_type & 0x0fffffff, pcap_file_name)
+                except ValueError:
+                    self.close()
+                    raise
+            self.record_offsets = self.read_pcap_record_offsets(magic)
+        elif len(self.view) >= 12 and self.view[:4] == struct.pack('<I', PCAPNG_SECTION_HEADER_BLOCK):
+            self.record_offsets = self.read_pcapng_record_offsets()
+        else:
+            self.close()
+            raise ValueError(f'invalid capture file: {pcap_file_name}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        view = self.view
+        for timestamp, data_offset, captured_length in self.record_offsets:
+            yield timestamp, view[data_offset:data_offset + captured_length]
+
+    def iter_record_offsets(self):
+        """ Iterate records without slicing them, for readers of the mapping itself
+
+        Returns:
+            generator: (timestamp, offset of packet bytes in the file, captured length) of every record
+        """
+        return self.record_offsets
+
+    def close(self):
+        """ Unmap and close the capture file
+            if records are still referenced the mapping is closed when they are released
+        """
+        try:
+            self.view.release()
+            self.mapping.close()
+        except BufferError:
+            pass
+        self.file.close()
+
+    def read_pcap_record_offsets(self, magic):
+        """ Generate records of a pcap file
+
+        Args:
+            magic (bytes): magic number of the file
+
+        Yields:
+            float, int, int: packet timestamp, packet offset and captured length
+        """
+        byte_order, units_per_second = PCAP_MAGIC_NUMBERS[magic]
+        view = self.view
+        file_length = len(view)
+        if file_length < PCAP_GLOBAL_HEADER_LENGTH:
+            return
+        unpack_record_header = struct.Struct(byte_order + 'III4x').unpack_from
+        offset = PCAP_GLOBAL_HEADER_LENGTH
+        while offset + PCAP_RECORD_HEADER_LENGTH <= file_length:
+            seconds, fraction, captured_length = unpack_record_header(view, offset)
+            data_offset = offset + PCAP_RECORD_HEADER_LENGTH
+            next_offset = data_offset + captured_length
+            # truncated last record
+            if next_offset > file_length:
+                return
+            self.record_offset = offset
+            yield seconds + fraction / units_per_second, data_offset, captured_length
+            offset = next_offset
+
+    def read_pcapng_record_offsets(self):
+        """ Generate records of a pcapng file, every section and interface is supported
+
+        Yields:
+            float, int, int: packet timestamp, packet offset and captured length
+        """
+        view = self.view
+        file_length = len(view)
+        offset = 0
+        byte_order = '<'
+        # (units per second, offset in seconds) of every interface of the current section
+        interfaces = []
+        timestamp = 0.0
+        while offset + 12 <= file_length:
+            block_type, = struct.unpack_from(byte_order + 'I', view, offset)
+            if block_type == PCAPNG_SECTION_HEADER_BLOCK:
+                # byte order of every section is given by its byte order magic
+                byte_order_magic, = struct.unpack_from('<I', view, offset + 8)
+                byte_order = '<' if byte_order_magic == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                interfaces = []
+                self.header_block_offsets.append(offset)
+            block_length, = struct.unpack_from(byte_order + 'I', view, offset + 4)
+            if block_length < 12 or offset + block_length > file_length:
+                return
+            body_offset = offset + 8
+            if block_type == PCAPNG_ENHANCED_PACKET_BLOCK:
+                interface_id, timestamp_high, timestamp_low, captured_length = struct.unpack_from(
+                    byte_order + 'IIII', view, body_offset)
+                units_per_second, timestamp_offset = get_interface(interfaces, interface_id, self.pcap_file_name)
+                timestamp = ((timestamp_high << 32) | timestamp_low) / units_per_second + timestamp_offset
+                data_offset = body_offset + 20
+                self.record_offset = offset
+                yield timestamp, data_offset, captured_length
+            elif block_type == PCAPNG_SIMPLE_PACKET_BLOCK:
+                # simple packet blocks have no timestamp, the previous packet timestamp is used,
+                # they belong to the first interface
+                get_interface(interfaces, 0, self.pcap_file_name)
+                original_length, = struct.unpack_from(byte_order + 'I', view, body_offset)
+                captured_length = min(original_length, block_length - 16)
+                data_offset = body_offset + 4
+                self.record_offset = offset
+                yield timestamp, data_offset, captured_length
+            elif block_type == PCAPNG_PACKET_BLOCK:
+                # obsolete packet block
+                interface_id, _, timestamp_high, timestamp_low, captured_length = struct.unpack_from(
+                    byte_order + 'HHIII', view, body_offset)
+                units_per_second, timestamp_offset = get_interface(interfaces, interface_id, self.pcap_file_name)
+                timestamp = ((timestamp_high << 32) | timestamp_low) / units_per_second + timestamp_offset
+                data_offset = body_offset + 20
+                self.record_offset = offset
+                yield timestamp, data_offset, captured_length
+            elif block_type == PCAPNG_INTERFACE_DESCRIPTION_BLOCK:
+                link_type, = struct.unpack_from(byte_order + 'H', view, body_offset)
+                check_link_type(link_type, self.pcap_file_name)
+                self.header_block_offsets.append(offset)
+                interfaces.append(read_interface_options(
+                    view, byte_order, body_offset + 8, offset + block_length - 4))
+            offset += block_length
+
+
+class PcapStreamReader:
+    """ Read pcap and pcapng records from a stream that can not be mapped
+
+    With follow set, the end of file is not the end of capture: the reader
+    waits for the file to grow, like tail -f, until stop is called.
+    idle_callback is called every time the reader has to wait for more data,
+    so a consumer can flush what it has buffered.
+    """
+
+    # bytes read from the stream at once
+    CHUNK_SIZE = 65536
+
+    def __init__(self, file, follow=False, poll_interval=0.2, idle_callback=None):
+        self.file = file
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self.idle_callback = idle_callback
+        self.stopped = False
+        self.buffer = bytearray()
+        self.position = 0
+        try:
+            self.file_descriptor = file.fileno()
+            # pipes and FIFOs are polled so waiting for data can be detected
+            self.pollable = not stat.S_ISREG(os.fstat(self.file_descriptor).st_mode)
+        except (AttributeError, OSError):
+            self.file_descriptor = None
+            self.pollable = False
+
+    def __iter__(self):
+        magic = self.read_exact(4)
+        if magic is None:
+            return
+        if magic in PCAP_MAGIC_NUMBERS:
+            yield from self.read_pcap_records(magic)
+        elif magic == struct.pack('<I', PCAPNG_SECTION_HEADER_BLOCK):
+            yield from self.read_pcapng_records(magic)
+        else:
+            raise ValueError('invalid capture stream')
+
+    def stop(self):
+        """ Stop waiting for a growing file
+        """
+        self.stopped = True
+
+    def read_exact(self, length):
+        """ Read exactly length bytes from the stream
+
+        Args:
+            length (int): number of bytes
+
+        Returns:
+            bytes: data, None at the end of stream
+        """
+        while len(self.buffer) - self.position < length:
+            if not self.fill_buffer():
+                return None
+        data = bytes(self.buffer[self.position:self.position + length])
+        self.position += length
+        return data
+
+    def fill_buffer(self):
+        """ Append the next chunk of the stream to the buffer
+
+        Returns:
+            bool: False at the end of stream
+        """
+        # drop bytes that are already read
+        if self.position:
+            del self.buffer[:self.position]
+            self.position = 0
+        while True:
+            if self.pollable and not select.select([self.file_descriptor], [], [], self.poll_interval)[0]:
+                # nothing written to the pipe yet
+                self.wait_for_data()
+                if self.stopped:
+                    return False
+                continue
+            if self.file_descriptor is not None:
+                data = os.read(self.file_descriptor, PcapStreamReader.CHUNK_SIZE)
+            else:
+                data = self.file.read(PcapStreamReader.CHUNK_SIZE)
+            if data:
+                self.buffer += data
+                return True
+            if not self.follow or self.stopped:
+                return False
+            # wait for the writer to append the rest of the file
+            self.wait_for_data()
+            time.sleep(self.poll_interval)
+
+    def wait_for_data(self):
+        """ Tell the consumer that the reader is waiting for data
+        """
+        if self.idle_callback is not None:
+            self.idle_callback()
+
+    def read_pcap_records(self, magic):
+        """ Generate records of a pcap stream
+
+        Args:
+            magic (bytes): magic number of the stream
+
+        Yields:
+            float, bytes: packet timestamp and packet bytes
+        """
+        byte_order, units_per_second = PCAP_MAGIC_NUMBERS[magic]
+        global_header = self.read_exact(PCAP_GLOBAL_HEADER_LENGTH - 4)
+        if global_header is None:
+            return
+        check_link_type(struct.unpack_from(byte_order + 'I', global_header, 16)[0] & 0x0fffffff, 'capture stream')
+        unpack_record_header = struct.Struct(byte_order + 'III4x').unpack
+        while True:
+            record_header = self.read_exact(PCAP_RECORD_HEADER_LENGTH)
+            if record_header is None:
+                return
+            seconds, fraction, captured_length = unpack_record_header(record_header)
+            buffer = self.read_exact(captured_length)
+            if buffer is None:
+                return
+            yield seconds + fraction / units_per_second, buffer
+
+    def read_pcapng_records(self, block_type_bytes):
+        """ Generate records of a pcapng stream
+
+        Args:
+            block_type_bytes (bytes): block type of the first section header block
+
+        Yields:
+            float, bytes: packet timestamp and packet bytes
+        """
+        byte_order = '<'
+        interfaces = []
+        timestamp = 0.0
+        while True:
+            if block_type_bytes is None:
+                block_type_bytes = self.read_exact(4)
+                if block_type_bytes is None:
+                    return
+            if block_type_bytes == struct.pack('<I', PCAPNG_SECTION_HEADER_BLOCK):
+                # block length is followed by the byte order magic of the new section
+                length_and_magic = self.read_exact(8)
+                if length_and_magic is None:
+                    return
+                byte_order_magic, = struct.unpack_from('<I', length_and_magic, 4)
+                byte_order = '<' if byte_order_magic == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                interfaces = []
+                block_length, = struct.unpack_from(byte_order + 'I', length_and_magic)
+                rest = self.read_exact(block_length - 12) if block_length >= 12 else None
+                if rest is None:
+                    return
+                block_type_bytes = None
+                continue
+            block_type, = struct.unpack(byte_order + 'I', block_type_bytes)
+            block_type_bytes = None
+            block_length_bytes = self.read_exact(4)
+            if block_length_bytes is None:
+                return
+            block_length, = struct.unpack(byte_order + 'I', block_length_bytes)
+            if block_length < 12:
+                return
+            # block body and the trailing block length
+            block = self.read_exact(block_length - 8)
+            if block is None:
+                return
+            if block_type == PCAPNG_ENHANCED_PACKET_BLOCK:
+                interface_id, timestamp_high, timestamp_low, captured_length = struct.unpack_from(
+                    byte_order + 'IIII', block)
+                units_per_second, timestamp_offset = get_interface(interfaces, interface_id, 'capture stream')
+                timestamp = ((timestamp_high << 32) | timestamp_low) / units_per_second + timestamp_offset
+                yield timestamp, block[20:20 + captured_length]
+            elif block_type == PCAPNG_SIMPLE_PACKET_BLOCK:
+                # simple packet blocks have no timestamp, the previous packet timestamp is used,
+                # they belong to the first interface
+                get_interface(interfaces, 0, 'capture stream')
+                original_length, = struct.unpack_from(byte_order + 'I', block)
+                yield timestamp, block[4:4 + min(original_length, block_length - 16)]
+            elif block_type == PCAPNG_PACKET_BLOCK:
+                interface_id, _, timestamp_high, timestamp_low, captured_length = struct.unpack_from(
+                    byte_order + 'HHIII', block)
+                units_per_second, timestamp_offset = get_interface(interfaces, interface_id, 'capture stream')
+                timestamp = ((timestamp_high << 32) | timestamp_low) / units_per_second + timestamp_offset
+                yield timestamp, block[20:20 + captured_length]
+            elif block_type == PCAPNG_INTERFACE_DESCRIPTION_BLOCK:
+                link_type, = struct.unpack_from(byte_order + 'H', block)
+                check_link_type(link_type, 'capture stream')
+                interfaces.append(read_interface_options(block, byte_order, 8, block_length - 12))
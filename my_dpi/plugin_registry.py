@@ -0,0 +1,262 @@
+""" Registry of protocol modules
+
+Protocol modules are found in the my_dpi.module package and in the
+'my_dpi.protocols' entry point group of installed distributions. A module
+declares its class and signatures in a top level PROTOCOL dictionary literal,
+which is read from the source without importing the module:
+
+    PROTOCOL = {
+        'class': 'Dns',
+        'priority': 10,
+        'signatures': (
+            {'l4': 'udp', 'pattern': rb'^.{4}\\x00[\\x01-\\x0f]\\x00.{5}', 'callback': 'callback_function',
+             'ports': (53, 5353, 5355), 'min_length': 12},
+        ),
+    }
+
+Signatures are registered with a LazyCallback, the module is imported and its
+class is created by MyDpi the first time one of its signatures matches.
+Modules without PROTOCOL are not protocol modules and are skipped.
+
+The PROTOCOL values of a package directory are cached in its __pycache__
+directory with the modification time and size of every module, so modules
+are only parsed again when they change.
+"""
+import os
+import sys
+import marshal
+import importlib
+import importlib.util
+
+
+PACKAGE = 'my_dpi.module'
+ENTRY_POINTS_GROUP = 'my_dpi.protocols'
+# priority of modules that do not declare one, lower priorities register their signatures first
+DEFAULT_PRIORITY = 100
+# cache of the PROTOCOL values of a package directory, marshal data depends on the Python version
+METADATA_CACHE_NAME = f'protocols.{sys.implementation.cache_tag}.marshal'
+
+
+class ProtocolPlugin:
+    """ Protocol module found by the registry, the module itself is not imported
+    """
+
+    def __init__(self, name, module_name, class_name, signatures, priority=DEFAULT_PRIORITY):
+        self.name = name
+        self.module_name = module_name
+        self.class_name = class_name
+        # signature metadata dictionaries of PROTOCOL
+        self.signatures = signatures
+        self.priority = priority
+
+    def load_class(self):
+        """ Import the module and get its protocol class
+
+        Returns:
+            class: protocol class, created with the MyDpi instance as argument
+        """
+        return getattr(importlib.import_module(self.module_name), self.class_name)
+
+
+class LazyCallback:
+    """ Signature callback that loads its protocol module on the first call,
+        MyDpi replaces it by the module method once the module is loaded
+    """
+
+    __slots__ = ('my_dpi', 'plugin', 'method_name', '__qualname__')
+
+    def __init__(self, my_dpi, plugin, method_name):
+        self.my_dpi = my_dpi
+        self.plugin = plugin
+        self.method_name = method_name
+        # same name as the module method in signature statistics
+        self.__qualname__ = f'{plugin.class_name}.{method_name}'
+
+    def __call__(self, flow, application_packet):
+        module_object = self.my_dpi.load_protocol_module(self.plugin)
+        getattr(module_object, self.method_name)(flow, application_packet)
+
+
+def read_protocol_metadata(path):
+    """ Read the PROTOCOL dictionary of a module source file
+
+    Args:
+        path (string): module file path
+
+    Returns:
+        dict: PROTOCOL value, None if the module does not declare it
+    """
+    # ast is slow to import, it is only needed when a module changed since the cache was written
+    import ast
+    with open(path, 'rb') as module_file:
+        tree = ast.parse(module_file.read(), path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+                isinstance(target, ast.Name) and target.id == 'PROTOCOL' for target in node.targets):
+            return ast.literal_eval(node.value)
+    return None
+
+
+def load_metadata_cache(directory):
+    """ Read the cached PROTOCOL values of a package directory
+
+    Args:
+        directory (string): package directory
+
+    Returns:
+        dict: module file name -> (modification time, size, PROTOCOL value), empty if there is no valid cache
+    """
+    try:
+        with open(os.path.join(directory, '__pycache__', METADATA_CACHE_NAME), 'rb') as cache_file:
+            cache = marshal.load(cache_file)
+    except (OSError, EOFError, ValueError, TypeError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def save_metadata_cache(directory, cache):
+    """ Write the cached PROTOCOL values of a package directory, read-only directories are not cached
+
+    Args:
+        directory (string): package directory
+        cache (dict): module file name -> (modification time, size, PROTOCOL value)
+    """
+    cache_directory = os.path.join(directory, '__pycache__')
+    cache_path = os.path.join(cache_directory, METADATA_CACHE_NAME)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(cache_directory, exist_ok=True)
+        with open(tmp_path, 'wb') as cache_file:
+            marshal.dump(cache, cache_file)
+        # processes started together read a complete cache or none
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def get_cached_protocol_metadata(entry, cache, updated_cache):
+    """ Get the PROTOCOL dictionary of a module file from the cache, parse it if it changed
+
+    Args:
+        entry (os.DirEntry): module file
+        cache (dict): cache read from the package directory
+        updated_cache (dict): cache of the modules found now, the entry is added to it
+
+    Returns:
+        dict: PROTOCOL value, None if the module does not declare it
+    """
+    stat = entry.stat()
+    cached = cache.get(entry.name)
+    if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        metadata = cached[2]
+    else:
+        metadata = read_protocol_metadata(entry.path)
+    updated_cache[entry.name] = (stat.st_mtime_ns, stat.st_size, metadata)
+    return metadata
+
+
+def create_plugin(name, module_name, metadata):
+    """ Create the plugin of a module
+
+    Args:
+        name (string): protocol name
+        module_name (string): importable module name
+        metadata (dict): PROTOCOL value of the module, None if the module does not declare it
+
+    Returns:
+        ProtocolPlugin: plugin, None if the module does not declare PROTOCOL
+    """
+    if metadata is None:
+        return None
+    return ProtocolPlugin(name, module_name, metadata['class'], tuple(metadata['signatures']),
+                          metadata.get('priority', DEFAULT_PRIORITY))
+
+
+# name -> ProtocolPlugin, filled once per process
+package_plugins = None
+entry_point_plugins = None
+
+
+def discover_package_plugins(package=PACKAGE):
+    """ Find protocol modules of a package
+
+    Args:
+        package (string, optional): package name. Defaults to PACKAGE.
+
+    Returns:
+        dict: protocol name -> ProtocolPlugin
+    """
+    plugins = {}
+    spec = importlib.util.find_spec(package)
+    for directory in spec.submodule_search_locations:
+        cache = load_metadata_cache(directory)
+        updated_cache = {}
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+            name, extension = os.path.splitext(entry.name)
+            if extension == '.py' and not name.startswith('_') and name not in plugins:
+                metadata = get_cached_protocol_metadata(entry, cache, updated_cache)
+                plugin = create_plugin(name, f'{package}.{name}', metadata)
+                if plugin is not None:
+                    plugins[name] = plugin
+        if updated_cache != cache:
+            save_metadata_cache(directory, updated_cache)
+    return plugins
+
+
+def discover_entry_point_plugins():
+    """ Find protocol modules of installed distributions, entry point values are module names
+
+    Returns:
+        dict: protocol name -> ProtocolPlugin
+    """
+    # importlib.metadata is slow to import, entry points are only read when they are asked for
+    import importlib.metadata
+    plugins = {}
+    for entry_point in importlib.metadata.entry_points(group=ENTRY_POINTS_GROUP):
+        spec = importlib.util.find_spec(entry_point.value)
+        metadata = None
+        # modules without a source file can not declare PROTOCOL
+        if spec is not None and spec.origin is not None and spec.origin.endswith('.py'):
+            metadata = read_protocol_metadata(spec.origin)
+        plugin = create_plugin(entry_point.name, entry_point.value, metadata)
+        if plugin is not None:
+            plugins[entry_point.name] = plugin
+    return plugins
+
+
+def get_plugins(names=None, entry_points=False):
+    """ Get plugins in registration order
+
+    Args:
+        names (iterable, optional): protocol names, None for every protocol. Defaults to None.
+        entry_points (bool, optional): also find modules of the entry point group, they are read anyway
+            when names has a protocol that is not in the package. Defaults to False.
+
+    Raises:
+        ValueError: a protocol of names is not found
+
+    Returns:
+        list: ProtocolPlugin list, ordered by priority and name
+    """
+    global package_plugins, entry_point_plugins
+    if package_plugins is None:
+        package_plugins = discover_package_plugins()
+    plugins = dict(package_plugins)
+    if names is not None:
+        names = list(names)
+        entry_points = entry_points or any(name not in plugins for name in names)
+    if entry_points:
+        if entry_point_plugins is None:
+            entry_point_plugins = discover_entry_point_plugins()
+        # modules of the package win over distributions with the same protocol name
+        for name, plugin in entry_point_plugins.items():
+            plugins.setdefault(name, plugin)
+    if names is not None:
+        unknown_names = [name for name in names if name not in plugins]
+        if unknown_names:
+            raise ValueError(f'unknown protocols: {", ".join(unknown_names)}')
+        plugins = {name: plugins[name] for name in names}
+    return sorted(plugins.values(), key=lambda plugin: (plugin.priority, plugin.name))
@@ -0,0 +1,247 @@
+""" Flow sampling and load shedding
+
+Two modes shed inspection work when packets arrive faster than they can be
+inspected:
+
+- flow: a new flow is kept when the CRC-32 of its direction independent key is
+  below rate * 2^32, so both directions of a flow get the same decision and
+  the packets of a kept flow are all processed. Packets of other flows are
+  dropped after their headers are decoded, they create no flow.
+- first-packet: every flow is created and its first packet is inspected, later
+  packets are kept with probability rate.
+
+A flow of the flow mode remembers the rate it was created with, its
+sampling_weight is 1 / rate. Counters of a sampled flow are exact and the
+flow stands for weight flows. Later packets of the first-packet mode raise
+the counters by 1 / rate of the rate they were kept with, so they estimate
+the counters of the whole flow (Horvitz-Thompson estimator) even when the
+rate changes mid-flow, and are rounded to integers before the flow is
+reported. The variance of the
+estimates is summed by protocol label, the report gives them with 95%
+confidence bounds.
+
+With a target lag, the rate is adjusted from the processing lag: wall clock
+time spent minus capture time read since the first packet. The rate is halved
+while the lag is above the target and growing, and raised again, up to the
+configured rate, once the lag is below half the target. In the flow mode a
+rate changed mid-flow applies to new flows, flows that are kept keep their
+weight. Flows rejected below the configured rate are remembered until they
+are idle for rejected_flow_timeout seconds of packet time, so a raised rate
+does not keep the rest of a flow it did not see start. In the first-packet
+mode a rate change applies to the next packets.
+"""
+import math
+import time
+import zlib
+import random
+from collections import OrderedDict
+
+
+# z value of two sided 95% confidence bounds
+CONFIDENCE_Z = 1.96
+
+
+class Sampler:
+    FLOW = 'flow'
+    FIRST_PACKET = 'first-packet'
+    MODES = (FLOW, FIRST_PACKET)
+
+    def __init__(self, rate=1.0, mode=FLOW, target_lag=None, min_rate=0.01, control_interval=1.0,
+                 control_packets=256, seed=None, rejected_flow_timeout=60.0, max_rejected_flows=65536):
+        if mode not in Sampler.MODES:
+            raise ValueError(f'unknown sampling mode: {mode}')
+        if not 0 < min_rate <= rate <= 1:
+            raise ValueError('sampling rates must be in (0, 1] and min_rate must not be above rate')
+        self.mode = mode
+        self.is_flow_mode = mode == Sampler.FLOW
+        self.max_rate = rate
+        self.min_rate = min_rate
+        # lowest rate used so far, the report tells how far the run degraded
+        self.lowest_rate = rate
+        # flows whose hash is below this threshold may be kept once the rate is raised again
+        self.max_hash_threshold = int(rate * 0x100000000)
+        # flow key -> timestamp of the last packet of flows rejected below max_hash_threshold,
+        # least recently seen first, only filled while the rate is below the configured rate
+        self.rejected_flows = OrderedDict()
+        self.rejected_flow_timeout = rejected_flow_timeout
+        self.max_rejected_flows = max_rejected_flows
+        self.set_rate(rate)
+        # None keeps the rate fixed
+        self.target_lag = target_lag
+        # seconds between two rate adjustments, the lag is read once every control_packets packets
+        self.control_interval = control_interval
+        self.control_packets = control_packets
+        self.packets_until_control = control_packets
+        self.first_timestamp = None
+        self.start_time = None
+        self.last_control_time = None
+        self.lag = 0.0
+        self.previous_lag = 0.0
+        self.random = random.Random(seed)
+        # decoded packets offered to the sampler and packets it kept
+        self.packets_count = 0
+        self.sampled_packets_count = 0
+        # label -> [flows, flows variance, packets, packets variance, bytes, bytes variance], summed by finish_flow
+        self.estimates = {}
+
+    def set_rate(self, rate):
+        """ Set the sampling rate of new flows and packets
+
+        Args:
+            rate (float): fraction of flows or packets that are kept
+        """
+        self.rate = rate
+        self.weight = 1 / rate
+        self.hash_threshold = int(rate * 0x100000000)
+        self.lowest_rate = min(self.lowest_rate, rate)
+
+    def is_flow_sampled(self, flow_key, timestamp):
+        """ Get the sampling decision of a packet of a flow that is not in the flow table,
+            the same for every packet of the flow
+
+        Args:
+            flow_key (bytes): direction independent flow key
+            timestamp (float): packet timestamp
+
+        Returns:
+            bool: True if the flow is kept
+        """
+        flow_hash = zlib.crc32(flow_key)
+        rejected_flows = self.rejected_flows
+        if rejected_flows:
+            # flows idle for longer than the timeout start again as new flows
+            deadline = timestamp - self.rejected_flow_timeout
+            while rejected_flows and rejected_flows[next(iter(rejected_flows))] < deadline:
+                rejected_flows.popitem(last=False)
+            if flow_key in rejected_flows:
+                rejected_flows[flow_key] = timestamp
+                rejected_flows.move_to_end(flow_key)
+                return False
+        if flow_hash < self.hash_threshold:
+            return True
+        if flow_hash < self.max_hash_threshold:
+            # a raised rate would keep this flow from a packet after its start
+            rejected_flows[flow_key] = timestamp
+            if len(rejected_flows) > self.max_rejected_flows:
+                rejected_flows.popitem(last=False)
+        return False
+
+    def is_packet_sampled(self):
+        """ Get the sampling decision of a packet that is not the first of its flow
+
+        Returns:
+            bool: True if the packet is kept
+        """
+        return self.random.random() < self.rate
+
+    def control(self, timestamp):
+        """ Adjust the rate from the processing lag, called for every packet when a target lag is set
+
+        Args:
+            timestamp (float): packet timestamp
+        """
+        self.packets_until_control -= 1
+        if self.packets_until_control > 0:
+            return
+        self.packets_until_control = self.control_packets
+        now = time.monotonic()
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+            self.start_time = self.last_control_time = now
+            return
+        if now - self.last_control_time < self.control_interval:
+            return
+        self.last_control_time = now
+        self.lag = (now - self.start_time) - (timestamp - self.first_timestamp)
+        if self.lag > self.target_lag:
+            # a lag that shrinks is already recovering, halving again would overshoot
+            if self.lag >= self.previous_lag and self.rate > self.min_rate:
+                self.set_rate(max(self.min_rate, self.rate / 2))
+        elif self.lag < self.target_lag / 2 and self.rate < self.max_rate:
+            self.set_rate(min(self.max_rate, self.rate * 1.25))
+        self.previous_lag = self.lag
+
+    def finish_flow(self, flow):
+        """ Add the estimates of a flow to the report and round its counters, called before it is reported
+
+        Args:
+            flow (Flow): flow created by a sampling worker
+        """
+        weight = flow.sampling_weight
+        packets_count = flow.sent_packets_count + flow.recieved_packets_count
+        bytes_count = flow.sent_bytes_count + flow.recieved_bytes_count
+        if self.is_flow_mode:
+            # every packet of the flow is kept with the flow, the flow is a cluster of packets
+            flows_count = weight
+            flows_variance = (weight - 1) * weight
+            packets_variance = flows_variance * packets_count ** 2
+            bytes_variance = flows_variance * bytes_count ** 2
+            packets_count *= weight
+            bytes_count *= weight
+        else:
+            # the first packet is always kept, later packets are kept one by one with the rate of their
+            # time, their variance was summed from the weights they were scaled by
+            flows_count = 1
+            flows_variance = 0
+            packets_variance = flow.sampling_variance
+            # packet sizes of the flow are taken as their mean
+            bytes_variance = packets_variance * (bytes_count / packets_count) ** 2
+        estimates = self.estimates.get(flow.protocol)
+        if estimates is None:
+            estimates = self.estimates[flow.protocol] = [0, 0.0, 0.0, 0.0, 0.0, 0.0]
+        estimates[0] += flows_count
+        estimates[1] += flows_variance
+        estimates[2] += packets_count
+        estimates[3] += packets_variance
+        estimates[4] += bytes_count
+        estimates[5] += bytes_variance
+        # counters of the flow are reported as estimates of the whole flow
+        counters_weight = weight if self.is_flow_mode else 1
+        flow.sent_packets_count = round(flow.sent_packets_count * counters_weight)
+        flow.recieved_packets_count = round(flow.recieved_packets_count * counters_weight)
+        flow.sent_bytes_count = round(flow.sent_bytes_count * counters_weight)
+        flow.recieved_bytes_count = round(flow.recieved_bytes_count * counters_weight)
+
+    def get_statistics(self):
+        """ Get sampling counters and estimates of every protocol label
+
+        Returns:
+            dict: mode, rates, lag, packets and label -> estimates with their 95% confidence bounds
+        """
+        protocols = {}
+        for protocol, (flows_count, flows_variance, packets_count, packets_variance,
+                       bytes_count, bytes_variance) in self.estimates.items():
+            protocols[protocol] = {
+                'flows': round(flows_count),
+                'flows_bound': round(CONFIDENCE_Z * math.sqrt(flows_variance)),
+                'packets': round(packets_count),
+                'packets_bound': round(CONFIDENCE_Z * math.sqrt(packets_variance)),
+                'bytes': round(bytes_count),
+                'bytes_bound': round(CONFIDENCE_Z * math.sqrt(bytes_variance)),
+            }
+        return {
+            'mode': self.mode,
+            'rate': self.rate,
+            'lowest_rate': self.lowest_rate,
+            'lag': self.lag,
+            'packets': self.packets_count,
+            'sampled_packets': self.sampled_packets_count,
+            'protocols': protocols,
+        }
+
+    def get_report(self):
+        """ Get sampling report, estimates of every protocol label with their 95% confidence bounds
+
+        Returns:
+            string: sampling report
+        """
+        statistics = self.get_statistics()
+        lines = [f'### sampling: mode: {statistics["mode"]}, rate: {statistics["rate"]:g}, '
+                 f'lowest rate: {statistics["lowest_rate"]:g}, '
+                 f'sampled packets: {statistics["sampled_packets"]} of {statistics["packets"]}']
+        protocols = sorted(statistics['protocols'].items(), key=lambda item: -item[1]['packets'])
+        for protocol, estimates in protocols:
+            lines.append(f'{protocol}: flows: {estimates["flows"]} ± {estimates["flows_bound"]}, '
+                         f'packets: {estimates["packets"]} ± {estimates["packets_bound"]}, '
+                         f'bytes: {estimates["bytes"]} ± {estimates["bytes_bound"]}')
+        return '\n'.join(lines) + '\n'
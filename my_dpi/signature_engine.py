@@ -0,0 +1,341 @@
+import re
+import time
+# the dispatch table reads patterns with the private regex parser,
+# without it every signature is a candidate for every first byte
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    try:
+        import sre_parse
+    except ImportError:
+        sre_parse = None
+
+
+# every possible value of the first payload byte
+ALL_BYTES = frozenset(range(256))
+
+
+def _first_bytes_of_sequence(items):
+    """ Find the bytes a parsed regex sequence can start with
+
+    Args:
+        items (list): parsed regex items (output of sre_parse)
+
+    Returns:
+        frozenset, bool: possible first bytes and True if the sequence can match empty
+    """
+    first_bytes = set()
+    for item in items:
+        item_first_bytes, nullable = _first_bytes_of_item(*item)
+        first_bytes |= item_first_bytes
+        if not nullable:
+            return frozenset(first_bytes), False
+    return frozenset(first_bytes), True
+
+
+def _first_bytes_of_item(opcode, argument):
+    """ Find the bytes a single parsed regex item can start with
+        unknown opcodes fall back to every byte, so the result is always a superset
+
+    Args:
+        opcode (sre_constants._NamedIntConstant): item opcode
+        argument (object): item argument
+
+    Returns:
+        frozenset, bool: possible first bytes and True if the item can match empty
+    """
+    if opcode is sre_parse.LITERAL:
+        return frozenset((argument,)), False
+    if opcode is sre_parse.NOT_LITERAL:
+        return ALL_BYTES - {argument}, False
+    if opcode is sre_parse.ANY:
+        return ALL_BYTES, False
+    if opcode is sre_parse.IN:
+        return _first_bytes_of_set(argument), False
+    if opcode is sre_parse.BRANCH:
+        first_bytes = set()
+        nullable = False
+        for branch in argument[1]:
+            branch_first_bytes, branch_nullable = _first_bytes_of_sequence(branch)
+            first_bytes |= branch_first_bytes
+            nullable = nullable or branch_nullable
+        return frozenset(first_bytes), nullable
+    if opcode is sre_parse.SUBPATTERN:
+        # (group, add_flags, del_flags, pattern)
+        return _first_bytes_of_sequence(argument[-1])
+    if opcode in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+                  getattr(sre_parse, 'POSSESSIVE_REPEAT', None)):
+        minimum, _, pattern = argument
+        first_bytes, nullable = _first_bytes_of_sequence(pattern)
+        return first_bytes, nullable or minimum == 0
+    if opcode is getattr(sre_parse, 'ATOMIC_GROUP', None):
+        return _first_bytes_of_sequence(argument)
+    if opcode in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        # zero width items do not consume the first byte
+        return frozenset(), True
+    return ALL_BYTES, True
+
+
+def _first_bytes_of_set(items):
+    """ Find the bytes matched by a character class like [\\x00-\\x0f]
+
+    Args:
+        items (list): parsed items of the IN opcode
+
+    Returns:
+        frozenset: bytes matched by the class
+    """
+    first_bytes = set()
+    negate = False
+    for opcode, argument in items:
+        if opcode is sre_parse.NEGATE:
+            negate = True
+        elif opcode is sre_parse.LITERAL:
+            first_bytes.add(argument)
+        elif opcode is sre_parse.RANGE:
+            first_bytes.update(range(argument[0], argument[1] + 1))
+        else:
+            # categories (\d, \s, ...) are rare in signatures, be conservative
+            return ALL_BYTES
+    if negate:
+        return ALL_BYTES - first_bytes
+    return frozenset(first_bytes)
+
+
+def get_pattern_first_bytes(pattern, flags=0):
+    """ Find every byte the payload can start with when pattern matches
+        only patterns anchored with ^ can be restricted, others may start matching anywhere
+
+    Args:
+        pattern (byte raw string): regular expression pattern
+        flags (int): regular expression flags
+
+    Returns:
+        frozenset: possible first payload bytes, every byte when the parser is unavailable or fails
+    """
+    if sre_parse is None or flags & (re.IGNORECASE | re.MULTILINE):
+        return ALL_BYTES
+    # the private parser may change between Python versions, the pattern itself was compiled already
+    try:
+        items = list(sre_parse.parse(pattern, flags))
+        if not items or items[0] != (sre_parse.AT, sre_parse.AT_BEGINNING):
+            return ALL_BYTES
+        first_bytes, nullable = _first_bytes_of_sequence(items[1:])
+    except Exception:
+        return ALL_BYTES
+    if nullable:
+        return ALL_BYTES
+    return first_bytes
+
+
+def get_pattern_min_length(pattern, flags=0):
+    """ Find the minimum length of data a pattern can match
+
+    Args:
+        pattern (byte raw string): regular expression pattern
+        flags (int): regular expression flags
+
+    Returns:
+        int: minimum match length, 0 when the parser is unavailable or fails
+    """
+    if sre_parse is None:
+        return 0
+    try:
+        return sre_parse.parse(pattern, flags).getwidth()[0]
+    except Exception:
+        return 0
+
+
+class Signature:
+    __slots__ = (
+        'pattern', 'regex', 'callback', 'first_bytes', 'ports', 'strict_ports', 'min_length',
+        'tests_count', 'matches_count', 'detections_count', 'callback_seconds',
+    )
+
+    def __init__(self, pattern, callback, ports=(), min_length=0, strict_ports=False, flags=re.DOTALL):
+        self.pattern = pattern
+        self.regex = re.compile(pattern, flags)
+        self.callback = callback
+        self.first_bytes = get_pattern_first_bytes(pattern, flags)
+        # expected source or destination ports, tried first when one of them matches
+        self.ports = frozenset(ports)
+        # only try the signature when a port matches
+        self.strict_ports = strict_ports
+        # shorter payloads can not match, the regex length bound is used when it is larger
+        self.min_length = max(min_length, get_pattern_min_length(pattern, flags))
+        # number of regex searches, regex matches and flows the callback classified
+        self.tests_count = 0
+        self.matches_count = 0
+        self.detections_count = 0
+        # seconds spent in callback, counted when the engine times callbacks
+        self.callback_seconds = 0.0
+
+    def get_hit_rate(self):
+        """ Get smoothed rate of regex searches that classified the flow
+
+        Returns:
+            float: hit rate
+        """
+        return (self.detections_count + 1) / (self.tests_count + 2)
+
+    def get_statistics(self):
+        """ Get signature counters
+
+        Returns:
+            dict: pattern, callback name and counters
+        """
+        return {
+            'pattern': self.pattern,
+            'callback': getattr(self.callback, '__qualname__', repr(self.callback)),
+            'tests': self.tests_count,
+            'matches': self.matches_count,
+            'detections': self.detections_count,
+            'callback_seconds': self.callback_seconds,
+        }
+
+
+class SignatureEngine:
+    """ Precompiled signatures with a leading byte dispatch table
+
+    Every signature is compiled once when it is registered, and added to
+    the dispatch table entries of the bytes a matching payload can start with.
+    Candidates of a packet are filtered by the minimum length and strict ports
+    of the signatures. Signatures expecting one of the packet ports are tried
+    first, then the others by hit rate, and the first one whose callback
+    detects the protocol wins. The hit rate order is updated every
+    reorder_interval packets, ties keep the registration order.
+    """
+
+    def __init__(self, reorder_interval=1024):
+        self.signatures = []
+        # dispatch_table[byte] is a tuple of signatures that can match a payload starting with byte
+        self.dispatch_table = [()] * 256
+        # every port expected by a signature
+        self.expected_ports = frozenset()
+        # ordered candidates by (first byte, expected source port, expected destination port)
+        self.candidates_cache = {}
+        self.reorder_interval = reorder_interval
+        self.packets_until_reorder = reorder_interval
+        # measure time spent in callbacks, set by Metrics
+        self.callback_timing = False
+
+    def register(self, pattern, callback, ports=(), min_length=0, strict_ports=False):
+        """ Compile pattern and add it to the dispatch table
+            registering the same pattern again replaces its callback and pre-conditions
+
+        Args:
+            pattern (byte raw string): regular expression pattern
+            callback (function): callback function
+            ports (iterable, optional): expected source or destination ports. Defaults to ().
+            min_length (int, optional): minimum payload length. Defaults to 0.
+            strict_ports (bool, optional): only try the signature when a port matches. Defaults to False.
+
+        Returns:
+            Signature: registered signature
+        """
+        signature = Signature(pattern, callback, ports, min_length, strict_ports)
+        for index, registered_signature in enumerate(self.signatures):
+            if registered_signature.pattern == pattern:
+                self.signatures[index] = signature
+                break
+        else:
+            self.signatures.append(signature)
+        self.expected_ports = frozenset().union(*(signature.ports for signature in self.signatures))
+        self.build_dispatch_table()
+        return signature
+
+    def build_dispatch_table(self):
+        """ Rebuild dispatch table from registered signatures, ordered by hit rate
+        """
+        # sort is stable, signatures with the same hit rate stay in registration order
+        signatures = sorted(self.signatures, key=Signature.get_hit_rate, reverse=True)
+        self.dispatch_table = [
+            tuple(signature for signature in signatures
+                  if first_byte in signature.first_bytes)
+            for first_byte in range(256)
+        ]
+        self.candidates_cache = {}
+
+    def get_candidates(self, packet_data, src_port=None, dst_port=None):
+        """ Get signatures that can match packet data, without the minimum length check
+
+        Args:
+            packet_data (bytes): application layer data
+            src_port (int, optional): source port. Defaults to None.
+            dst_port (int, optional): destination port. Defaults to None.
+
+        Returns:
+            tuple: candidate signatures, the ones expecting a packet port first
+        """
+        if not packet_data:
+            return ()
+        # ports no signature expects share one cache entry
+        if src_port not in self.expected_ports:
+            src_port = None
+        if dst_port not in self.expected_ports:
+            dst_port = None
+        key = (packet_data[0], src_port, dst_port)
+        candidates = self.candidates_cache.get(key)
+        if candidates is None:
+            port_candidates = []
+            other_candidates = []
+            for signature in self.dispatch_table[packet_data[0]]:
+                if src_port in signature.ports or dst_port in signature.ports:
+                    port_candidates.append(signature)
+                elif not signature.strict_ports:
+                    other_candidates.append(signature)
+            candidates = self.candidates_cache[key] = tuple(port_candidates + other_candidates)
+        return candidates
+
+    def feed(self, flow, application_packet):
+        """ Match candidate signatures with application packet data and call
+            the callback of every matched signature until the flow protocol is detected,
+            the first callback that requested more packets of the flow keeps it when none does
+
+        Args:
+            flow (Flow): flow
+            application_packet (Packet): application layer packet
+
+        Returns:
+            bool: True if the flow protocol is detected
+        """
+        self.packets_until_reorder -= 1
+        if self.packets_until_reorder <= 0:
+            self.packets_until_reorder = self.reorder_interval
+            self.build_dispatch_table()
+        packet_data = application_packet.packet_data
+        packet_length = len(packet_data)
+        # inspection callback, budget and direction of the first callback that requested more packets
+        pending_request = None
+        for signature in self.get_candidates(packet_data, flow.src_port, flow.dst_port):
+            if packet_length < signature.min_length:
+                continue
+            signature.tests_count += 1
+            if signature.regex.search(packet_data) is None:
+                continue
+            signature.matches_count += 1
+            if self.callback_timing:
+                start_time = time.perf_counter()
+                signature.callback(flow, application_packet)
+                signature.callback_seconds += time.perf_counter() - start_time
+            else:
+                signature.callback(flow, application_packet)
+            if flow.is_protocol_detected():
+                signature.detections_count += 1
+                return True
+            # the callback waits for more packets, later candidates may still classify the flow
+            if flow.inspection_callback is not None:
+                if pending_request is None:
+                    pending_request = (flow.inspection_callback, flow.inspection_budget, flow.inspection_direction)
+                flow.inspection_callback = None
+        if pending_request is not None:
+            flow.request_more_packets(*pending_request)
+        return False
+
+    def get_statistics(self):
+        """ Get counters of every signature
+
+        Returns:
+            list: dict of counters of every signature in registration order
+        """
+        return [signature.get_statistics() for signature in self.signatures]
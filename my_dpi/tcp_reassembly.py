@@ -0,0 +1,194 @@
+class TcpStream:
+    """ Reassembled prefix of one direction of a TCP flow
+    """
+
+    __slots__ = ('base_sequence', 'data', 'segments', 'buffered_bytes')
+
+    def __init__(self, base_sequence):
+        # sequence number of the first byte of data
+        self.base_sequence = base_sequence
+        # contiguous bytes from base_sequence
+        self.data = bytearray()
+        # out of order segments after data: offset -> bytes
+        self.segments = {}
+        self.buffered_bytes = 0
+
+
+class TcpReassembler:
+    """ Sequence ordered reassembly of the first prefix_size bytes of every TCP direction
+
+    Memory is bounded by flow_budget bytes per flow (both directions, in order and
+    out of order bytes) and global_budget bytes for every flow. A flow that would go
+    above a budget gives up reassembly and its buffers are released at once,
+    like flows that are classified or whose prefixes are full.
+
+    A direction starts at its first segment. A later segment that starts less
+    than prefix_size bytes before it moves the start back, so a stream start
+    that arrives after the next segments is not lost; a segment that starts
+    further before only adds its bytes after the current start.
+    """
+
+    def __init__(self, prefix_size=4096, flow_budget=8192, global_budget=64 * 1024 * 1024):
+        self.prefix_size = prefix_size
+        self.flow_budget = flow_budget
+        self.global_budget = global_budget
+        # flow -> [client stream, server stream]
+        self.streams = {}
+        # bytes buffered by every flow
+        self.buffered_bytes = 0
+
+    def __contains__(self, flow):
+        return flow in self.streams
+
+    def start(self, flow, application_packet):
+        """ Start reassembly of a flow from its first payload segment
+
+        Args:
+            flow (Flow): flow
+            application_packet (Packet): first application layer packet of the flow
+
+        Returns:
+            bool: True if reassembly is started
+        """
+        if application_packet.tcp_sequence is None or len(application_packet.packet_data) >= self.prefix_size:
+            return False
+        self.streams[flow] = [None, None]
+        self.add_segment(flow, application_packet)
+        return flow in self.streams
+
+    def add_segment(self, flow, application_packet):
+        """ Add a segment to the stream of its direction
+
+        Args:
+            flow (Flow): flow
+            application_packet (Packet): application layer packet
+
+        Returns:
+            bytes: reassembled prefix of the packet direction if it grew, None otherwise
+        """
+        flow_streams = self.streams.get(flow)
+        if flow_streams is None:
+            return None
+        direction = 0 if application_packet.is_packet_from_client else 1
+        stream = flow_streams[direction]
+        sequence = application_packet.tcp_sequence
+        payload = application_packet.packet_data
+        if stream is None:
+            stream = flow_streams[direction] = TcpStream(sequence)
+        # offset from the first byte of the stream, sequence numbers wrap at 2^32
+        offset = (sequence - stream.base_sequence) & 0xffffffff
+        if offset >= 0x80000000:
+            shift = 0x100000000 - offset
+            if shift < self.prefix_size:
+                # the stream start arrived after later segments, the stream starts at this segment
+                self.rebase(stream, shift)
+            else:
+                # segment starts more than a prefix before the stream, keep only its new bytes
+                payload = payload[shift:]
+            offset = 0
+        if offset >= self.prefix_size:
+            # segment after the prefix
+            return None
+        prefix_length = len(stream.data)
+        end = min(offset + len(payload), self.prefix_size)
+        if end <= prefix_length:
+            # retransmission of reassembled bytes
+            return None
+        if offset > prefix_length:
+            # out of order segment, kept until the gap is filled
+            segment = bytes(payload[:end - offset])
+            previous_segment = stream.segments.get(offset, b'')
+            if len(segment) > len(previous_segment) and self.reserve(
+                    flow, flow_streams, stream, len(segment) - len(previous_segment)):
+                stream.segments[offset] = segment
+            return None
+        if not self.reserve(flow, flow_streams, stream, end - prefix_length):
+            return None
+        stream.data += payload[prefix_length - offset:end - offset]
+        self.merge_segments(stream)
+        data = bytes(stream.data)
+        if len(data) >= self.prefix_size:
+            # prefix is complete, nothing more to reassemble in this flow
+            self.release(flow)
+        return data
+
+    def rebase(self, stream, shift):
+        """ Move the start of a stream shift bytes before its first byte,
+            its bytes become out of order segments and bytes after the prefix are released
+
+        Args:
+            stream (TcpStream): stream
+            shift (int): number of bytes between the new and the current first byte, below prefix_size
+        """
+        segments = {offset + shift: segment for offset, segment in stream.segments.items()}
+        if stream.data:
+            segments[shift] = bytes(stream.data)
+        stream.base_sequence = (stream.base_sequence - shift) & 0xffffffff
+        stream.data = bytearray()
+        stream.segments = {}
+        for offset, segment in segments.items():
+            kept_segment = segment[:max(self.prefix_size - offset, 0)]
+            released_length = len(segment) - len(kept_segment)
+            stream.buffered_bytes -= released_length
+            self.buffered_bytes -= released_length
+            if kept_segment:
+                stream.segments[offset] = kept_segment
+
+    def merge_segments(self, stream):
+        """ Append out of order segments that became contiguous with data
+
+        Args:
+            stream (TcpStream): stream
+        """
+        segments = stream.segments
+        while segments:
+            prefix_length = len(stream.data)
+            merged = False
+            for offset in sorted(segments):
+                if offset > prefix_length:
+                    break
+                segment = segments.pop(offset)
+                stream.buffered_bytes -= len(segment)
+                self.buffered_bytes -= len(segment)
+                new_bytes = segment[prefix_length - offset:]
+                if new_bytes:
+                    stream.data += new_bytes
+                    stream.buffered_bytes += len(new_bytes)
+                    self.buffered_bytes += len(new_bytes)
+                    merged = True
+                    break
+            if not merged:
+                return
+
+    def reserve(self, flow, flow_streams, stream, length):
+        """ Account length more bytes for stream, the flow gives up reassembly if a budget is spent
+
+        Args:
+            flow (Flow): flow
+            flow_streams (list): streams of the flow
+            stream (TcpStream): stream that buffers the bytes
+            length (int): number of bytes
+
+        Returns:
+            bool: True if bytes can be buffered
+        """
+        flow_bytes = sum(flow_stream.buffered_bytes for flow_stream in flow_streams if flow_stream is not None)
+        if flow_bytes + length > self.flow_budget or self.buffered_bytes + length > self.global_budget:
+            self.release(flow)
+            return False
+        stream.buffered_bytes += length
+        self.buffered_bytes += length
+        return True
+
+    def release(self, flow):
+        """ Release buffers of a flow, reassembly of the flow is finished
+
+        Args:
+            flow (Flow): flow
+        """
+        flow_streams = self.streams.pop(flow, None)
+        if flow_streams is None:
+            return
+        for stream in flow_streams:
+            if stream is not None:
+                self.buffered_bytes -= stream.buffered_bytes
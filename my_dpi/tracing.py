@@ -0,0 +1,216 @@
+""" Tracing of targeted flows
+
+A FlowTracer is configured with targets and checks every new flow against
+them once, when the flow is created:
+
+    10.0.0.1, 2001:db8::1            address, as either endpoint
+    10.0.0.0/8, 2001:db8::/32        network, as either endpoint
+    10.0.0.1:53, [2001:db8::1]:443   endpoint (address and port)
+    udp 10.0.0.1:5353 10.0.0.2:53    5-tuple, in either direction
+
+5-tuples are kept as canonical flow keys in a set, endpoints in a set of
+(address, port) and networks in a set of prefixes of every prefix length,
+so a new flow costs a few set lookups whatever the number of targets.
+Packets of traced flows are written to the trace file with the decoder that
+read them, their direction and payload, and the inspection state, label
+and pending module callback after MyDpi saw them. Workers only use the
+tracing path when a tracer is configured.
+"""
+import sys
+import socket
+import ipaddress
+from my_dpi.five_tuple import FiveTuple
+
+
+class FlowTracer:
+
+    def __init__(self, targets, path='-'):
+        # canonical flow keys of 5-tuple targets
+        self.flow_keys = set()
+        # (address, port) of endpoint targets
+        self.endpoints = set()
+        # (address length, prefix length) -> network prefixes as integers
+        self.networks = {}
+        for target in targets:
+            self.add_target(target)
+        # traced flow key -> description of the flow in trace lines
+        self.traced_flows = {}
+        self.path = path
+        self.file = sys.stderr if path == '-' else open(path, 'w', buffering=1 << 16)
+
+    @staticmethod
+    def parse_endpoint(endpoint):
+        """ Parse ADDRESS:PORT or [IPV6 ADDRESS]:PORT
+
+        Args:
+            endpoint (string): endpoint
+
+        Raises:
+            ValueError: endpoint is not valid
+
+        Returns:
+            tuple: packed address and port
+        """
+        address, separator, port = endpoint.rpartition(':')
+        if not separator or not port.isdigit() or int(port) > 0xffff:
+            raise ValueError(f'invalid trace endpoint {endpoint!r}')
+        if address.startswith('[') and address.endswith(']'):
+            address = address[1:-1]
+        try:
+            return ipaddress.ip_address(address).packed, int(port)
+        except ValueError:
+            raise ValueError(f'invalid trace endpoint {endpoint!r}') from None
+
+    @staticmethod
+    def parse_target(target):
+        """ Parse a trace target
+
+        Args:
+            target (string): address, network, endpoint or 5-tuple, see the module documentation
+
+        Raises:
+            ValueError: target is not valid
+
+        Returns:
+            tuple: ('flow', canonical flow key), ('endpoint', (address, port))
+                or ('network', (address length, prefix length, prefix))
+        """
+        fields = target.split()
+        if len(fields) == 3:
+            if fields[0].lower() not in ('tcp', 'udp'):
+                raise ValueError(f'invalid trace 5-tuple {target!r}, it starts with tcp or udp')
+            src_ip, src_port = FlowTracer.parse_endpoint(fields[1])
+            dst_ip, dst_port = FlowTracer.parse_endpoint(fields[2])
+            flow_key, _ = FiveTuple.get_flow_key(src_ip, dst_ip, fields[0].lower() == 'tcp', src_port, dst_port)
+            return 'flow', flow_key
+        if len(fields) != 1:
+            raise ValueError(f'invalid trace target {target!r}')
+        # IPv6 addresses have colons too, an endpoint is a bracketed IPv6 address or an IPv4 address with a port
+        if target.startswith('[') or target.count(':') == 1:
+            return 'endpoint', FlowTracer.parse_endpoint(target)
+        try:
+            network = ipaddress.ip_network(target, strict=False)
+        except ValueError:
+            raise ValueError(f'invalid trace target {target!r}') from None
+        shift = network.max_prefixlen - network.prefixlen
+        return 'network', (len(network.network_address.packed), network.prefixlen,
+                           int(network.network_address) >> shift)
+
+    def add_target(self, target):
+        """ Add a trace target
+
+        Args:
+            target (string): address, network, endpoint or 5-tuple, see the module documentation
+
+        Raises:
+            ValueError: target is not valid
+        """
+        kind, value = FlowTracer.parse_target(target)
+        if kind == 'flow':
+            self.flow_keys.add(value)
+        elif kind == 'endpoint':
+            self.endpoints.add(value)
+        else:
+            address_length, prefix_length, prefix = value
+            self.networks.setdefault((address_length, prefix_length), set()).add(prefix)
+
+    def is_address_traced(self, ip_address):
+        address_length = len(ip_address)
+        address = int.from_bytes(ip_address, 'big')
+        for (network_address_length, prefix_length), prefixes in self.networks.items():
+            if network_address_length == address_length and \
+                    address >> (address_length * 8 - prefix_length) in prefixes:
+                return True
+        return False
+
+    def check_new_flow(self, flow_key, flow, timestamp):
+        """ Check a new flow against the targets, called once per flow
+
+        Args:
+            flow_key (bytes): canonical flow key
+            flow (Flow): new flow, before its first packet is counted
+            timestamp (float): timestamp of the first packet
+
+        Returns:
+            bool: True if the flow is traced
+        """
+        if not (flow_key in self.flow_keys or
+                (flow.src_ip, flow.src_port) in self.endpoints or
+                (flow.dst_ip, flow.dst_port) in self.endpoints or
+                (self.networks and (self.is_address_traced(flow.src_ip) or self.is_address_traced(flow.dst_ip)))):
+            return False
+        description = (f'{"tcp" if flow.payload_type else "udp"} '
+                       f'{FlowTracer.format_endpoint(flow.src_ip, flow.src_port)} > '
+                       f'{FlowTracer.format_endpoint(flow.dst_ip, flow.dst_port)}')
+        self.traced_flows[flow_key] = description
+        self.write(timestamp, description, 'new flow')
+        return True
+
+    @staticmethod
+    def format_endpoint(ip_address, port):
+        if len(ip_address) == 16:
+            return f'[{socket.inet_ntop(socket.AF_INET6, ip_address)}]:{port}'
+        return f'{socket.inet_ntoa(ip_address)}:{port}'
+
+    def write(self, timestamp, description, event):
+        self.file.write(f'{timestamp:.6f} {description}: {event}\n')
+
+    def trace_packet(self, description, flow, application_packet, decoder):
+        """ Write the decoding of a packet of a traced flow, before it is inspected
+
+        Args:
+            description (string): description of the flow
+            flow (Flow): traced flow
+            application_packet (Packet): packet
+            decoder (string): fast_parser or dpkt
+        """
+        direction = 'client' if application_packet.is_packet_from_client else 'server'
+        sequence = ''
+        if application_packet.tcp_sequence is not None:
+            sequence = f', sequence {application_packet.tcp_sequence}'
+        payload = bytes(application_packet.packet_data[:16])
+        self.write(application_packet.packet_timestamp, description,
+                   f'packet from {direction}, decoded by {decoder}, payload {len(application_packet.packet_data)} bytes'
+                   f'{sequence}, starts with {payload.hex()}')
+        if not flow.is_inspecting():
+            self.write(application_packet.packet_timestamp, description,
+                       f'not inspected, {flow.inspection_state}: {flow.protocol}')
+
+    def trace_inspection(self, description, flow, application_packet):
+        """ Write the inspection state of a traced flow after MyDpi saw a packet
+
+        Args:
+            description (string): description of the flow
+            flow (Flow): traced flow
+            application_packet (Packet): inspected packet
+        """
+        callback = flow.inspection_callback
+        waiting = ''
+        if callback is not None:
+            waiting = (f', waiting for {getattr(callback, "__qualname__", callback)} '
+                       f'with {flow.inspection_budget} packets left')
+        names = ''
+        if flow.server_name is not None or flow.application_protocols is not None:
+            names = f', server name {flow.server_name}, alpn {flow.application_protocols}'
+        self.write(application_packet.packet_timestamp, description,
+                   f'inspected, {flow.inspection_state}: {flow.protocol}{waiting}{names}')
+
+    def finish_flow(self, flow, reason):
+        """ Write the end of a traced flow, called for every flow that leaves the flow table
+
+        Args:
+            flow (Flow): flow that leaves the flow table
+            reason (string): why the flow leaves
+        """
+        flow_key = flow.get_flow_key_of_flow()
+        description = self.traced_flows.pop(flow_key, None)
+        if description is not None:
+            self.write(flow.flow_last_time, description,
+                       f'{reason}, {flow.protocol}, {flow.get_total_packets_count()} packets, '
+                       f'{flow.get_total_bytes_count()} bytes')
+
+    def close(self):
+        if self.file is not sys.stderr:
+            self.file.close()
+        else:
+            self.file.flush()
@@ -0,0 +1,178 @@
+import queue
+import multiprocessing
+from worker import Worker, ExpiredFlowSender, FLOWS
+from my_dpi.flow_table import FlowTable
+from my_dpi.five_tuple import FiveTuple
+from my_dpi.pcap_reader import PcapReader
+from my_dpi import fast_parser
+from my_dpi.checkpoint import load_checkpoint
+
+
+def get_packet_shard(packet_payload, shards_count):
+    """ Map packet to a shard by its direction independent flow key
+        both directions of a flow go to the same shard, packets that are
+        not decoded by the fast parser go to the first shard
+
+    Args:
+        packet_payload (bytes): packet bytes
+        shards_count (int): number of shards
+
+    Returns:
+        int: shard index
+    """
+    decoded_packet = fast_parser.decode_packet(packet_payload)
+    if not isinstance(decoded_packet, tuple):
+        return 0
+    flow_key, _ = FiveTuple.get_flow_key(*decoded_packet[:5])
+    return hash(flow_key) % shards_count
+
+
+def shard_process(my_dpi_factory, flow_table_factory, packets_queue, results_queue, shard_flows=(),
+                  expired_batch_size=1024):
+    """ Process packets of one shard with its own Worker/MyDpi pair, send expired flows
+        back as they expire and the shard flows when the end of capture is reached
+
+    Args:
+        my_dpi_factory (callable): returns a new MyDpi instance
+        flow_table_factory (callable): returns a new FlowTable instance
+        packets_queue (multiprocessing.Queue): batches of (timestamp, packet bytes), None at the end
+        results_queue (multiprocessing.Queue): queue of (EXPIRED_FLOWS, (flow, reason) list) messages
+            and one (FLOWS, (key, flow) list) message at the end
+        shard_flows (list, optional): (key, flow) list of the shard loaded from a checkpoint. Defaults to ().
+        expired_batch_size (int, optional): expired flows sent in one message. Defaults to 1024.
+    """
+    dpi_worker = Worker(my_dpi_factory(), flow_table_factory())
+    for flow_key, flow in shard_flows:
+        dpi_worker.flows_dict.add(flow_key, flow)
+    # the exporter lives in the main process, the shard only keeps a batch of expired flows
+    expired_flow_sender = ExpiredFlowSender(results_queue, expired_batch_size)
+    dpi_worker.flow_reporter = expired_flow_sender
+    while True:
+        packets_batch = packets_queue.get()
+        if packets_batch is None:
+            break
+        for timestamp, buffer in packets_batch:
+            dpi_worker.process_packet(buffer, timestamp)
+    expired_flow_sender.flush()
+    flows = list(dpi_worker.flows_dict.items())
+    for _, flow in flows:
+        # module callbacks stay in this process, they may not be picklable
+        if flow.is_inspecting():
+            flow.give_up()
+    results_queue.put((FLOWS, flows))
+
+
+class ShardedWorker(Worker):
+    """ Worker that reads a capture once and shards its packets by flow
+        to several processes, then merges the per-shard flows into one report
+    """
+
+    def __init__(self, my_dpi_factory, workers_count, flow_table_factory=FlowTable, batch_size=1024, queue_size=64,
+                 packet_filter=None):
+        # packets are filtered here, before they are copied to the shards
+        Worker.__init__(self, None, packet_filter=packet_filter)
+        self.my_dpi_factory = my_dpi_factory
+        self.flow_table_factory = flow_table_factory
+        # expired flows of the shards are reported by the main process
+        self.flow_reporter = flow_table_factory().expired_flow_callback
+        self.workers_count = workers_count
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        # flows of a checkpoint, sent to the process of their shard
+        self.checkpoint_flows = []
+
+    def load_checkpoint(self, path):
+        """ Keep flows of a checkpoint file until they are sent to their shards by executor
+
+        Args:
+            path (string): checkpoint file path
+        """
+        self.checkpoint_flows.extend(load_checkpoint(path))
+
+    def executor(self, pcap_file_name):
+        """ Read every packet from pcap or pcapng file and feed it to the process of its shard
+
+        Args:
+            pcap_file_name (string): path of the pcap file
+        """
+        results_queue = multiprocessing.Queue()
+        packets_queues = []
+        processes = []
+        checkpoint_shards_flows = [[] for _ in range(self.workers_count)]
+        # same mapping as get_packet_shard, next packets of a checkpoint flow go to its shard
+        for flow_key, flow in self.checkpoint_flows:
+            checkpoint_shards_flows[hash(flow_key) % self.workers_count].append((flow_key, flow))
+        self.checkpoint_flows = []
+        for shard in range(self.workers_count):
+            # bounded queue so reading cannot run far ahead of the shards
+            packets_queue = multiprocessing.Queue(self.queue_size)
+            process = multiprocessing.Process(
+                target=shard_process,
+                args=(self.my_dpi_factory, self.flow_table_factory, packets_queue, results_queue,
+                      checkpoint_shards_flows[shard], self.batch_size),
+                daemon=True)
+            process.start()
+            packets_queues.append(packets_queue)
+            processes.append(process)
+
+        # (key, flow) lists the shards left at the end of capture
+        shards_flows = []
+        batches = [[] for _ in range(self.workers_count)]
+        packet_filter = self.packet_filter
+        with PcapReader(pcap_file_name) as pcap:
+            for timestamp, buffer in pcap:
+                if packet_filter is not None and not packet_filter(buffer):
+                    continue
+                shard = get_packet_shard(buffer, self.workers_count)
+                batch = batches[shard]
+                # records are copied once here to be sent to the shard process
+                batch.append((timestamp, bytes(buffer)))
+                if len(batch) >= self.batch_size:
+                    packets_queues[shard].put(batch)
+                    batches[shard] = []
+                    # expired flows are reported while the capture is read, shards do not hold them
+                    self.read_results(results_queue, shards_flows)
+        for shard, packets_queue in enumerate(packets_queues):
+            if batches[shard]:
+                packets_queue.put(batches[shard])
+            packets_queue.put(None)
+
+        # results must be read before joining, a process does not exit until its queue is flushed
+        while len(shards_flows) < len(processes):
+            try:
+                message = results_queue.get(timeout=0.1)
+            except queue.Empty:
+                # a shard that failed never sends its flows
+                if any(process.exitcode not in (None, 0) for process in processes):
+                    raise RuntimeError('a shard process failed')
+                continue
+            self.handle_process_message(message, shards_flows)
+        for process in processes:
+            process.join()
+        self.merge_flows(shards_flows)
+
+    def read_results(self, results_queue, shards_flows):
+        """ Handle the messages of the shards that are already in the results queue
+
+        Args:
+            results_queue (multiprocessing.Queue): results queue of the shards
+            shards_flows (list): (key, flow) lists of the shards
+        """
+        while True:
+            try:
+                message = results_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.handle_process_message(message, shards_flows)
+
+    def merge_flows(self, shards_flows):
+        """ Merge flows of every shard into flows_dict
+            shards never share a flow, so flows are only ordered by their start time
+
+        Args:
+            shards_flows (list): (key, flow) list of every shard
+        """
+        flows = [item for shard_flows in shards_flows for item in shard_flows]
+        flows.sort(key=lambda item: item[1].flow_start_time)
+        for flow_key, flow in flows:
+            self.flows_dict[flow_key] = flow
@@ -0,0 +1,203 @@
+import sys
+import time
+import asyncio
+import threading
+import concurrent.futures
+from collections import Counter
+from worker import Worker
+from my_dpi.pcap_reader import PcapStreamReader
+
+
+class StreamWorker(Worker):
+    """ Worker for captures that are read while they are written: stdin, a FIFO or a growing file
+
+    Packets go through an asyncio pipeline of three stages connected by bounded queues:
+    read (blocking reads in a thread), parse/inspect (Worker.process_packet) and report
+    (expired flows and periodic interim summaries). A full queue stops the stage before it,
+    so a slow stage slows the reader down instead of buffering the capture in memory.
+    """
+
+    def __init__(self, my_bdpi, flow_table=None, report_interval=10.0, follow=False, queue_size=64, batch_size=64,
+                 metrics=None, sampler=None, packet_filter=None, tracer=None):
+        Worker.__init__(self, my_bdpi, flow_table, metrics, sampler, packet_filter, tracer)
+        self.report_interval = report_interval
+        # wait for more data at the end of file, like tail -f
+        self.follow = follow
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        # expired flows are reported by the report stage instead of the flow table
+        self.stream_flow_reporter = self.flow_reporter
+        self.flow_reporter = self.collect_expired_flow
+        self.expired_flows = []
+        # expired flows passed from the inspect stage to the report stage, kept to report them after an interrupt
+        self.reports_queue = None
+        self.packets_count = 0
+        self.reader = None
+
+    def collect_expired_flow(self, flow, reason):
+        """ Keep an expired flow until the inspect stage passes it to the report stage
+
+        Args:
+            flow (Flow): expired flow
+            reason (string): why the flow expired
+        """
+        self.expired_flows.append((flow, reason))
+
+    def executor(self, pcap_file_name):
+        """ Read and process a capture stream until its end
+
+        Args:
+            pcap_file_name (string): path of the capture, '-' for stdin
+        """
+        if pcap_file_name == '-':
+            file = sys.stdin.buffer
+        else:
+            file = open(pcap_file_name, 'rb')
+        self.reader = PcapStreamReader(file, self.follow)
+        try:
+            asyncio.run(self.run_pipeline(self.reader))
+        except KeyboardInterrupt:
+            # stop following the file, flows read so far are still reported:
+            # expired flows here, flows still in the table by export_flows
+            self.reader.stop()
+            self.report_pending_flows()
+        finally:
+            if file is not sys.stdin.buffer:
+                file.close()
+
+    async def run_pipeline(self, reader):
+        """ Run read, parse/inspect and report stages until the end of stream
+
+        Args:
+            reader (PcapStreamReader): capture stream reader
+        """
+        loop = asyncio.get_running_loop()
+        packets_queue = asyncio.Queue(self.queue_size)
+        reports_queue = self.reports_queue = asyncio.Queue(self.queue_size)
+        # daemon thread, an interrupted blocking read does not keep the program alive
+        read_thread = threading.Thread(
+            target=self.read_stage, args=(reader, packets_queue, loop), daemon=True)
+        read_thread.start()
+        await asyncio.gather(
+            self.inspect_stage(packets_queue, reports_queue),
+            self.report_stage(reports_queue),
+        )
+
+    def read_stage(self, reader, packets_queue, loop):
+        """ Read records in batches and put them in packets_queue, runs in a thread
+
+        Args:
+            reader (PcapStreamReader): capture stream reader
+            packets_queue (asyncio.Queue): batches of (timestamp, packet bytes), None at the end
+            loop (asyncio.AbstractEventLoop): event loop of the pipeline
+        """
+        def put(item):
+            # blocks while the queue is full
+            asyncio.run_coroutine_threadsafe(packets_queue.put(item), loop).result()
+
+        batch = []
+
+        def flush():
+            # called by the reader before it waits, read packets are not held back
+            nonlocal batch
+            if batch:
+                put(batch)
+                batch = []
+
+        reader.idle_callback = flush
+        try:
+            try:
+                for record in reader:
+                    batch.append(record)
+                    if len(batch) >= self.batch_size:
+                        flush()
+                flush()
+            finally:
+                put(None)
+        except concurrent.futures.CancelledError:
+            # an interrupted pipeline cancels the waiting put, nothing reads the queue anymore
+            pass
+        except RuntimeError:
+            # or closes its event loop before the next put
+            if not loop.is_closed():
+                raise
+
+    async def inspect_stage(self, packets_queue, reports_queue):
+        """ Process every packet batch and pass expired flows to the report stage
+
+        Args:
+            packets_queue (asyncio.Queue): batches of (timestamp, packet bytes), None at the end
+            reports_queue (asyncio.Queue): lists of (flow, reason), None at the end
+        """
+        while True:
+            batch = await packets_queue.get()
+            if batch is None:
+                break
+            for timestamp, buffer in batch:
+                self.process_packet(buffer, timestamp)
+            self.packets_count += len(batch)
+            if self.expired_flows:
+                await reports_queue.put(self.expired_flows)
+                self.expired_flows = []
+        await reports_queue.put(None)
+
+    async def report_stage(self, reports_queue):
+        """ Report expired flows as they arrive and an interim summary every report_interval seconds
+
+        Args:
+            reports_queue (asyncio.Queue): lists of (flow, reason), None at the end
+        """
+        loop = asyncio.get_running_loop()
+        next_report_time = loop.time() + self.report_interval
+        while True:
+            timeout = next_report_time - loop.time()
+            if self.metrics is not None:
+                # metrics of a stream that receives no packets are exported by this stage
+                timeout = min(timeout, self.metrics.next_export_time - time.monotonic())
+            try:
+                expired_flows = await asyncio.wait_for(reports_queue.get(), max(0, timeout))
+            except asyncio.TimeoutError:
+                expired_flows = []
+            if expired_flows is None:
+                break
+            self.report_flows(expired_flows)
+            if self.metrics is not None:
+                self.metrics.export_if_due()
+            if loop.time() >= next_report_time:
+                # interim reports do not mix with flow records written to the standard output
+                print(self.get_interim_report(), file=sys.stderr)
+                next_report_time = loop.time() + self.report_interval
+
+    def report_flows(self, expired_flows):
+        """ Pass expired flows to the flow reporter of the worker
+
+        Args:
+            expired_flows (list): (flow, reason) list
+        """
+        if self.stream_flow_reporter is not None:
+            for flow, reason in expired_flows:
+                self.stream_flow_reporter(flow, reason)
+
+    def report_pending_flows(self):
+        """ Report expired flows the pipeline did not report before it was interrupted
+        """
+        if self.reports_queue is not None:
+            while not self.reports_queue.empty():
+                expired_flows = self.reports_queue.get_nowait()
+                if expired_flows is not None:
+                    self.report_flows(expired_flows)
+        self.report_flows(self.expired_flows)
+        self.expired_flows = []
+
+    def get_interim_report(self):
+        """ Get summary of packets and flows processed so far
+
+        Returns:
+            string: interim report
+        """
+        protocols_count = Counter(flow.protocol for flow in self.flows_dict.values())
+        protocols = ', '.join(f'{protocol}: {count}' for protocol, count in protocols_count.most_common())
+        # a lowered sampling rate tells the capture is read slower than it is written
+        sampling = f', sampling rate: {self.sampler.rate:g}' if self.sampler is not None else ''
+        return (f'### interim report: packets: {self.packets_count}, '
+                f'active flows: {len(self.flows_dict)}{sampling}; {protocols}\n')
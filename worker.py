@@ -1,80 +1,406 @@
 import os
-import dpkt
 from my_dpi.flow import Flow
 from my_dpi.packet import Packet
 from my_dpi.five_tuple import FiveTuple
-from my_dpi.debug.debugger import Debugger
+from my_dpi.flow_table import FlowTable
+from my_dpi.pcap_reader import PcapReader
+from my_dpi import fast_parser
+from my_dpi.export import get_exporter
+from my_dpi.checkpoint import save_checkpoint, load_checkpoint
+from my_dpi.packet_filter import compile_filter
+
+
+# messages of worker processes to the main process: (kind, list)
+EXPIRED_FLOWS = 'expired_flows'
+FLOWS = 'flows'
+
+
+class ExpiredFlowSender:
+    """ flow_reporter of worker processes, sends expired flows to the main process in batches,
+        so a process holds at most batch_size expired flows
+    """
+
+    def __init__(self, results_queue, batch_size=1024):
+        self.results_queue = results_queue
+        self.batch_size = batch_size
+        self.expired_flows = []
+
+    def __call__(self, flow, reason):
+        # module callbacks of pending flows stay in this process, they may not be picklable
+        flow.inspection_callback = None
+        self.expired_flows.append((flow, reason))
+        if len(self.expired_flows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Send the expired flows of the batch
+        """
+        if self.expired_flows:
+            # the queue pickles the list later in its feeder thread, so the next batch is a new list
+            self.results_queue.put((EXPIRED_FLOWS, self.expired_flows))
+            self.expired_flows = []
 
 
 class Worker:
-    def __init__(self, my_bdpi):
-        self.flows_dict = {}
+    def __init__(self, my_bdpi, flow_table=None, metrics=None, sampler=None, packet_filter=None, tracer=None):
+        # flows_dict is a FlowTable, unbounded unless a configured flow_table is given
+        self.flows_dict = flow_table if flow_table is not None else FlowTable()
         self.my_dpi = my_bdpi
+        # packets go through process_packet_with_metrics when metrics are enabled
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.attach(self.flows_dict, my_bdpi)
+        # packets go through process_packet_with_sampling when flows or packets are sampled
+        self.sampler = sampler
+        # packets that do not match the filter expression are dropped before they are decoded,
+        # the expression is compiled by every process, compiled filters can not be pickled
+        self.packet_filter = compile_filter(packet_filter) if packet_filter is not None else None
+        # reported flows are added to the aggregates, see my_dpi.aggregates
+        self.aggregates = None
+        # record offsets of every flow are added to the flow index, see my_dpi.flow_index
+        self.flow_index = None
+        # packets go through process_packet_with_tracing when flows are traced
+        self.tracer = tracer
+        # process_packet checks one attribute when metrics, sampling and tracing are disabled
+        if metrics is not None:
+            self.instrumented_process_packet = self.process_packet_with_metrics
+        elif sampler is not None:
+            self.instrumented_process_packet = self.process_packet_with_sampling
+        elif tracer is not None:
+            self.instrumented_process_packet = self.process_packet_with_tracing
+        else:
+            self.instrumented_process_packet = None
+        # expired flows release their DPI state before they are reported
+        self.flow_reporter = self.flows_dict.expired_flow_callback
+        self.flows_dict.expired_flow_callback = self.expire_flow
 
-    def process_packet(self, packet_payload, timestamp):
-        """ Initial process for every packet and feed the valid packets to DPI
+    def expire_flow(self, flow, reason):
+        """ Release DPI state of an expired flow and report it
+
+        Args:
+            flow (Flow): expired flow
+            reason (string): why the flow expired
+        """
+        if self.my_dpi is not None:
+            self.my_dpi.release_flow(flow)
+        if self.sampler is not None:
+            self.sampler.finish_flow(flow)
+        if self.aggregates is not None:
+            self.aggregates.add_flow(flow)
+        if self.tracer is not None:
+            self.tracer.finish_flow(flow, reason)
+        if self.flow_reporter is not None:
+            self.flow_reporter(flow, reason)
+
+    def handle_process_message(self, message, processes_flows):
+        """ Report expired flows of a worker process message, or keep the flows it left
+
+        Args:
+            message (tuple): (EXPIRED_FLOWS, (flow, reason) list) or (FLOWS, (key, flow) list)
+            processes_flows (list): (key, flow) lists of the processes, FLOWS lists are appended
+        """
+        kind, items = message
+        if kind == EXPIRED_FLOWS:
+            for flow, reason in items:
+                # DPI state of the flows stayed in the other processes, expire_flow only aggregates and reports them
+                self.expire_flow(flow, reason)
+        else:
+            processes_flows.append(items)
+
+    def decode_packet(self, packet_payload):
+        """ Decode packet headers with dpkt, used for encapsulations the fast parser leaves to dpkt
 
         Args:
             packet_payload (bytes): packet bytes
-            timestamp (float): packet timestamp
+
+        Returns:
+            tuple: (src_ip, dst_ip, is_tcp, src_port, dst_port, payload, tcp_sequence),
+                a fast_parser drop reason if packet is not inspected
         """
-        ethernet = dpkt.ethernet.Ethernet(packet_payload)
+        # dpkt takes longer to import than short runs take to process their capture,
+        # it is only imported by the first packet the fast parser leaves to it
+        import dpkt
+        ethernet = dpkt.ethernet.Ethernet(bytes(packet_payload))
         # Check packet first layer protocol is Ethernet
         if not isinstance(ethernet, dpkt.ethernet.Ethernet):
-            return
+            return fast_parser.MALFORMED
         ip_packet = ethernet.data
         # Check packet second layer protocol is IP
-        if not isinstance(ip_packet, dpkt.ip.IP):
-            return
+        if not isinstance(ip_packet, (dpkt.ip.IP, dpkt.ip6.IP6)):
+            return fast_parser.NON_IP
         ip_payload = ip_packet.data
         # Check packet third layer protocol is UDP or TCP
         if not isinstance(ip_payload, dpkt.udp.UDP) and not isinstance(ip_payload, dpkt.tcp.TCP):
-            return
+            return fast_parser.NON_L4
         # skip UDP/TCP zero length payload
         if not ip_payload.data:
+            return fast_parser.ZERO_PAYLOAD
+        is_tcp = isinstance(ip_payload, dpkt.tcp.TCP)
+        return (
+            ip_packet.src,
+            ip_packet.dst,
+            is_tcp,
+            ip_payload.sport,
+            ip_payload.dport,
+            ip_payload.data,
+            ip_payload.seq if is_tcp else None
+        )
+
+    def process_packet(self, packet_payload, timestamp):
+        """ Initial process for every packet and feed the valid packets to DPI
+
+        Args:
+            packet_payload (bytes): packet bytes
+            timestamp (float): packet timestamp
+        """
+        if self.packet_filter is not None and not self.packet_filter(packet_payload):
+            if self.metrics is not None:
+                self.metrics.count_filtered_packet()
+            return
+        if self.instrumented_process_packet is not None:
+            self.instrumented_process_packet(packet_payload, timestamp)
+            return
+        # expire idle and active flows by packet time
+        if self.flows_dict.expiring:
+            self.flows_dict.expire(timestamp)
+        # decode headers with struct offsets, dpkt only decodes unusual encapsulations
+        decoded_packet = fast_parser.decode_packet(packet_payload)
+        if decoded_packet is fast_parser.FALLBACK:
+            decoded_packet = self.decode_packet(packet_payload)
+        # skip non IP, non UDP/TCP and zero length payload packets
+        if not isinstance(decoded_packet, tuple):
             return
 
         # extract 5-tuple of packet
-        five_tuple_key, reversed_five_tuple_key = FiveTuple.get_five_tuple_of_packet(
-            ip_packet)
-        Debugger.catch_debugger(src=five_tuple_key[0], dst=five_tuple_key[1],
-                                sport=five_tuple_key[3], dport=five_tuple_key[4])
-        find_flow_five_tuple_key = five_tuple_key
-        is_packet_from_client = True
-        # check 5-tuple or its reverse order exist in flows_dict dictionary before
-        if five_tuple_key in self.flows_dict:
-            flow = self.flows_dict[five_tuple_key]
-        elif reversed_five_tuple_key in self.flows_dict:
-            flow = self.flows_dict[reversed_five_tuple_key]
-            is_packet_from_client = not is_packet_from_client
-            find_flow_five_tuple_key = reversed_five_tuple_key
+        five_tuple_key = decoded_packet[:5]
+        application_data = decoded_packet[5]
+        # both directions of a flow have the same key, so one lookup finds the flow
+        flow_key, src_endpoint_is_lower = FiveTuple.get_flow_key(*five_tuple_key)
+        flow = self.flows_dict.lookup(flow_key)
+        if flow is None:
+            # first packet of the flow is sent by the client
+            flow = Flow(five_tuple_key, src_endpoint_is_lower)
+            self.flows_dict.add(flow_key, flow)
+            is_packet_from_client = True
         else:
-            flow = Flow(five_tuple_key)
+            is_packet_from_client = flow.is_packet_from_client(src_endpoint_is_lower)
+
+        application_packet = Packet(
+            is_packet_from_client, timestamp, application_data, decoded_packet[6])
+        flow.update_stats(application_packet)
+        # classified flows and flows inspection gave up on skip the inspector
+        if flow.is_inspecting():
+            self.my_dpi.inspect_packet(five_tuple_key, flow, application_packet)
 
-        # add packet data to dictionary
-        application_data = ip_packet.data.data
+    def process_packet_with_metrics(self, packet_payload, timestamp):
+        """ Same as process_packet, with packets and bytes counted for every stage
+            and stage timings sampled
+
+        Args:
+            packet_payload (bytes): packet bytes
+            timestamp (float): packet timestamp
+        """
+        metrics = self.metrics
+        if self.flows_dict.expiring:
+            self.flows_dict.expire(timestamp)
+        # counters are updated inline, a method call per stage would cost more than the stage
+        metrics.packets_count += 1
+        metrics.bytes_count += len(packet_payload)
+        metrics.packets_until_timing -= 1
+        is_timed = metrics.packets_until_timing <= 0
+        if is_timed:
+            start_time = metrics.start_timing()
+
+        decoded_packet = fast_parser.decode_packet(packet_payload)
+        if decoded_packet is fast_parser.FALLBACK:
+            decoded_packet = self.decode_packet(packet_payload)
+        if is_timed:
+            start_time = metrics.add_stage_time(metrics.DECODE, start_time)
+        if not isinstance(decoded_packet, tuple):
+            metrics.count_drop(decoded_packet)
+            return
+
+        five_tuple_key = decoded_packet[:5]
+        application_data = decoded_packet[5]
+        metrics.decoded_packets_count += 1
+        metrics.decoded_bytes_count += len(application_data)
+        flow_key, src_endpoint_is_lower = FiveTuple.get_flow_key(*five_tuple_key)
+        flow = self.flows_dict.lookup(flow_key)
+        if flow is None:
+            flow = Flow(five_tuple_key, src_endpoint_is_lower)
+            self.flows_dict.add(flow_key, flow)
+            is_packet_from_client = True
+            metrics.flows_created_count += 1
+        else:
+            is_packet_from_client = flow.is_packet_from_client(src_endpoint_is_lower)
+        if is_timed:
+            start_time = metrics.add_stage_time(metrics.FLOW_LOOKUP, start_time)
+
+        application_packet = Packet(
+            is_packet_from_client, timestamp, application_data, decoded_packet[6])
+        flow.update_stats(application_packet)
+        if is_timed:
+            start_time = metrics.add_stage_time(metrics.STATS_UPDATE, start_time)
+
+        if flow.is_inspecting():
+            metrics.inspected_packets_count += 1
+            metrics.inspected_bytes_count += len(application_data)
+            self.my_dpi.inspect_packet(five_tuple_key, flow, application_packet)
+            if is_timed:
+                metrics.add_stage_time(metrics.INSPECTION, start_time)
+
+    def process_packet_with_sampling(self, packet_payload, timestamp):
+        """ Same as process_packet, with packets of flows that are not sampled dropped
+            after their headers are decoded and counters of sampled flows scaled up
+
+        Args:
+            packet_payload (bytes): packet bytes
+            timestamp (float): packet timestamp
+        """
+        sampler = self.sampler
+        if sampler.target_lag is not None:
+            sampler.control(timestamp)
+        if self.flows_dict.expiring:
+            self.flows_dict.expire(timestamp)
+        decoded_packet = fast_parser.decode_packet(packet_payload)
+        if decoded_packet is fast_parser.FALLBACK:
+            decoded_packet = self.decode_packet(packet_payload)
+        if not isinstance(decoded_packet, tuple):
+            return
+        sampler.packets_count += 1
+
+        five_tuple_key = decoded_packet[:5]
+        application_data = decoded_packet[5]
+        flow_key, src_endpoint_is_lower = FiveTuple.get_flow_key(*five_tuple_key)
+        flow = self.flows_dict.lookup(flow_key)
+        if flow is None:
+            # flows that are not sampled are decided again by their next packet, they keep no state
+            if sampler.is_flow_mode and not sampler.is_flow_sampled(flow_key, timestamp):
+                return
+            flow = Flow(five_tuple_key, src_endpoint_is_lower)
+            flow.sampling_weight = sampler.weight
+            self.flows_dict.add(flow_key, flow)
+            is_packet_from_client = True
+            # counters of sampled flows are scaled when the flow is finished, first packets are counted once
+            weight = 1
+        elif sampler.is_flow_mode:
+            is_packet_from_client = flow.is_packet_from_client(src_endpoint_is_lower)
+            weight = 1
+        elif sampler.is_packet_sampled():
+            is_packet_from_client = flow.is_packet_from_client(src_endpoint_is_lower)
+            # the packet was kept with the current rate, which target lag control may have changed mid-flow
+            weight = sampler.weight
+        else:
+            return
+        sampler.sampled_packets_count += 1
+
+        application_packet = Packet(
+            is_packet_from_client, timestamp, application_data, decoded_packet[6])
+        if weight == 1:
+            flow.update_stats(application_packet)
+        else:
+            flow.update_sampled_stats(application_packet, weight)
+        if flow.is_inspecting():
+            self.my_dpi.inspect_packet(five_tuple_key, flow, application_packet)
+
+    def process_packet_with_tracing(self, packet_payload, timestamp):
+        """ Same as process_packet, with new flows checked against the trace targets
+            and decoding and inspection of traced flows written to the trace file
+
+        Args:
+            packet_payload (bytes): packet bytes
+            timestamp (float): packet timestamp
+        """
+        tracer = self.tracer
+        if self.flows_dict.expiring:
+            self.flows_dict.expire(timestamp)
+        decoder = 'fast_parser'
+        decoded_packet = fast_parser.decode_packet(packet_payload)
+        if decoded_packet is fast_parser.FALLBACK:
+            decoder = 'dpkt'
+            decoded_packet = self.decode_packet(packet_payload)
+        if not isinstance(decoded_packet, tuple):
+            return
+
+        five_tuple_key = decoded_packet[:5]
+        application_data = decoded_packet[5]
+        flow_key, src_endpoint_is_lower = FiveTuple.get_flow_key(*five_tuple_key)
+        flow = self.flows_dict.lookup(flow_key)
+        if flow is None:
+            flow = Flow(five_tuple_key, src_endpoint_is_lower)
+            self.flows_dict.add(flow_key, flow)
+            is_packet_from_client = True
+            # targets are only checked here, next packets look the flow key up in the traced flows
+            tracer.check_new_flow(flow_key, flow, timestamp)
+        else:
+            is_packet_from_client = flow.is_packet_from_client(src_endpoint_is_lower)
 
         application_packet = Packet(
-            is_packet_from_client, timestamp, application_data)
+            is_packet_from_client, timestamp, application_data, decoded_packet[6])
         flow.update_stats(application_packet)
-        self.flows_dict.update({find_flow_five_tuple_key: flow})
-        self.my_dpi.inspect_packet(five_tuple_key, flow, application_packet)
+        description = tracer.traced_flows.get(flow_key)
+        if description is not None:
+            tracer.trace_packet(description, flow, application_packet, decoder)
+        if flow.is_inspecting():
+            self.my_dpi.inspect_packet(five_tuple_key, flow, application_packet)
+            if description is not None:
+                tracer.trace_inspection(description, flow, application_packet)
+
+    def save_checkpoint(self, path):
+        """ Write flows of flows_dict to a checkpoint file, a later run continues them with load_checkpoint
+
+        Args:
+            path (string): checkpoint file path
+        """
+        save_checkpoint(path, self.flows_dict.values())
+
+    def load_checkpoint(self, path):
+        """ Add flows of a checkpoint file to flows_dict, used before the next capture file is processed
+
+        Args:
+            path (string): checkpoint file path
+        """
+        for flow_key, flow in load_checkpoint(path):
+            self.flows_dict.add(flow_key, flow)
+
+    def export_flows(self, exporter):
+        """ Export flows that are still in flows_dict at the end of the capture
+
+        Args:
+            exporter (FlowExporter): flow exporter
+        """
+        for flow in self.flows_dict.values():
+            if self.sampler is not None:
+                self.sampler.finish_flow(flow)
+            if self.aggregates is not None:
+                self.aggregates.add_flow(flow)
+            if self.tracer is not None:
+                self.tracer.finish_flow(flow, FlowTable.END_OF_CAPTURE)
+            exporter.export_flow(flow, FlowTable.END_OF_CAPTURE)
+        exporter.flush()
 
     def print_conversation(self):
         """Print flows_dict conversation in terminal
         """
-        for flow_key in self.flows_dict:
-            # Get flow state string from get_state_string function and print it here
-            print(self.flows_dict[flow_key].get_state_string())
+        self.export_flows(get_exporter('text'))
 
     def executor(self, pcap_file_name):
-        """ Read every packet from pcap file
+        """ Read every packet from pcap or pcapng file
 
         Args:
             pcap_file_name (string): path of the pcap file
         """
-        # open pcap file and feed every packet to process packet function
-        with open(pcap_file_name, 'rb') as file:
-            pcap = dpkt.pcap.Reader(file)
-            for timestamp, buffer in pcap:
+        # map pcap file in memory and feed every packet to process packet function
+        with PcapReader(pcap_file_name) as pcap:
+            if self.flow_index is None:
+                for timestamp, buffer in pcap:
+                    self.process_packet(buffer, timestamp)
+                return
+            # every record is indexed by its offset, packets the filter drops included
+            add_packet = self.flow_index.add_packet
+            view = pcap.view
+            for timestamp, data_offset, captured_length in pcap.iter_record_offsets():
+                buffer = view[data_offset:data_offset + captured_length]
+                add_packet(pcap.record_offset, buffer)
                 self.process_packet(buffer, timestamp)
+            self.flow_index.finish_capture(pcap_file_name, pcap)